@@ -0,0 +1,574 @@
+import os
+import random
+import statistics
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import click
+import sqlalchemy as sa
+from sqlalchemy import bindparam, func, insert, lambda_stmt, select
+
+from generate_data import DataGenerator
+from lib import audit, availability, database, reports
+from lib.models import AuditEntry, Base, User, Book, Rental, Reservation, UserBook
+from lib.matching import NameIndex
+from lib.online_migration import rebuild_table
+from lib.recommendations import Recommender
+from lib.services.rental_service import RentalService
+from lib.services.user_service import UserService
+from lib.services.reservation_service import ReservationService
+
+
+def _scratch_database(directory):
+    """Point the services at an empty SQLite file inside directory."""
+    path = os.path.join(directory, "bench.db")
+    engine = database.configure(f"sqlite:///{path}", connect_args={"timeout": 60})
+    Base.metadata.create_all(engine)
+    return engine
+
+
+def _percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+@click.group()
+def bench():
+    """Benchmarks that run against a throwaway database."""
+    pass
+
+
+@click.command()
+@click.option('--entries', default=2000, show_default=True, help="Users queueing for the hot title.")
+@click.option('--workers', default=16, show_default=True, help="Threads placing reservations at once.")
+def waitlist(entries, workers):
+    """Queue thousands of users for one title, then drain the queue through returns."""
+    reservations = ReservationService()
+    rentals = RentalService()
+
+    with tempfile.TemporaryDirectory() as directory:
+        engine = _scratch_database(directory)
+        with engine.begin() as connection:
+            connection.execute(insert(Book.__table__), [{"id": 1, "title": "Hot Title", "author": "Someone", "available": 1}])
+            connection.execute(insert(User.__table__), [
+                {"id": i, "name": f"User {i}", "email": f"user{i}@example.com"} for i in range(entries + 1)
+            ])
+        rentals.rent_book(0, 1)  # User 0 takes the only copy
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(lambda user_id: reservations.reserve_book(user_id, 1), range(1, entries + 1)))
+        enqueue_seconds = time.perf_counter() - started
+        failures = [r for r in results if r.startswith("Error")]
+        click.echo(f"Enqueued {entries - len(failures)}/{entries} reservations from {workers} threads "
+                   f"in {enqueue_seconds:.2f}s ({entries / enqueue_seconds:.0f}/s)")
+
+        with engine.connect() as connection:
+            queue = connection.execute(
+                select(Reservation.user_id).where(Reservation.book_id == 1).order_by(Reservation.id)
+            ).scalars().all()
+
+        # Each cycle: the holder returns the copy, the next user in line collects it
+        latencies = []
+        holders = []
+        started = time.perf_counter()
+        for _ in queue:
+            with engine.connect() as connection:
+                rental_id = connection.scalar(
+                    select(Rental.id).where(Rental.book_id == 1, Rental.return_date.is_(None))
+                )
+            tick = time.perf_counter()
+            rentals.return_book(rental_id)
+            latencies.append(time.perf_counter() - tick)
+            with engine.connect() as connection:
+                holder = connection.scalar(
+                    select(Reservation.user_id).where(Reservation.book_id == 1, Reservation.status == 'ready')
+                )
+            holders.append(holder)
+            rentals.rent_book(holder, 1)
+        drain_seconds = time.perf_counter() - started
+
+        click.echo(f"Drained {len(queue)} holds in {drain_seconds:.2f}s ({len(queue) / drain_seconds:.0f} cycles/s)")
+        click.echo(f"return_book with allocation: p50 {statistics.median(latencies) * 1000:.2f} ms, "
+                   f"p99 {_percentile(latencies, 99) * 1000:.2f} ms")
+        click.echo("FIFO order preserved" if holders == queue else "FIFO order VIOLATED")
+        engine.dispose()
+
+
+@click.command()
+@click.option('--books', default=200000, show_default=True, help="Rows in the table being rebuilt.")
+@click.option('--writers', default=4, show_default=True, help="Threads renting and returning during the rebuild.")
+@click.option('--chunk-size', default=5000, show_default=True, help="Rows copied per transaction.")
+@click.option('--database-url', default=None,
+              help="Run against this database (e.g. a scratch PostgreSQL one) instead of a temporary SQLite file. "
+                   "Its tables are dropped and recreated.")
+def online_rebuild(books, writers, chunk_size, database_url):
+    """Rebuild `books` online while rentals and returns keep writing to it."""
+    rentals = RentalService()
+
+    with tempfile.TemporaryDirectory() as directory:
+        if database_url:
+            engine = database.configure(database_url)
+            Base.metadata.drop_all(engine)
+        else:
+            engine = _scratch_database(directory)
+        DataGenerator(users=books // 10, books=books, rentals=books // 2, seed=7,
+                      batch_size=50000).load(engine)
+        click.echo("")
+        with engine.connect() as connection:
+            # Copies per title = on the shelf + still out; must hold before and after
+            active = select(Rental.book_id, func.count().label("out")).where(Rental.return_date.is_(None)).group_by(Rental.book_id).subquery()
+            copies = dict(connection.execute(
+                select(Book.id, Book.available + func.coalesce(active.c.out, 0)).outerjoin(active, active.c.book_id == Book.id)
+            ).all())
+            users = connection.scalar(select(func.max(User.id)))
+
+        stop = threading.Event()
+        counts = {"rented": 0, "returned": 0, "errors": 0}
+        latencies, errors = [], []
+
+        def write(worker):
+            # Each writer owns the titles with id % writers == worker. SQLite ignores
+            # FOR UPDATE, so writers sharing a title could race on `available`
+            # themselves and hide what the rebuild does.
+            rng = random.Random(worker)
+            while not stop.is_set():
+                tick = time.perf_counter()
+                try:
+                    if rng.random() < 0.5:
+                        book_id = rng.randrange(worker or writers, books + 1, writers)
+                        if rentals.rent_book(rng.randint(1, users), book_id).startswith("User"):
+                            counts["rented"] += 1
+                    else:
+                        with engine.connect() as connection:
+                            rental_id = connection.scalar(
+                                select(Rental.id)
+                                .where(Rental.return_date.is_(None), Rental.book_id % writers == worker)
+                                .order_by(Rental.id.desc()).limit(1)
+                            )
+                        if rental_id and rentals.return_book(rental_id).startswith("Rental"):
+                            counts["returned"] += 1
+                except Exception as error:
+                    counts["errors"] += 1
+                    errors.append(f"{type(error).__name__}: {str(error).splitlines()[0]}")
+                latencies.append(time.perf_counter() - tick)
+
+        threads = [threading.Thread(target=write, args=(worker,)) for worker in range(writers)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.5)
+
+        last_progress = [0.0]
+
+        def progress(message):
+            if time.monotonic() - last_progress[0] > 1 or "rebuilt" in message:
+                last_progress[0] = time.monotonic()
+                click.echo(message)
+
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+            stats = rebuild_table(connection, 'books', [
+                sa.Column('id', sa.Integer, primary_key=True),
+                sa.Column('title', sa.String, nullable=False),
+                sa.Column('author', sa.String, nullable=False),
+                sa.Column('available', sa.Integer, nullable=True),
+                sa.Column('genres', sa.String, nullable=True),
+            ], chunk_size=chunk_size, progress=progress)
+
+        time.sleep(0.5)
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+        with engine.connect() as connection:
+            after = dict(connection.execute(
+                select(Book.id, Book.available + func.coalesce(active.c.out, 0)).outerjoin(active, active.c.book_id == Book.id)
+            ).all())
+        lost = sum(1 for book_id, count in copies.items() if after.get(book_id) != count)
+
+        click.echo(f"Writers: {counts['rented']} rentals, {counts['returned']} returns, {counts['errors']} errors; "
+                   f"p50 {statistics.median(latencies) * 1000:.1f} ms, max {max(latencies) * 1000:.0f} ms")
+        for message in sorted(set(errors)):
+            click.echo(f"  {errors.count(message)} x {message}")
+        click.echo(f"Write lock held for {stats['swap_seconds'] * 1000:.0f} ms of a {stats['total_seconds']:.1f}s rebuild"
+                   f" ({stats['swap_attempts']} swap attempt(s))")
+        click.echo("All copies accounted for after the rebuild" if lost == 0 else f"{lost} titles lost or gained copies")
+        if engine.dialect.name == "postgresql":
+            with engine.connect() as connection:
+                references = connection.execute(sa.text(
+                    "SELECT conrelid::regclass::text, convalidated FROM pg_constraint "
+                    "WHERE contype = 'f' AND confrelid = 'books'::regclass ORDER BY 1")).all()
+            click.echo("Foreign keys on books: " + ", ".join(
+                f"{table} ({'valid' if valid else 'NOT VALID'})" for table, valid in references))
+        engine.dispose()
+
+
+@click.command()
+@click.option('--calls', default=10000, show_default=True, help="Calls per variant.")
+def statement_cache(calls):
+    """Per-call cost of the active-rental check: ORM Query, fresh select(), lambda_stmt and a prebuilt select()."""
+    with tempfile.TemporaryDirectory() as directory:
+        engine = _scratch_database(directory)
+        with engine.begin() as connection:
+            connection.execute(insert(User.__table__), [
+                {"id": i, "name": f"User {i}", "email": f"user{i}@example.com"} for i in range(1, 1001)
+            ])
+            connection.execute(insert(Book.__table__), [
+                {"id": i, "title": f"Book {i}", "author": "Someone", "available": 1} for i in range(1, 101)
+            ])
+
+        def query(session, user_id, book_id):
+            return session.query(Rental).filter_by(user_id=user_id, book_id=book_id, return_date=None).first()
+
+        def plain_select(session, user_id, book_id):
+            return session.scalar(
+                select(Rental.id)
+                .where(Rental.user_id == user_id, Rental.book_id == book_id, Rental.return_date.is_(None))
+                .limit(1)
+            )
+
+        def cached_lambda(session, user_id, book_id):
+            return session.scalar(lambda_stmt(
+                lambda: select(Rental.id)
+                .where(Rental.user_id == user_id, Rental.book_id == book_id, Rental.return_date.is_(None))
+                .limit(1)
+            ))
+
+        prebuilt_statement = (
+            select(Rental.id)
+            .where(Rental.user_id == bindparam("user_id"), Rental.book_id == bindparam("book_id"),
+                   Rental.return_date.is_(None))
+            .limit(1)
+        )
+
+        def prebuilt(session, user_id, book_id):  # What the services do
+            return session.scalar(prebuilt_statement, {"user_id": user_id, "book_id": book_id})
+
+        click.echo(f"{'variant':<10}{'us/call':>10}{'calls/s':>10}{'python us':>11}{'cache hits':>12}{'misses':>8}")
+        for name, check in (("query", query), ("select", plain_select), ("lambda", cached_lambda), ("prebuilt", prebuilt)):
+            session = database.get_session()
+            before = database.engine_stats()["primary"]
+            started = time.perf_counter()
+            for call in range(calls):
+                check(session, call % 1000 + 1, call % 100 + 1)
+            elapsed = time.perf_counter() - started
+            session.close()
+            after = database.engine_stats()["primary"]
+            in_database = after["total_seconds"] - before["total_seconds"]
+            click.echo(f"{name:<10}{elapsed / calls * 1e6:>10.1f}{calls / elapsed:>10.0f}"
+                       f"{(elapsed - in_database) / calls * 1e6:>11.1f}"
+                       f"{after['cache_hits'] - before['cache_hits']:>12}{after['cache_misses'] - before['cache_misses']:>8}")
+        engine.dispose()
+
+
+@click.command()
+@click.option('--users', default=20000, show_default=True, help="Users in the generated history.")
+@click.option('--books', default=5000, show_default=True, help="Books in the generated history.")
+@click.option('--rentals', default=200000, show_default=True, help="Rentals in the generated history.")
+@click.option('--lookups', default=2000, show_default=True, help="Lookups timed per kind.")
+def recommend(users, books, rentals, lookups):
+    """Build recommendations from a generated history, then time lookups and incremental updates."""
+    with tempfile.TemporaryDirectory() as directory:
+        engine = _scratch_database(directory)
+        DataGenerator(users=users, books=books, rentals=rentals, seed=11, batch_size=50000).load(engine)
+        click.echo("")
+        # Hold back the newest tenth of the history to fold in incrementally afterwards
+        with engine.begin() as connection:
+            cutoff = connection.scalar(select(func.max(Rental.id))) * 9 // 10
+            held_back = [dict(row._mapping) for row in connection.execute(
+                select(Rental.__table__).where(Rental.id > cutoff))]
+            connection.execute(sa.delete(Rental.__table__).where(Rental.id > cutoff))
+
+        recommender = Recommender()
+        recommender.rebuild(echo=click.echo)
+
+        with engine.begin() as connection:
+            connection.execute(insert(Rental.__table__), held_back)
+        started = time.perf_counter()
+        folded = recommender.update()
+        elapsed = time.perf_counter() - started
+        click.echo(f"Incremental update: {folded} rentals in {elapsed:.2f}s ({folded / elapsed:.0f}/s)")
+
+        rng = random.Random(3)
+        for kind, lookup, top in (("book", recommender.for_book, books), ("user", recommender.for_user, users)):
+            latencies = []
+            for _ in range(lookups):
+                target = rng.randint(1, top)
+                tick = time.perf_counter()
+                lookup(target)
+                latencies.append(time.perf_counter() - tick)
+            click.echo(f"for_{kind}: p50 {_percentile(latencies, 50) * 1000:.2f} ms, "
+                       f"p99 {_percentile(latencies, 99) * 1000:.2f} ms over {lookups} lookups")
+        engine.dispose()
+
+
+def _typo(rng, text):
+    """Drop, double or swap one letter, or replace it with a neighbour."""
+    i = rng.randrange(len(text) - 1)
+    edit = rng.randrange(4)
+    if edit == 0:
+        return text[:i] + text[i + 1:]
+    if edit == 1:
+        return text[:i] + text[i] + text[i:]
+    if edit == 2:
+        return text[:i] + text[i + 1] + text[i] + text[i + 2:]
+    return text[:i] + chr(ord(text[i]) + 1) + text[i + 1:]
+
+
+@click.command()
+@click.option('--titles', default=1000000, show_default=True, help="Titles in the in-memory catalog.")
+@click.option('--queries', default=2000, show_default=True, help="Mistyped lookups timed.")
+def fuzzy_match(titles, queries):
+    """Index generated titles in memory and time lookups with one or two typos each."""
+    rng = random.Random(5)
+    syllables = ["ka", "ri", "mo", "sa", "len", "tor", "vi", "na", "ber", "do", "sha", "mi", "lu", "ron", "te",
+                 "gal", "pe", "zi", "hu", "an", "ost", "wy", "que", "dra"]
+    vocabulary = list({"".join(rng.choice(syllables) for _ in range(rng.randint(1, 4))) for _ in range(20000)})
+    common = ["the", "of", "and", "a", "in"]
+    catalog = []
+    for _ in range(titles):
+        words = [rng.choice(vocabulary) for _ in range(rng.randint(1, 5))]
+        if rng.random() < 0.5:
+            words.insert(rng.randrange(len(words) + 1), rng.choice(common))
+        catalog.append(" ".join(words).title())
+
+    index = NameIndex()
+    started = time.perf_counter()
+    for title_id, title in enumerate(catalog, start=1):
+        index.add(title_id, title)
+    click.echo(f"Indexed {titles} titles in {time.perf_counter() - started:.1f}s")
+
+    latencies, found = [], 0
+    for _ in range(queries):
+        title_id = rng.randint(1, titles)
+        query = catalog[title_id - 1]
+        for _ in range(rng.randint(1, 2)):
+            query = _typo(rng, query) if len(query) > 2 else query
+        tick = time.perf_counter()
+        matches = index.search(query)
+        latencies.append(time.perf_counter() - tick)
+        found += any(match_id == title_id or match_text == catalog[title_id - 1] for _, match_id, match_text in matches)
+    click.echo(f"search: p50 {_percentile(latencies, 50) * 1000:.2f} ms, p99 {_percentile(latencies, 99) * 1000:.2f} ms, "
+               f"intended title in top 5 for {found / queries:.1%} of {queries} mistyped queries")
+
+
+@click.command()
+@click.option('--users', default=200000, show_default=True, help="Users in the generated history.")
+@click.option('--books', default=50000, show_default=True, help="Books in the generated history.")
+@click.option('--rentals', default=3000000, show_default=True, help="Rentals in the generated history.")
+@click.option('--max-workers', default=None, type=int, help="Largest pool to time (default: the core count).")
+def parallel_report(users, books, rentals, max_workers):
+    """Time both history reports with 1, 2, 4, ... worker processes and check they agree."""
+    max_workers = max_workers or os.cpu_count() or 1
+    counts = sorted({1, max_workers} | {2 ** power for power in range(max_workers.bit_length()) if 2 ** power <= max_workers})
+    with tempfile.TemporaryDirectory() as directory:
+        engine = _scratch_database(directory)
+        DataGenerator(users=users, books=books, rentals=rentals, seed=13, batch_size=50000).load(engine)
+        click.echo("")
+        reports.run(reports.PenaltyRevenue(), workers=1)  # Warm the page cache
+
+        click.echo(f"{'report':<11}{'workers':>8}{'seconds':>9}{'speedup':>9}{'rows/s':>12}")
+        for name, make in (("penalties", reports.PenaltyRevenue),
+                           ("users", lambda: reports.UserSummary(os.path.join(directory, "users.csv")))):
+            baseline = expected = None
+            for workers in counts:
+                started = time.perf_counter()
+                report = make()
+                # Compared as printed (penalties to the cent, so float summation order doesn't matter)
+                output = report.lines(reports.run(report, workers=workers))
+                elapsed = time.perf_counter() - started
+                if name == "users":
+                    with open(report.path) as written:
+                        output.append(written.read())
+                if expected is None:
+                    baseline, expected = elapsed, output
+                elif output != expected:
+                    raise click.ClickException(f"{name} with {workers} workers disagrees with the single-process result")
+                click.echo(f"{name:<11}{workers:>8}{elapsed:>9.2f}{baseline / elapsed:>8.2f}x{rentals / elapsed:>12.0f}")
+        engine.dispose()
+
+
+@click.command()
+@click.option('--rentals', default=50000, show_default=True, help="Returned rentals in the deleted user's history.")
+@click.option('--batch-size', default=2000, show_default=True, help="Rows removed per transaction.")
+def delete_user(rentals, batch_size):
+    """Delete a user with a long rental history, the old ORM-cascade way and with batched cleanup."""
+    with tempfile.TemporaryDirectory() as directory:
+        engine = _scratch_database(directory)
+        DataGenerator(users=1000, books=2000, rentals=20000, seed=17, batch_size=50000).load(engine)
+        click.echo("")
+        now = datetime(2024, 1, 1)
+        with engine.begin() as connection:
+            first_user = connection.scalar(select(func.max(User.id))) + 1
+            for user_id in (first_user, first_user + 1):
+                connection.execute(insert(User.__table__), [
+                    {"id": user_id, "name": f"Heavy Reader {user_id}", "email": f"heavy{user_id}@example.com"}])
+                connection.execute(insert(Rental.__table__), [
+                    {"user_id": user_id, "book_id": i % 2000 + 1, "rent_date": now - timedelta(days=i % 3000 + 14),
+                     "due_date": now - timedelta(days=i % 3000), "return_date": now - timedelta(days=i % 3000),
+                     "penalty": 0.0}
+                    for i in range(rentals)
+                ])
+                connection.execute(insert(UserBook.__table__), [
+                    {"user_id": user_id, "book_id": i + 1} for i in range(min(rentals, 2000))])
+            # A newer rental by someone else, so neither user owns the newest row
+            connection.execute(insert(Rental.__table__), [
+                {"user_id": 1, "book_id": 1, "rent_date": now, "due_date": now, "return_date": now, "penalty": 0.0}])
+
+        def orm_cascade(user_id):  # What cascade="all, delete" did: load every row, delete one by one
+            session = database.get_session()
+            try:
+                for rental in session.scalars(select(Rental).where(Rental.user_id == user_id)):
+                    session.delete(rental)
+                session.execute(sa.delete(UserBook.__table__).where(UserBook.user_id == user_id))
+                session.delete(session.get(User, user_id))
+                session.commit()
+            finally:
+                session.close()
+
+        for name, user_id, remove in (("orm", first_user, orm_cascade),
+                                      ("batched", first_user + 1,
+                                       lambda user_id: UserService().delete_user(user_id, batch_size=batch_size))):
+            tracemalloc.start()
+            started = time.perf_counter()
+            remove(user_id)
+            elapsed = time.perf_counter() - started
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            with engine.connect() as connection:
+                left = connection.scalar(select(func.count()).select_from(Rental).where(Rental.user_id == user_id))
+            click.echo(f"{name:<8} {elapsed:6.2f}s, peak Python memory {peak / 2**20:6.1f} MiB, {left} rentals left")
+        engine.dispose()
+
+
+@click.command('availability')
+@click.option('--books', default=100000, show_default=True, help="Books in the catalog.")
+@click.option('--checks', default=20000, show_default=True, help="Point checks timed per source.")
+@click.option('--seconds', default=5.0, show_default=True, help="How long to rent and return during the churn phase.")
+def availability_snapshot(books, checks, seconds):
+    """Availability checks from the database and from the snapshot, then churn and verify it."""
+    with tempfile.TemporaryDirectory() as directory:
+        engine = _scratch_database(directory)
+        DataGenerator(users=books // 5, books=books, rentals=books, seed=19, batch_size=50000).load(engine)
+        click.echo("")
+        availability.ENABLED = True
+        started = time.perf_counter()
+        snapshot = availability.snapshot()
+        click.echo(f"Loaded the snapshot of {books} books in {(time.perf_counter() - started) * 1000:.0f} ms")
+
+        rng = random.Random(23)
+        ids = [rng.randint(1, books) for _ in range(checks)]
+        point = select(Book.available).where(Book.id == bindparam("book_id"))
+        with engine.connect() as connection:
+            started = time.perf_counter()
+            for book_id in ids:
+                connection.scalar(point, {"book_id": book_id})
+            from_database = (time.perf_counter() - started) / checks
+            started = time.perf_counter()
+            connection.execute(select(func.count(), func.sum(Book.available)).where(Book.available > 0)).one()
+            total_database = time.perf_counter() - started
+        started = time.perf_counter()
+        for book_id in ids:
+            snapshot.available(book_id)
+        from_snapshot = (time.perf_counter() - started) / checks
+        started = time.perf_counter()
+        snapshot.totals()
+        total_snapshot = time.perf_counter() - started
+        click.echo(f"point check: database {from_database * 1e6:.1f} us, snapshot {from_snapshot * 1e6:.2f} us")
+        click.echo(f"catalog totals: database {total_database * 1000:.1f} ms, snapshot {total_snapshot * 1e6:.1f} us")
+
+        # Rentals and returns through the services report what they commit; direct
+        # UPDATEs on another connection stand in for other processes
+        rentals = RentalService()
+        stop = time.monotonic() + seconds
+        writes = {"service": 0, "foreign": 0}
+        while time.monotonic() < stop:
+            if rng.random() < 0.8:
+                with engine.connect() as connection:
+                    rental_id = connection.scalar(select(Rental.id).where(Rental.return_date.is_(None)).limit(1))
+                if rng.random() < 0.5 or rental_id is None:
+                    rentals.rent_book(rng.randint(1, books // 5), rng.randint(1, books))
+                else:
+                    rentals.return_book(rental_id)
+                writes["service"] += 1
+            else:
+                with engine.begin() as connection:
+                    connection.execute(sa.update(Book.__table__).where(Book.id == rng.randint(1, books))
+                                       .values(available=Book.available + 1))
+                writes["foreign"] += 1
+        stale = len(snapshot.verify())
+        time.sleep(snapshot.poll_seconds)
+        snapshot.totals()  # Polls the change version
+        click.echo(f"Churn: {writes['service']} service writes, {writes['foreign']} foreign updates, "
+                   f"{snapshot.reloads} reloads; {stale} books stale right after, "
+                   f"{len(snapshot.verify())} after one poll interval")
+        snapshot.close()
+        engine.dispose()
+
+
+@click.command('audit')
+@click.option('--cycles', default=2000, show_default=True, help="Rent-and-return cycles per configuration.")
+def audit_overhead(cycles):
+    """Rental path latency with no audit log, a synchronous one and the buffered one."""
+    with tempfile.TemporaryDirectory() as directory:
+        engine = _scratch_database(directory)
+        DataGenerator(users=2000, books=5000, rentals=20000, seed=29, batch_size=50000).load(engine)
+        click.echo("")
+        path = os.path.join(directory, "audit.jsonl")
+        configurations = (
+            ("off", None, {}),
+            ("synchronous", "table", {"capacity": 1}),  # Every commit writes its own records before returning
+            ("buffered table", "table", {}),
+            ("buffered file", f"file:{path}", {}),
+        )
+        rentals = RentalService()
+        rng = random.Random(31)
+        for name, url, options in configurations:
+            log = audit.enable(url, **options) if url else None
+            samples = []
+            started = time.perf_counter()
+            for _ in range(cycles):
+                user_id, book_id = rng.randint(1, 2000), rng.randint(1, 5000)
+                began = time.perf_counter()
+                rentals.rent_book(user_id, book_id)
+                with engine.connect() as connection:
+                    rental_id = connection.scalar(select(func.max(Rental.id)).where(
+                        Rental.user_id == user_id, Rental.return_date.is_(None)))
+                if rental_id is not None:
+                    rentals.return_book(rental_id)
+                samples.append(time.perf_counter() - began)
+            elapsed = time.perf_counter() - started
+            closing = time.perf_counter()
+            audit.disable()
+            closing = time.perf_counter() - closing
+            line = (f"{name:<15} {cycles / elapsed:7.0f} cycles/s, p50 {_percentile(samples, 50) * 1000:5.2f} ms, "
+                    f"p99 {_percentile(samples, 99) * 1000:5.2f} ms")
+            if log is not None:
+                if url == "table":
+                    with engine.begin() as connection:
+                        stored = connection.scalar(select(func.count()).select_from(AuditEntry))
+                        connection.execute(sa.delete(AuditEntry.__table__))
+                else:
+                    with open(path) as written:
+                        stored = sum(1 for _ in written)
+                line += (f"; {log.stats['captured']} records in {log.stats['batches']} batches, "
+                         f"{stored} stored, final flush {closing * 1000:.0f} ms")
+            click.echo(line)
+        engine.dispose()
+
+
+bench.add_command(waitlist)
+bench.add_command(online_rebuild)
+bench.add_command(statement_cache)
+bench.add_command(recommend)
+bench.add_command(parallel_report)
+bench.add_command(delete_user)
+bench.add_command(availability_snapshot)
+bench.add_command(audit_overhead)
+bench.add_command(fuzzy_match)
+
+if __name__ == "__main__":
+    bench()
@@ -3,15 +3,19 @@
 from lib.services.user_service import UserService
 from lib.services.book_service import BookService
 from lib.services.rental_service import RentalService
+from lib.services.reservation_service import ReservationService
+from lib.profiling import enable_from_env, profiled
 import click
 
 # Instantiate services
 user_service = UserService()
 book_service = BookService()
 rental_service = RentalService()
+reservation_service = ReservationService()
 
 def main_menu():
     """Displays the main menu options."""
+    enable_from_env()
     while True:
         click.echo("\n===== Welcome to Jamii Book Rental Management System =====")
         click.echo("\n===== Main Menu =====")
@@ -44,7 +48,8 @@ def manage_users():
         click.echo("2. Delete a user")
         click.echo("3. List all users")
         click.echo("4. Find user by attribute")
-        click.echo("5. Back to Main Menu")
+        click.echo("5. View account summary")
+        click.echo("6. Back to Main Menu")
 
         choice = input("Choose an option: ").strip()
 
@@ -57,10 +62,13 @@ def manage_users():
         elif choice == "4":
             find_user_by_attribute()
         elif choice == "5":
+            account_summary()
+        elif choice == "6":
             break
         else:
             click.echo("Invalid option. Please choose again.")
 
+@profiled
 def add_user():
     """Prompt the user to add a new user."""
     name = input("Enter user name: ").strip()
@@ -69,6 +77,7 @@ def add_user():
     result = user_service.add_user(name, email)
     click.echo(result)
 
+@profiled
 def delete_user():
     """Prompt the user to delete a user by ID."""
     user_id = input("Enter user ID to delete: ").strip()
@@ -76,6 +85,7 @@ def delete_user():
     result = user_service.delete_user(int(user_id))
     click.echo(result)
 
+@profiled
 def list_users():
     """List all users."""
     users = user_service.list_users()
@@ -86,6 +96,7 @@ def list_users():
     else:
         click.echo(users)
 
+@profiled
 def find_user_by_attribute():
     """Find a user by attribute."""
     click.echo("\nFind User By:")
@@ -109,6 +120,24 @@ def find_user_by_attribute():
     else:
         click.echo(f"No users found with that attribute.")
 
+@profiled
+def account_summary():
+    """Show a user's rental totals, penalties and recent rentals."""
+    user_id = input("Enter user ID: ").strip()
+
+    summary = user_service.account_summary(int(user_id))
+    if isinstance(summary, str):
+        click.echo(summary)
+        return
+    click.echo(f"\n{summary['name']} ({summary['email']})")
+    click.echo(f"Rentals: {summary['total_rentals']} total, {summary['active_rentals']} active, "
+               f"{summary['overdue_rentals']} overdue")
+    click.echo(f"Penalties: {summary['penalties']} KSh charged (lifetime), "
+               f"{summary['accruing_penalties']} KSh accruing on overdue rentals")
+    for rental in summary["recent_rentals"]:
+        click.echo(f"Rental ID: {rental['id']}, Book: {rental['title']}, Rented: {rental['rent_date']}, "
+                   f"Returned: {rental['return_date'] or 'not yet'}")
+
 # ============= Book Management Menu =============
 
 def manage_books():
@@ -136,6 +165,7 @@ def manage_books():
         else:
             click.echo("Invalid option. Please choose again.")
 
+@profiled
 def add_book():
     """Prompt the user to add a new book."""
     title = input("Enter book title: ").strip()
@@ -146,6 +176,7 @@ def add_book():
     result = book_service.add_book(title, author, int(available), genres)
     click.echo(result)
 
+@profiled
 def delete_book():
     """Prompt the user to delete a book by ID."""
     book_id = input("Enter book ID to delete: ").strip()
@@ -153,6 +184,7 @@ def delete_book():
     result = book_service.delete_book(int(book_id))
     click.echo(result)
 
+@profiled
 def list_books():
     """List all available books."""
     books = book_service.list_books()
@@ -163,6 +195,7 @@ def list_books():
     else:
         click.echo(books)
 
+@profiled
 def search_books():
     """Search for books by title or author."""
     title = input("Enter book title to search (leave blank to skip): ").strip()
@@ -186,7 +219,10 @@ def manage_rentals():
         click.echo("2. Rent a book by name and title (for seed data or simulated overdue returns)")
         click.echo("3. Return a book")
         click.echo("4. List active rentals")
-        click.echo("5. Back to Main Menu")
+        click.echo("5. Reserve an unavailable book")
+        click.echo("6. Cancel a reservation")
+        click.echo("7. List reservations for a book")
+        click.echo("8. Back to Main Menu")
         
         choice = input("Choose an option: ").strip()
 
@@ -199,10 +235,17 @@ def manage_rentals():
         elif choice == "4":
             list_rentals()
         elif choice == "5":
+            reserve_book()
+        elif choice == "6":
+            cancel_reservation()
+        elif choice == "7":
+            list_reservations()
+        elif choice == "8":
             break
         else:
             click.echo("Invalid option. Please choose again.")
 
+@profiled
 def rent_book_by_id():
     """Prompt the user to rent a book by user ID and book ID."""
     user_id = input("Enter user ID: ").strip()
@@ -211,6 +254,7 @@ def rent_book_by_id():
     result = rental_service.rent_book(int(user_id), int(book_id))
     click.echo(result)
 
+@profiled
 def rent_book_by_name_and_title():
     """Rent a book using the user name and book title. Can simulate overdue returns."""
     user_name = input("Enter user name: ").strip()
@@ -221,6 +265,7 @@ def rent_book_by_name_and_title():
     result = rental_service.rent_book_by_name(user_name, book_title, int(days_rented_ago), int(due_days_ago))
     click.echo(result)
 
+@profiled
 def return_book():
     """Prompt the user to return a rented book."""
     rental_id = input("Enter rental ID to return: ").strip()
@@ -228,6 +273,7 @@ def return_book():
     result = rental_service.return_book(int(rental_id))
     click.echo(result)
 
+@profiled
 def list_rentals():
     """List all active rentals and returned rentals sorted by return date."""
     rentals = rental_service.list_rentals()
@@ -236,6 +282,34 @@ def list_rentals():
     else:
         click.echo(rentals)
 
+@profiled
+def reserve_book():
+    """Prompt the user to join the waitlist for an unavailable book."""
+    user_id = input("Enter user ID: ").strip()
+    book_id = input("Enter book ID: ").strip()
+
+    result = reservation_service.reserve_book(int(user_id), int(book_id))
+    click.echo(result)
+
+@profiled
+def cancel_reservation():
+    """Prompt the user to cancel a reservation."""
+    reservation_id = input("Enter reservation ID to cancel: ").strip()
+
+    result = reservation_service.cancel_reservation(int(reservation_id))
+    click.echo(result)
+
+@profiled
+def list_reservations():
+    """List the waitlist for a book in queue order."""
+    book_id = input("Enter book ID: ").strip()
+
+    reservations = reservation_service.list_reservations(int(book_id))
+    if isinstance(reservations, list):
+        click.echo("\n".join(reservations))
+    else:
+        click.echo(reservations)
+
 # ============= Main Execution =============
 
 if __name__ == '__main__':
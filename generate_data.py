@@ -0,0 +1,240 @@
+import random
+import time
+from datetime import datetime, timedelta, timezone
+from itertools import accumulate
+
+import click
+from sqlalchemy import bindparam, create_engine, delete, func, insert, select, update
+
+from lib.database import DATABASE_URL
+from lib.models import DAILY_PENALTY, LOAN_DAYS, Base, User, Book, Rental, UserBook
+
+FIRST_NAMES = ["John", "Jane", "Alice", "Kimu", "Bruce", "Clark", "Peter", "Tony", "Natasha", "Wanda",
+               "Amina", "Otieno", "Wanjiru", "Kamau", "Achieng", "Mwangi", "Njeri", "Baraka", "Zawadi", "Imani"]
+LAST_NAMES = ["Doe", "Smith", "Johnson", "Lami", "Wayne", "Kent", "Parker", "Stark", "Romanoff", "Maximoff",
+              "Odhiambo", "Mutua", "Kariuki", "Wekesa", "Chebet", "Kiprop", "Njoroge", "Atieno", "Mbugua", "Omondi"]
+GENRES = ["Dystopian", "Fiction", "Classics", "Non-Fictional", "African Fiction", "Fantasy",
+          "Adventure", "Historical Fiction", "Science Fiction", "Biography", "Poetry", "Mystery"]
+TITLE_WORDS = ["Silent", "River", "Crimson", "Garden", "Hidden", "Empire", "Broken", "Promise", "Golden",
+               "Shadow", "Last", "Journey", "Savannah", "Winter", "Storm", "Letters", "Ancient", "City",
+               "Forgotten", "Dream", "Iron", "Harvest", "Distant", "Shore"]
+
+
+def _relax_pragmas(connection):
+    """Trade durability for speed while the bulk load runs (SQLite only); return the settings to restore."""
+    saved = (connection.exec_driver_sql("PRAGMA journal_mode").scalar(),
+             connection.exec_driver_sql("PRAGMA synchronous").scalar())
+    connection.exec_driver_sql("PRAGMA journal_mode=MEMORY")
+    connection.exec_driver_sql("PRAGMA synchronous=OFF")
+    connection.exec_driver_sql("PRAGMA temp_store=MEMORY")
+    connection.exec_driver_sql("PRAGMA cache_size=-262144")  # 256 MiB
+    connection.commit()
+    return saved
+
+
+def _restore_pragmas(connection, saved):
+    """Put back the durability settings _relax_pragmas found, e.g. a WAL journal."""
+    journal_mode, synchronous = saved
+    connection.exec_driver_sql(f"PRAGMA synchronous={int(synchronous)}")
+    connection.exec_driver_sql(f"PRAGMA journal_mode={journal_mode}")
+    connection.commit()
+
+
+def _batched(rows, batch_size):
+    """Yield lists of at most batch_size rows from an iterator."""
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class DataGenerator:
+    """Deterministic bulk generator for users, books and rentals.
+
+    Book popularity follows a Zipf distribution (rank r is picked with weight
+    1 / r**zipf_s), so a few titles take most of the rentals like in a real
+    library. The same seed and volumes always produce the same rows.
+    """
+
+    def __init__(self, users=1000, books=1000, rentals=5000, seed=42, zipf_s=1.1, max_copies=5,
+                 active_share=0.15, overdue_share=0.08, history_days=365, batch_size=50000, now=None):
+        self.users = users
+        self.books = books
+        self.rentals = rentals
+        self.rng = random.Random(seed)
+        self.zipf_s = zipf_s
+        self.max_copies = max_copies
+        self.active_share = active_share
+        self.overdue_share = overdue_share
+        self.history_days = history_days
+        self.batch_size = batch_size
+        # Stored naive, the way SQLite hands DateTime values back
+        self.now = now or datetime.now(timezone.utc).replace(tzinfo=None)
+        self.copies = {}  # book_id -> copies still on the shelf
+
+    # ---------- row factories ----------
+
+    def user_rows(self, first_id):
+        rng = self.rng
+        for user_id in range(first_id, first_id + self.users):
+            name = f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}"
+            yield {"id": user_id, "name": name, "email": f"user{user_id}@example.com"}
+
+    def book_rows(self, first_id):
+        rng = self.rng
+        # Skewed towards single copies, like most of a real catalog
+        copy_weights = [1 / (n * n) for n in range(1, self.max_copies + 1)]
+        copy_choices = list(range(1, self.max_copies + 1))
+        for book_id in range(first_id, first_id + self.books):
+            title = f"{rng.choice(TITLE_WORDS)} {rng.choice(TITLE_WORDS)} {book_id}"
+            author = f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}"
+            copies = rng.choices(copy_choices, weights=copy_weights)[0]
+            self.copies[book_id] = copies
+            yield {"id": book_id, "title": title, "author": author,
+                   "available": copies, "genres": rng.choice(GENRES)}
+
+    def rental_rows(self, first_user_id, first_book_id):
+        """Yield (rental, user_book) row pairs.
+
+        Active rentals take a copy off the shelf; once a title runs out of
+        copies, further rentals of it are generated as already returned.
+        """
+        rng = self.rng
+        book_ids = list(range(first_book_id, first_book_id + self.books))
+        rng.shuffle(book_ids)  # Popularity rank is independent of id
+        cum_weights = list(accumulate(1 / (rank ** self.zipf_s) for rank in range(1, self.books + 1)))
+        active_pairs = set()
+        last_user_id = first_user_id + self.users - 1
+        history = max(self.history_days, LOAN_DAYS + 30)
+
+        remaining = self.rentals
+        while remaining > 0:
+            chunk = min(remaining, self.batch_size)
+            remaining -= chunk
+            for book_id in rng.choices(book_ids, cum_weights=cum_weights, k=chunk):
+                user_id = rng.randint(first_user_id, last_user_id)
+                overdue = rng.random() < self.overdue_share
+                active = (rng.random() < self.active_share
+                          and self.copies[book_id] > 0
+                          and (user_id, book_id) not in active_pairs)
+
+                if active:
+                    if overdue:
+                        rent_date = self.now - timedelta(days=rng.uniform(LOAN_DAYS + 1, LOAN_DAYS + 60))
+                    else:
+                        rent_date = self.now - timedelta(days=rng.uniform(0, LOAN_DAYS))
+                    return_date = None
+                    penalty = 0.0
+                    self.copies[book_id] -= 1
+                    active_pairs.add((user_id, book_id))
+                else:
+                    days_late = rng.randint(1, 30) if overdue else 0
+                    loan_length = LOAN_DAYS + days_late if overdue else rng.uniform(0, LOAN_DAYS)
+                    rent_date = self.now - timedelta(days=rng.uniform(loan_length, history))
+                    return_date = rent_date + timedelta(days=loan_length)
+                    penalty = float(days_late * DAILY_PENALTY)
+
+                yield (
+                    {"user_id": user_id, "book_id": book_id, "rent_date": rent_date,
+                     "return_date": return_date, "due_date": rent_date + timedelta(days=LOAN_DAYS),
+                     "penalty": penalty},
+                    {"user_id": user_id, "book_id": book_id},
+                )
+
+    # ---------- loading ----------
+
+    def _insert(self, connection, table, rows, label):
+        count = 0
+        for batch in _batched(rows, self.batch_size):
+            connection.execute(insert(table), batch)
+            count += len(batch)
+        click.echo(f"  {label}: {count} rows")
+        return count
+
+    def load(self, engine, clear=True):
+        """Bulk insert the configured volumes through a single connection."""
+        sqlite = engine.dialect.name == "sqlite"
+        Base.metadata.create_all(engine)
+
+        with engine.connect() as connection:
+            if sqlite:
+                saved = _relax_pragmas(connection)
+            try:
+                with connection.begin():
+                    if clear:
+                        # Children first so foreign keys never dangle
+                        for table in reversed(Base.metadata.sorted_tables):
+                            connection.execute(delete(table))
+                    first_user_id = (connection.scalar(select(func.max(User.id))) or 0) + 1
+                    first_book_id = (connection.scalar(select(func.max(Book.id))) or 0) + 1
+
+                    self._insert(connection, User.__table__, self.user_rows(first_user_id), "users")
+                    self._insert(connection, Book.__table__, self.book_rows(first_book_id), "books")
+
+                    user_book_rows = []
+                    rental_rows = []
+                    for rental, user_book in self.rental_rows(first_user_id, first_book_id):
+                        rental_rows.append(rental)
+                        user_book_rows.append(user_book)
+                        if len(rental_rows) >= self.batch_size:
+                            connection.execute(insert(Rental.__table__), rental_rows)
+                            connection.execute(insert(UserBook.__table__), user_book_rows)
+                            rental_rows, user_book_rows = [], []
+                    if rental_rows:
+                        connection.execute(insert(Rental.__table__), rental_rows)
+                        connection.execute(insert(UserBook.__table__), user_book_rows)
+                    click.echo(f"  rentals: {self.rentals} rows")
+
+                    # Copies still out are reflected in books.available
+                    shelf = [{"b_id": book_id, "b_available": copies} for book_id, copies in self.copies.items()]
+                    for batch in _batched(shelf, self.batch_size):
+                        connection.execute(
+                            update(Book.__table__)
+                            .where(Book.__table__.c.id == bindparam("b_id"))
+                            .values(available=bindparam("b_available")),
+                            batch,
+                        )
+                    if engine.dialect.name == "postgresql":
+                        # Ids were inserted explicitly, so move the serial sequences past them
+                        for table in ("users", "books"):
+                            connection.exec_driver_sql(
+                                f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+                                f"(SELECT COALESCE(MAX(id), 1) FROM {table}))"
+                            )
+            finally:
+                if sqlite:
+                    _restore_pragmas(connection, saved)
+
+
+@click.command()
+@click.option('--users', default=1000, show_default=True, help="Number of users to generate.")
+@click.option('--books', default=1000, show_default=True, help="Number of distinct titles to generate.")
+@click.option('--rentals', default=5000, show_default=True, help="Number of rentals to generate.")
+@click.option('--seed', default=42, show_default=True, help="Random seed; same seed, same data.")
+@click.option('--zipf-s', default=1.1, show_default=True, help="Zipf exponent for title popularity.")
+@click.option('--max-copies', default=5, show_default=True, help="Maximum copies per title.")
+@click.option('--active-share', default=0.15, show_default=True, help="Share of rentals still out.")
+@click.option('--overdue-share', default=0.08, show_default=True, help="Share of rentals that are or were late.")
+@click.option('--history-days', default=365, show_default=True, help="How far back rentals go.")
+@click.option('--batch-size', default=50000, show_default=True, help="Rows per executemany batch.")
+@click.option('--database-url', default=DATABASE_URL, show_default=True, help="Target database.")
+@click.option('--append', is_flag=True, help="Keep existing rows instead of clearing the database.")
+def generate(users, books, rentals, seed, zipf_s, max_copies, active_share, overdue_share,
+             history_days, batch_size, database_url, append):
+    """Generate a synthetic dataset for load testing."""
+    generator = DataGenerator(users=users, books=books, rentals=rentals, seed=seed, zipf_s=zipf_s,
+                              max_copies=max_copies, active_share=active_share, overdue_share=overdue_share,
+                              history_days=history_days, batch_size=batch_size)
+    engine = create_engine(database_url)
+    started = time.perf_counter()
+    click.echo(f"Generating data into {database_url} (seed={seed})")
+    generator.load(engine, clear=not append)
+    click.echo(f"Done in {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == "__main__":
+    generate()
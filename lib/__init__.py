@@ -0,0 +1,4 @@
+import time
+
+# Start of the process as far as profiling is concerned (see lib/profiling.py)
+IMPORTED_AT = time.perf_counter()
@@ -0,0 +1,102 @@
+import time
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import delete, insert, literal, select, union_all
+
+from lib.database import get_session
+from lib.models import ArchivedRental, Rental, RentalNotice
+
+ARCHIVE_AFTER_DAYS = 180  # Returned rentals older than this leave the hot table
+
+HISTORY_COLUMNS = ('id', 'user_id', 'book_id', 'rent_date', 'due_date', 'return_date', 'penalty', 'rate_plan_id')
+
+
+def _utcnow():
+    # Naive UTC, comparable with the DateTime values SQLite returns
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def rental_history(user_id=None, returned_only=False):
+    """Live and archived rentals as one subquery with the HISTORY_COLUMNS.
+
+    Filters are applied to each side of the UNION ALL so both tables can use
+    their (user_id, rent_date, ...) indexes.
+    """
+    parts = []
+    for model in (Rental, ArchivedRental):
+        query = select(*(getattr(model, name) for name in HISTORY_COLUMNS))
+        if user_id is not None:
+            query = query.where(model.user_id == user_id)
+        if returned_only and model is Rental:
+            query = query.where(Rental.return_date.is_not(None))
+        parts.append(query)
+    return union_all(*parts).subquery("rental_history")
+
+
+def move_to_archive(session, ids):
+    """Copy the (returned) rentals with these ids into rentals_archive and delete them, in the caller's transaction."""
+    columns = [getattr(Rental, name) for name in HISTORY_COLUMNS]
+    session.execute(
+        insert(ArchivedRental).from_select(
+            list(HISTORY_COLUMNS) + ['archived_at'],
+            select(*columns, literal(_utcnow())).where(Rental.id.in_(ids)),
+        )
+    )
+    # Notices only matter while a rental is open; drop them with it
+    session.execute(delete(RentalNotice).where(RentalNotice.rental_id.in_(ids)))
+    session.execute(delete(Rental).where(Rental.id.in_(ids)))
+
+
+class RentalArchiver:
+    """Moves returned rentals older than `age_days` into rentals_archive in batches.
+
+    Each batch is copied and deleted in one short transaction, so rentals and
+    returns are only ever blocked for a single batch.
+    """
+
+    def __init__(self, age_days=ARCHIVE_AFTER_DAYS, batch_size=2000, branch=None):
+        self.age_days = age_days
+        self.batch_size = batch_size
+        self.branch = branch
+
+    def archive_batch(self, cutoff, after_id=0):
+        """Archive the next batch with id > after_id; return (rows moved, last id scanned)."""
+        session = get_session(branch=self.branch)
+        try:
+            # Moving the newest rental out is safe: rentals is AUTOINCREMENT on SQLite
+            # and a sequence on PostgreSQL, so its id is never handed out again
+            ids = session.scalars(
+                select(Rental.id)
+                .where(Rental.id > after_id, Rental.return_date.is_not(None), Rental.return_date < cutoff)
+                .order_by(Rental.id)
+                .limit(self.batch_size)
+                .with_for_update(skip_locked=True)
+            ).all()
+            if not ids:
+                return 0, after_id
+
+            move_to_archive(session, ids)
+            session.commit()
+            return len(ids), ids[-1]
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def run(self, max_batches=None, echo=print):
+        """Archive everything past the cutoff (or up to max_batches) and report progress."""
+        started = time.monotonic()
+        cutoff = _utcnow() - timedelta(days=self.age_days)
+        moved, last_id, batches = 0, 0, 0
+        while max_batches is None or batches < max_batches:
+            count, last_id = self.archive_batch(cutoff, last_id)
+            if not count:
+                break
+            moved += count
+            batches += 1
+            echo(f"Archived {moved} rentals (up to rental ID {last_id})")
+        elapsed = time.monotonic() - started
+        echo(f"Moved {moved} rentals returned before {cutoff:%Y-%m-%d} to the archive "
+             f"in {elapsed:.1f}s ({moved / max(elapsed, 1e-9):.0f}/s)")
+        return moved
@@ -0,0 +1,320 @@
+"""Audit trail of changes to users and books, captured from session events.
+
+Enabled with AUDIT_LOG=table (rows in audit_log) or AUDIT_LOG=file:<path>
+(JSON lines). Flushing a session notes what it inserts, updates or
+deletes in `users` and `books`, old and new values included; ORM bulk and
+Core statements run through a session are noted as the statement and its
+parameters, with the row id when the WHERE clause names one. The notes
+are held on the session until it commits and dropped if it rolls back.
+
+A commit only appends its records to an in-memory buffer. A background
+thread writes the buffer out in batches every FLUSH_SECONDS, or sooner
+once BATCH_SIZE records are waiting, so the rental path never waits on
+an audit insert. The buffer holds at most CAPACITY records: a commit that
+finds it full writes the batch itself before going on. Records still
+buffered are written when the process exits, including on SIGTERM.
+A batch the sink rejects is appended to FALLBACK_PATH rather than lost.
+
+Statements run on a bare connection (engine.begin()) bypass the session
+and aren't captured.
+"""
+import atexit
+import getpass
+import json
+import os
+import signal
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+from sqlalchemy import event, insert, select
+from sqlalchemy.orm import attributes
+from sqlalchemy.sql.elements import BinaryExpression, BindParameter
+from sqlalchemy.sql.operators import eq
+
+from lib import database
+from lib.database import Session, get_session
+from lib.models import AuditEntry
+
+AUDIT_LOG = os.environ.get("AUDIT_LOG", "")
+FLUSH_SECONDS = float(os.environ.get("AUDIT_FLUSH_SECONDS", "1"))
+BATCH_SIZE = 500
+CAPACITY = 20000
+FALLBACK_PATH = os.environ.get("AUDIT_FALLBACK", "audit_fallback.jsonl")
+
+AUDITED_TABLES = frozenset(("users", "books"))
+
+# Who the changes are recorded against; a session's info["actor"] takes precedence
+actor = os.environ.get("AUDIT_ACTOR") or getpass.getuser()
+
+
+def set_actor(name):
+    global actor
+    actor = name
+
+
+def _utcnow():
+    # Naive UTC, comparable with the DateTime values SQLite returns
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+# ---------- sinks ----------
+
+def _row(record, encode=True):
+    at, who, branch, action, table, row_id, changes = record
+    if encode and changes is not None:
+        changes = json.dumps(changes, default=str)
+    return {"at": at, "actor": who, "branch": branch, "action": action, "table_name": table,
+            "row_id": row_id, "changes": changes}
+
+
+class TableSink:
+    """Inserts each batch into audit_log in the main database, one transaction per batch."""
+
+    def write(self, records):
+        with database.engine.begin() as connection:
+            connection.execute(insert(AuditEntry), [_row(record) for record in records])
+
+
+class FileSink:
+    """Appends each record as a JSON line."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, records):
+        with open(self.path, "a") as sink:
+            for record in records:
+                sink.write(json.dumps(_row(record, encode=False), default=str) + "\n")
+
+
+def sink_from_url(url):
+    """Build a sink from `table` or `file:<path>`."""
+    if url == "table":
+        return TableSink()
+    if url.startswith("file:"):
+        return FileSink(url[len("file:"):])
+    raise ValueError(f"Unknown audit log '{url}', expected table or file:<path>.")
+
+
+# ---------- buffer ----------
+
+class AuditLog:
+    """Bounded buffer of committed records, drained by a background thread."""
+
+    def __init__(self, sink, batch_size=BATCH_SIZE, capacity=CAPACITY, flush_seconds=FLUSH_SECONDS):
+        self.sink = sink
+        self.batch_size = batch_size
+        self.capacity = capacity
+        self.flush_seconds = flush_seconds
+        self.stats = {"captured": 0, "written": 0, "batches": 0, "inline_flushes": 0, "fallback": 0}
+        self._buffer = []
+        self._lock = threading.Condition()
+        self._write_lock = threading.Lock()  # Batches reach the sink one at a time, in commit order
+        self._thread = None
+        self._closed = False
+
+    def add(self, records):
+        with self._lock:
+            self._buffer.extend(records)
+            self.stats["captured"] += len(records)
+            # A full buffer means the flusher has fallen behind: this commit writes out the backlog
+            inline = self._closed or len(self._buffer) >= self.capacity
+            if not inline:
+                if len(self._buffer) >= self.batch_size:
+                    self._lock.notify()
+                if self._thread is None:
+                    self._start()
+        if inline:
+            self.stats["inline_flushes"] += 1
+            self.flush()
+
+    def flush(self):
+        """Write out everything buffered so far."""
+        with self._write_lock:
+            with self._lock:
+                batch, self._buffer = self._buffer, []
+            for start in range(0, len(batch), self.batch_size):
+                self._write(batch[start:start + self.batch_size])
+
+    def _write(self, batch):
+        try:
+            self.sink.write(batch)
+        except Exception as error:
+            print(f"Audit log write failed ({error}); appending {len(batch)} records to {FALLBACK_PATH}",
+                  file=sys.stderr)
+            FileSink(FALLBACK_PATH).write(batch)
+            self.stats["fallback"] += len(batch)
+        self.stats["written"] += len(batch)
+        self.stats["batches"] += 1
+
+    def _start(self):
+        self._thread = threading.Thread(target=self._run, name="audit-flush", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                deadline = time.monotonic() + self.flush_seconds
+                while not self._closed and len(self._buffer) < self.batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._lock.wait(remaining)
+                closed = self._closed
+            self.flush()
+            if closed:
+                return
+
+    def close(self):
+        """Stop the flusher and write out whatever is left."""
+        with self._lock:
+            self._closed = True
+            self._lock.notify()
+            thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        self.flush()
+
+
+_log = None
+
+
+def enable(url=None, **options):
+    """Start recording to `url` (default AUDIT_LOG); options go to AuditLog. Return the log."""
+    global _log
+    disable()
+    _log = AuditLog(sink_from_url(url or AUDIT_LOG), **options)
+    atexit.register(_log.close)
+    if threading.current_thread() is threading.main_thread() and signal.getsignal(signal.SIGTERM) == signal.SIG_DFL:
+        # Turn SIGTERM into a normal exit so the atexit flush runs
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+    return _log
+
+
+def disable():
+    """Stop recording, writing out what is buffered."""
+    global _log
+    log, _log = _log, None
+    if log is not None:
+        atexit.unregister(log.close)
+        log.close()
+
+
+# ---------- capture ----------
+
+def _note(session, action, table, row_id, changes):
+    session.info.setdefault("audit", []).append(
+        (_utcnow(), session.info.get("actor", actor), session.info.get("branch"), action, table, row_id, changes)
+    )
+
+
+def _columns(obj, only_changed):
+    """{column: value} for a new or deleted object, {column: [old, new]} for changes."""
+    changes = {}
+    for column in obj.__table__.columns:
+        history = attributes.get_history(obj, column.key)
+        if only_changed:
+            if history.has_changes():
+                changes[column.key] = [history.deleted[0] if history.deleted else None,
+                                       history.added[0] if history.added else None]
+        else:
+            values = history.added or history.unchanged or history.deleted
+            changes[column.key] = values[0] if values else None
+    return changes
+
+
+@event.listens_for(Session, "after_flush")
+def _flushed(session, flush_context):
+    if _log is None:
+        return
+    for action, objects in (("insert", session.new), ("update", session.dirty), ("delete", session.deleted)):
+        for obj in objects:
+            table = getattr(obj, "__tablename__", None)
+            if table not in AUDITED_TABLES:
+                continue
+            if action == "update":
+                changes = _columns(obj, only_changed=True)
+                if not changes:
+                    continue
+            else:
+                changes = _columns(obj, only_changed=False)
+            _note(session, action, table, obj.id, changes)
+
+
+def _where_id(statement, parameters):
+    """The row id when the statement's WHERE clause is `id = <value>`, else None."""
+    clause = statement.whereclause
+    if (isinstance(clause, BinaryExpression) and clause.operator is eq
+            and getattr(clause.left, "primary_key", False) and isinstance(clause.right, BindParameter)):
+        return parameters.get(clause.right.key, clause.right.value)
+    return None
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _executed(orm_execute_state):
+    if _log is None or not (orm_execute_state.is_insert or orm_execute_state.is_update
+                            or orm_execute_state.is_delete):
+        return
+    statement = orm_execute_state.statement
+    table = getattr(getattr(statement, "table", None), "name", None)
+    if table not in AUDITED_TABLES:
+        return
+    session = orm_execute_state.session
+    action = "insert" if orm_execute_state.is_insert else "update" if orm_execute_state.is_update else "delete"
+    compiled = statement.compile(dialect=session.get_bind().dialect)
+    parameter_sets = orm_execute_state.parameters
+    if not isinstance(parameter_sets, (list, tuple)):
+        parameter_sets = [parameter_sets or {}]
+    for parameters in parameter_sets:
+        values = {**compiled.params, **parameters}
+        row_id = _where_id(statement, values)
+        changes = {"statement": str(compiled), "parameters": values}
+        if action == "delete" and row_id is not None:
+            # Keep what the row held; on the caller's connection, so it sees the same snapshot
+            row = session.connection().execute(
+                select(statement.table).where(statement.table.c.id == row_id)
+            ).mappings().first()
+            changes["row"] = dict(row) if row is not None else None
+        _note(session, action, table, row_id, changes)
+
+
+@event.listens_for(Session, "after_commit")
+def _committed(session):
+    records = session.info.pop("audit", None)
+    if records and _log is not None:
+        _log.add(records)
+
+
+@event.listens_for(Session, "after_rollback")
+def _rolled_back(session):
+    session.info.pop("audit", None)
+
+
+if AUDIT_LOG:
+    enable()
+
+
+# ---------- reading ----------
+
+def history(table=None, row_id=None, limit=20):
+    """Recent audit_log entries, newest first, optionally for one table or row, as lines."""
+    query = select(AuditEntry).order_by(AuditEntry.at.desc(), AuditEntry.id.desc()).limit(limit)
+    if table:
+        query = query.where(AuditEntry.table_name == table)
+    if row_id is not None:
+        query = query.where(AuditEntry.row_id == row_id)
+    session = get_session(readonly=True)
+    try:
+        entries = session.scalars(query).all()
+    finally:
+        session.close()
+    if not entries:
+        return ["No audit entries found."]
+    return [
+        f"{entry.at:%Y-%m-%d %H:%M:%S} {entry.actor}{f'@{entry.branch}' if entry.branch else ''} "
+        f"{entry.action} {entry.table_name}"
+        f"{f' #{entry.row_id}' if entry.row_id is not None else ''}: {entry.changes}"
+        for entry in entries
+    ]
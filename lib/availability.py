@@ -0,0 +1,215 @@
+"""In-process map of copies on the shelf per book, for checks that skip the database.
+
+Enabled with AVAILABILITY_SNAPSHOT=1. The map is an array indexed by book
+id (-1 where there is no such book), loaded in one pass over `books`, with
+running totals so "how many titles are available" is a field read.
+
+It is kept current two ways. Write paths in this process report the
+value they committed (`note()`), so their changes show up at once. Any
+other change, from another process or a path that doesn't report, moves
+a change version the snapshot polls at most every POLL_SECONDS over a
+connection of its own: SQLite's `PRAGMA data_version`, or the books
+table's write counters on PostgreSQL. When it has moved, the map is
+reloaded, from the primary (never a replica, which may be behind the
+version it just read). `verify()` compares the map with `books.available`.
+
+Neither version says whose commits moved it, so this process's own
+writes are reloaded too. Each entry remembers when its value was read
+instead: a note carries the time its writer read the row (`stamp()`)
+and is dropped when the entry holds a value read later, by a reload or
+a later note. A note that loses to a reload needs nothing more: the
+reload either saw its commit or read the version before it, and then
+the next poll reloads again.
+"""
+import os
+import threading
+import time
+from array import array
+
+from sqlalchemy import select, text
+
+from lib import database
+from lib.database import STREAM_BATCH_SIZE, get_session
+from lib.models import Book
+
+ENABLED = os.environ.get("AVAILABILITY_SNAPSHOT", "0") == "1"
+POLL_SECONDS = float(os.environ.get("AVAILABILITY_POLL_SECONDS", "1"))
+
+MISSING = -1
+
+_PG_BOOKS_VERSION = text(
+    "SELECT n_tup_ins + n_tup_upd + n_tup_del FROM pg_stat_user_tables WHERE relname = 'books'"
+)
+
+
+class AvailabilitySnapshot:
+    """Copies on the shelf per book id for one database."""
+
+    def __init__(self, branch=None, poll_seconds=POLL_SECONDS):
+        self.branch = branch
+        self.poll_seconds = poll_seconds
+        self.reloads = 0
+        self._copies = array("l")
+        self._titles = 0        # Books with a copy on the shelf
+        self._shelved = 0       # Copies on the shelf, all books
+        self._version = None
+        self._polled = float("-inf")
+        self._loaded_at = float("-inf")  # When the running load began reading
+        self._noted_at = {}              # book id -> read time of a note since then
+        self._watch = None
+        self._lock = threading.Lock()
+        self.reload()
+
+    # ---------- reads ----------
+
+    def available(self, book_id):
+        """Copies of book_id on the shelf, or None if there is no such book."""
+        self._poll()
+        copies = self._copies[book_id] if 0 <= book_id < len(self._copies) else MISSING
+        return None if copies == MISSING else copies
+
+    def totals(self):
+        """(titles with a copy on the shelf, copies on the shelf)."""
+        self._poll()
+        return self._titles, self._shelved
+
+    def available_ids(self):
+        """Ids of books with a copy on the shelf, ascending."""
+        self._poll()
+        return [book_id for book_id, copies in enumerate(self._copies) if copies > 0]
+
+    # ---------- upkeep ----------
+
+    def _set(self, book_id, copies):
+        """Store one book's count, keeping the totals; callers hold the lock."""
+        if book_id >= len(self._copies):
+            self._copies.extend([MISSING] * (book_id + 1 - len(self._copies)))
+        old = self._copies[book_id]
+        if old > 0:
+            self._titles -= 1
+            self._shelved -= old
+        if copies > 0:
+            self._titles += 1
+            self._shelved += copies
+        self._copies[book_id] = copies
+
+    def note(self, book_id, copies, read_at=None):
+        """Record a committed availability read at `read_at` (see stamp()); None for a deleted book.
+
+        Returns whether it was applied, i.e. nothing fresher is known.
+        """
+        read_at = stamp() if read_at is None else read_at
+        with self._lock:
+            if read_at <= self._noted_at.get(book_id, self._loaded_at):
+                return False
+            self._noted_at[book_id] = read_at
+            self._set(book_id, MISSING if copies is None else max(copies, 0))
+            return True
+
+    def _change_version(self):
+        if self._watch is None:
+            engine = database.branch_engine(self.branch) if self.branch else database.engine
+            self._watch = engine.connect()
+        try:
+            if self._watch.dialect.name == "sqlite":
+                # Moves whenever another connection commits, in this process or any other
+                return self._watch.exec_driver_sql("PRAGMA data_version").scalar()
+            return self._watch.execute(_PG_BOOKS_VERSION).scalar()
+        finally:
+            self._watch.rollback()  # PostgreSQL caches statistics for the rest of a transaction
+
+    def reload(self):
+        """Rebuild the map from `books`."""
+        with self._lock:
+            # Read the version first: a change committed during the load moves it again
+            loaded_at = stamp()
+            version = self._change_version()
+            # From the primary, like the version: a replica may not have caught up to it yet
+            session = get_session(branch=self.branch)
+            try:
+                copies = array("l")
+                titles = shelved = 0
+                for book_id, available in session.execute(
+                    select(Book.id, Book.available).order_by(Book.id).execution_options(yield_per=STREAM_BATCH_SIZE)
+                ):
+                    available = max(available or 0, 0)
+                    if book_id >= len(copies):
+                        copies.extend([MISSING] * (book_id + 1 - len(copies)))
+                    copies[book_id] = available
+                    if available:
+                        titles += 1
+                        shelved += available
+            finally:
+                session.close()
+            self._copies, self._titles, self._shelved = copies, titles, shelved
+            self._loaded_at, self._noted_at = loaded_at, {}
+            self._version, self._polled = version, time.monotonic()
+            self.reloads += 1
+
+    def _poll(self):
+        if time.monotonic() - self._polled < self.poll_seconds:
+            return
+        with self._lock:
+            if time.monotonic() - self._polled < self.poll_seconds:
+                return
+            self._polled = time.monotonic()
+            changed = self._change_version() != self._version
+        if changed:
+            self.reload()
+
+    def verify(self):
+        """Books whose snapshot count differs from books.available, as (book_id, snapshot, database)."""
+        with self._lock:
+            copies = self._copies[:]
+        mismatches, seen = [], set()
+        session = get_session(branch=self.branch)  # A lagging replica would report false mismatches
+        try:
+            for book_id, available in session.execute(
+                select(Book.id, Book.available).execution_options(yield_per=STREAM_BATCH_SIZE)
+            ):
+                seen.add(book_id)
+                cached = copies[book_id] if book_id < len(copies) else MISSING
+                if cached != max(available or 0, 0):
+                    mismatches.append((book_id, None if cached == MISSING else cached, available))
+        finally:
+            session.close()
+        mismatches.extend((book_id, cached, None) for book_id, cached in enumerate(copies)
+                          if cached != MISSING and book_id not in seen)
+        return sorted(mismatches)
+
+    def close(self):
+        with self._lock:
+            if self._watch is not None:
+                self._watch.close()
+                self._watch = None
+
+
+_snapshots = {}
+_snapshots_lock = threading.Lock()
+
+
+def stamp():
+    """A read time for note(): take it after reading (and locking) the row, before committing."""
+    return time.monotonic()
+
+
+def snapshot(branch=None):
+    """The process-wide snapshot for a database, loaded on first use; None unless enabled."""
+    if not ENABLED:
+        return None
+    with _snapshots_lock:
+        if branch not in _snapshots:
+            _snapshots[branch] = AvailabilitySnapshot(branch)
+        return _snapshots[branch]
+
+
+def snapshot_loaded(branch=None):
+    """Whether write paths should report to a snapshot of this database."""
+    return branch in _snapshots
+
+
+def note(book_id, copies, branch=None, read_at=None):
+    """Pass a committed availability to the database's snapshot, if one is loaded."""
+    loaded = _snapshots.get(branch)
+    if loaded is not None:
+        loaded.note(book_id, copies, read_at)
@@ -0,0 +1,70 @@
+"""Batched removal of the rows that depend on a user or book before it is deleted.
+
+Every batch is one set-based statement over at most `batch_size` keys in
+its own short transaction, so deleting a user with years of history never
+loads the rows into memory and never holds locks for long. Returned
+rentals aren't deleted but moved to rentals_archive, which has no foreign
+keys, so penalty history outlives the user or book it belongs to.
+"""
+from sqlalchemy import delete, func, select, tuple_
+
+from lib.archive import move_to_archive
+from lib.database import get_session
+from lib.models import Rental
+
+CLEANUP_BATCH_SIZE = 2000
+
+
+def open_rentals(session, condition):
+    """How many unreturned rentals match condition."""
+    return session.scalar(select(func.count()).select_from(Rental).where(condition, Rental.return_date.is_(None)))
+
+
+def referencing_rentals(session, condition):
+    """How many rentals, returned or not, still match condition."""
+    return session.scalar(select(func.count()).select_from(Rental).where(condition))
+
+
+def delete_batches(model, condition, branch=None, batch_size=CLEANUP_BATCH_SIZE):
+    """Delete rows of model matching condition, batch_size primary keys per transaction; return how many."""
+    key = list(model.__table__.primary_key.columns)
+    deleted = 0
+    while True:
+        session = get_session(branch=branch)
+        try:
+            rows = session.execute(select(*key).where(condition).limit(batch_size)).all()
+            if not rows:
+                return deleted
+            if len(key) == 1:
+                session.execute(delete(model.__table__).where(key[0].in_([row[0] for row in rows])))
+            else:
+                session.execute(delete(model.__table__).where(tuple_(*key).in_([tuple(row) for row in rows])))
+            session.commit()
+            deleted += len(rows)
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+
+def archive_returned(condition, branch=None, batch_size=CLEANUP_BATCH_SIZE):
+    """Move returned rentals matching condition into the archive in batches; return how many moved."""
+    moved = 0
+    while True:
+        session = get_session(branch=branch)
+        try:
+            ids = session.scalars(
+                select(Rental.id).where(condition, Rental.return_date.is_not(None))
+                .order_by(Rental.id).limit(batch_size)
+            ).all()
+            if not ids:
+                return moved
+            move_to_archive(session, ids)
+            session.commit()
+            moved += len(ids)
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
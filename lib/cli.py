@@ -1,17 +1,57 @@
+import os
+import time
 import click
+from lib.database import engine_stats
 from lib.services.user_service import UserService
 from lib.services.book_service import BookService
 from lib.services.rental_service import RentalService
-
-user_service = UserService()
-book_service = BookService()
-rental_service = RentalService()
+from lib.services.reservation_service import ReservationService
+from lib.scheduler import OverdueScheduler
+from lib.notifications import NotificationWorker, transport_from_url
+from lib.archive import ARCHIVE_AFTER_DAYS, RentalArchiver
+from lib import profiling
+from lib import pricing
+from lib import reports
+from lib import availability
+from lib import audit
+from lib.recommendations import RECOMMEND_LIMIT, Recommender
+
+# Branch database to work in (see BRANCH_DATABASES); None means the main database
+branch = os.environ.get("LIBRARY_BRANCH")
+
+user_service = UserService(branch)
+book_service = BookService(branch)
+rental_service = RentalService(branch)
+reservation_service = ReservationService(branch)
+
+def use_branch(name):
+    """Point every service used by the commands and menu at a branch."""
+    global branch, user_service, book_service, rental_service, reservation_service
+    branch = name
+    user_service = UserService(name)
+    book_service = BookService(name)
+    rental_service = RentalService(name)
+    reservation_service = ReservationService(name)
 
 
 @click.group()
-def cli():
+@click.option('--branch', 'branch_name', envvar='LIBRARY_BRANCH', default=None,
+              help="Branch to work in (see BRANCH_DATABASES).")
+@click.option('--profile', 'profile_dir', envvar='LIBRARY_PROFILE', default=None, type=click.Path(file_okay=False),
+              help="Profile the command into this directory (see lib/profiling.py).")
+@click.option('--profiler', envvar='LIBRARY_PROFILER', default='sample', show_default=True,
+              type=click.Choice(['sample', 'cprofile']), help="Stack sampling or cProfile.")
+@click.option('--actor', envvar='AUDIT_ACTOR', default=None,
+              help="Name recorded in the audit log for changes (default: the login name).")
+@click.pass_context
+def cli(ctx, branch_name, profile_dir, profiler, actor):
     """Main entry point for the CLI."""
-    pass
+    use_branch(branch_name)
+    if actor:
+        audit.set_actor(actor)
+    if profile_dir and ctx.invoked_subcommand != 'profile-compare':
+        profiling.enable(profile_dir, profiler)
+        ctx.with_resource(profiling.action(ctx.invoked_subcommand))
 
 # User management
 @click.command()
@@ -33,6 +73,48 @@ def list_users():
     for user in users:
         click.echo(user)
 
+@click.command()
+@click.argument('user_id', type=int)
+@click.option('--limit', default=10, show_default=True, help="Recent rentals to show.")
+@click.option('--offset', default=0, show_default=True, help="Skip this many recent rentals.")
+def account(user_id, limit, offset):
+    """Show a user's rental totals, penalties and recent rentals."""
+    summary = user_service.account_summary(user_id, limit, offset)
+    for line in format_account_summary(summary):
+        click.echo(line)
+
+def format_account_summary(summary):
+    """Render an account summary (or an error string) as display lines."""
+    if isinstance(summary, str):
+        return [summary]
+    lines = [
+        f"User ID: {summary['id']}, Name: {summary['name']}, Email: {summary['email']}",
+        f"Rentals: {summary['total_rentals']} total, {summary['active_rentals']} active, "
+        f"{summary['overdue_rentals']} overdue",
+        f"Penalties: {summary['penalties']} KSh charged (lifetime), "
+        f"{summary['accruing_penalties']} KSh accruing on overdue rentals",
+        "Recent Rentals:",
+    ]
+    for rental in summary["recent_rentals"]:
+        status = f"Returned on: {rental['return_date']}" if rental["return_date"] else f"Due: {rental['due_date']}"
+        lines.append(f"Rental ID: {rental['id']}, Book: {rental['title']}, Rented: {rental['rent_date']}, {status}")
+    return lines
+
+@click.command()
+@click.argument('branch_name')
+def sync_users(branch_name):
+    """Copy all users into a branch database, e.g. after adding the branch."""
+    result = user_service.sync_users(branch_name)
+    click.echo(result)
+
+@click.command()
+@click.argument('user_id', type=int)
+@click.argument('tier')
+def set_tier(user_id, tier):
+    """Set a user's membership tier (used to pick rate plans)."""
+    result = user_service.set_tier(user_id, tier)
+    click.echo(result)
+
 # Book management
 @click.command()
 @click.argument('title')
@@ -43,6 +125,16 @@ def add_book(title, author, available, genres):
     result = book_service.add_book(title, author, available, genres)
     click.echo(result)
 
+@click.command('availability')
+@click.argument('book_ids', type=int, nargs=-1)
+def check_availability(book_ids):
+    """Copies on the shelf for the given books, or totals for the whole catalog."""
+    if not book_ids:
+        click.echo(book_service.availability_summary())
+        return
+    for line in book_service.check_availability(list(book_ids)):
+        click.echo(line)
+
 @click.command()
 @click.argument('book_id', type=int)
 def delete_book(book_id):
@@ -61,11 +153,22 @@ def list_books(sort_by):
 @click.command()
 @click.option('--title', default=None, help="Filter books by title.")
 @click.option('--author', default=None, help="Filter books by author.")
-def search_books(title, author):
+@click.option('--all-branches', is_flag=True, help="Search every branch in parallel.")
+def search_books(title, author, all_branches):
     """Search for books by title and/or author."""
     
     # Instantiate BookService inside the function
-    book_service = BookService()
+    book_service = BookService(branch)
+
+    if all_branches:
+        matches, errors = book_service.search_all_branches(title, author)
+        for book_branch, book in matches:
+            click.echo(f"Branch: {book_branch or 'main'}, Book ID: {book.id}, Title: {book.title}, Author: {book.author}")
+        if not matches:
+            click.echo("No matching books found.")
+        for book_branch, error in errors:
+            click.echo(f"Error: Branch '{book_branch or 'main'}' could not be searched: {error.splitlines()[0]}")
+        return
     
     # Use the service to search books
     books = book_service.search_books(title, author)
@@ -77,13 +180,19 @@ def search_books(title, author):
             click.echo(f"Book ID: {book.id}, Title: {book.title}, Author: {book.author}")
     else:
         click.echo("No matching books found.")
+        suggestions = book_service.suggest_books(title, author)
+        if suggestions:
+            click.echo("Did you mean:")
+            for score, book_id, book_title, book_author in suggestions:
+                click.echo(f"Book ID: {book_id}, Title: {book_title}, Author: {book_author} ({score:.0%} similar)")
 
 # Rental management
 @click.command()
 @click.argument('user_id', type=int)
 @click.argument('book_id', type=int)
-def rent_book(user_id, book_id):
-    result = rental_service.rent_book(user_id, book_id)
+@click.option('--loan-days', default=None, type=int, help="Loan length; must be offered by a matching rate plan.")
+def rent_book(user_id, book_id, loan_days):
+    result = rental_service.rent_book(user_id, book_id, loan_days=loan_days)
     click.echo(result)
 
 @click.command()
@@ -93,26 +202,222 @@ def return_book(rental_id):
     click.echo(result)
 
 @click.command()
-def list_rentals():
+@click.argument('file', type=click.File('r'))
+@click.option('--chunk-size', default=500, show_default=True, help="Returns committed per transaction.")
+def return_batch(file, chunk_size):
+    """Return every rental listed in FILE (one rental ID or R-barcode per line, '-' for stdin)."""
+    codes = [line for line in file if line.strip() and not line.lstrip().startswith('#')]
+    outcomes = rental_service.return_batch(codes, chunk_size=chunk_size)
+    for outcome in outcomes:
+        click.echo(outcome)
+    failed = sum(1 for outcome in outcomes if ": Error:" in outcome)
+    click.echo(f"Processed {len(outcomes)} lines: {len(outcomes) - failed} returned, {failed} failed.")
+
+@click.command()
+@click.option('--archived', default=0, show_default=True, help="Also show this many of the latest archived rentals.")
+def list_rentals(archived):
     """List all rentals, with returned ones sorted by return date"""
-    rentals = rental_service.list_rentals()
+    rentals = rental_service.list_rentals(archived)
     for rental in rentals:
         click.echo(rental)
 
+# Reservation management
+@click.command()
+@click.argument('user_id', type=int)
+@click.argument('book_id', type=int)
+def reserve_book(user_id, book_id):
+    """Join the waitlist for an unavailable book."""
+    result = reservation_service.reserve_book(user_id, book_id)
+    click.echo(result)
+
+@click.command()
+@click.argument('reservation_id', type=int)
+def cancel_reservation(reservation_id):
+    result = reservation_service.cancel_reservation(reservation_id)
+    click.echo(result)
+
+@click.command()
+@click.argument('book_id', type=int)
+def list_reservations(book_id):
+    """List the waitlist for a book in queue order."""
+    reservations = reservation_service.list_reservations(book_id)
+    if isinstance(reservations, str):
+        click.echo(reservations)
+    else:
+        for reservation in reservations:
+            click.echo(reservation)
+
+@click.command()
+def expire_reservations():
+    """Expire lapsed waitlist places and release uncollected holds."""
+    result = reservation_service.expire_reservations()
+    click.echo(result)
+
+# Pricing
+@click.command()
+@click.argument('name')
+@click.option('--genre', default=None, help="Genre the plan applies to (default: any).")
+@click.option('--tier', default=None, help="Membership tier the plan applies to (default: any).")
+@click.option('--loan-days', default=14, show_default=True, help="Loan length in days.")
+@click.option('--daily-penalty', default=50.0, show_default=True, help="KSh per day late.")
+@click.option('--cap', default=None, type=float, help="Maximum penalty per rental in KSh.")
+@click.option('--grace-days', default=0, show_default=True, help="Days late before penalties start.")
+def add_rate_plan(name, genre, tier, loan_days, daily_penalty, cap, grace_days):
+    """Add a rate plan for a genre and/or membership tier."""
+    result = pricing.add_rate_plan(name, genre, tier, loan_days, daily_penalty, cap, grace_days, branch=branch)
+    click.echo(result)
+
+@click.command()
+def list_rate_plans():
+    """List rate plans."""
+    plans = pricing.list_rate_plans(branch)
+    if isinstance(plans, str):
+        click.echo(plans)
+    else:
+        for plan in plans:
+            click.echo(plan)
+
+@click.command()
+@click.option('--reassign', is_flag=True, help="Pick each rental's plan again from current genres and tiers.")
+@click.option('--batch-size', default=5000, show_default=True, help="Rentals per transaction.")
+@click.option('--dry-run', is_flag=True, help="Report the changes without writing them.")
+def reprice_rentals(reassign, batch_size, dry_run):
+    """Recompute penalties of returned (and archived) rentals under the current rate plans."""
+    pricing.reprice(branch, reassign=reassign, batch_size=batch_size, dry_run=dry_run, echo=click.echo)
+
+# Recommendations
+@click.command()
+@click.argument('target_id', type=int)
+@click.option('--user', 'for_user', is_flag=True, help="TARGET_ID is a user; recommend from their rental history.")
+@click.option('--limit', default=RECOMMEND_LIMIT, show_default=True, help="Books to suggest.")
+def recommend(target_id, for_user, limit):
+    """Suggest books co-rented with a book (or with a user's books)."""
+    recommender = Recommender(branch=branch)
+    if for_user:
+        result = recommender.for_user(target_id, limit)
+    else:
+        result = recommender.for_book(target_id, limit)
+    if isinstance(result, str):
+        click.echo(result)
+    else:
+        for line in result:
+            click.echo(line)
+
+@click.command()
+@click.option('--rebuild', is_flag=True, help="Recount every pair from the full rental history.")
+@click.option('--batch-size', default=2000, show_default=True, help="Rentals folded in per transaction.")
+def update_recommendations(rebuild, batch_size):
+    """Fold new rentals into the co-rental counts and neighbor lists."""
+    recommender = Recommender(batch_size=batch_size, branch=branch)
+    if rebuild:
+        recommender.rebuild(echo=click.echo)
+    else:
+        click.echo(f"Folded {recommender.update()} new rentals into the recommendations.")
+
+# Reports
+@click.command()
+@click.argument('kind', type=click.Choice(['penalties', 'users']))
+@click.option('--year', default=None, type=int, help="Penalties: break this year down by month.")
+@click.option('--output', default='user_rentals.csv', show_default=True, type=click.Path(dir_okay=False),
+              help="Users: CSV file to write.")
+@click.option('--workers', default=None, type=int, help="Processes scanning id ranges (default: one per core).")
+def report(kind, year, output, workers):
+    """Penalty revenue per year, or per-user rental totals as CSV, over the whole rental history."""
+    started = time.monotonic()
+    chosen = reports.PenaltyRevenue(year) if kind == 'penalties' else reports.UserSummary(output)
+    for line in chosen.lines(reports.run(chosen, workers=workers, branch=branch)):
+        click.echo(line)
+    click.echo(f"Done in {time.monotonic() - started:.1f}s")
+
+# Background jobs
+@click.command()
+@click.option('--interval', default=60, show_default=True, help="Seconds between ticks.")
+@click.option('--batch-size', default=1000, show_default=True, help="Rentals handled per transaction.")
+@click.option('--once', is_flag=True, help="Run a single tick and exit.")
+def scheduler(interval, batch_size, once):
+    """Record due-date reminders and overdue notices as rentals cross their due date."""
+    OverdueScheduler(batch_size=batch_size, branch=branch).run(interval=interval, ticks=1 if once else None, echo=click.echo)
+
+@click.command()
+@click.option('--transport', default='file:notifications.jsonl', show_default=True,
+              help="Where to deliver: file:<path> or smtp://host:port.")
+@click.option('--batch-size', default=100, show_default=True, help="Notifications claimed per batch.")
+@click.option('--concurrency', default=4, show_default=True, help="Sends in flight at once.")
+@click.option('--rate', default=None, type=float, help="Maximum sends per second.")
+@click.option('--interval', default=5, show_default=True, help="Seconds to wait when the outbox is empty.")
+@click.option('--once', is_flag=True, help="Stop once the outbox is drained.")
+def notify_worker(transport, batch_size, concurrency, rate, interval, once):
+    """Deliver queued notifications from the outbox."""
+    worker = NotificationWorker(transport_from_url(transport), batch_size=batch_size,
+                                concurrency=concurrency, rate=rate, branch=branch)
+    worker.run(interval=interval, once=once, echo=click.echo)
+
+@click.command()
+@click.option('--older-than', default=ARCHIVE_AFTER_DAYS, show_default=True,
+              help="Archive rentals returned more than this many days ago.")
+@click.option('--batch-size', default=2000, show_default=True, help="Rentals moved per transaction.")
+@click.option('--max-batches', default=None, type=int, help="Stop after this many batches.")
+def archive_rentals(older_than, batch_size, max_batches):
+    """Move old returned rentals out of the hot rentals table into the archive."""
+    RentalArchiver(age_days=older_than, batch_size=batch_size, branch=branch).run(max_batches=max_batches, echo=click.echo)
+
+@click.command('audit-log')
+@click.argument('table', required=False, type=click.Choice(sorted(audit.AUDITED_TABLES)))
+@click.argument('row_id', required=False, type=int)
+@click.option('--limit', default=20, show_default=True, help="Entries to show.")
+def audit_log(table, row_id, limit):
+    """Show recent audited changes, optionally to one table or row (see AUDIT_LOG)."""
+    for line in audit.history(table, row_id, limit):
+        click.echo(line)
+
+@click.command()
+@click.argument('baseline', type=click.Path(exists=True))
+@click.argument('current', type=click.Path(exists=True))
+@click.option('--top', default=10, show_default=True, help="Functions with the largest shifts to show.")
+def profile_compare(baseline, current, top):
+    """Compare saved profiles (a .json file or a --profile directory each)."""
+    for line in profiling.compare(baseline, current, top=top):
+        click.echo(line)
+
 # ============ Add commands to CLI group ============
 
 cli.add_command(add_user)
 cli.add_command(delete_user)
 cli.add_command(list_users)
+cli.add_command(account)
+cli.add_command(sync_users)
+cli.add_command(set_tier)
 
 cli.add_command(add_book)
 cli.add_command(delete_book)
 cli.add_command(list_books)
 cli.add_command(search_books)
+cli.add_command(check_availability)
 
 cli.add_command(rent_book)
 cli.add_command(return_book)
+cli.add_command(return_batch)
 cli.add_command(list_rentals)
+cli.add_command(archive_rentals)
+
+cli.add_command(reserve_book)
+cli.add_command(cancel_reservation)
+cli.add_command(list_reservations)
+cli.add_command(expire_reservations)
+
+cli.add_command(add_rate_plan)
+cli.add_command(list_rate_plans)
+cli.add_command(reprice_rentals)
+
+cli.add_command(recommend)
+cli.add_command(update_recommendations)
+
+cli.add_command(report)
+
+cli.add_command(scheduler)
+cli.add_command(notify_worker)
+cli.add_command(audit_log)
+cli.add_command(profile_compare)
 
 # ============ Menu Interaction System ============
 
@@ -131,9 +436,18 @@ def display_menu():
     print("8. Rent a book")
     print("9. Return a rented book")
     print("10. List all rentals")
+    print("11. Reserve an unavailable book")
+    print("12. Cancel a reservation")
+    print("13. List reservations for a book")
+    print("14. Show a user's account summary")
+    print("15. Show database engine statistics")
+    print("16. Recommend books for a book or user")
+    print("17. Check book availability")
 
 def run_menu():
     """Run the interactive menu."""
+    profiling.enable_from_env()
+    availability.snapshot(branch)  # Loaded up front when AVAILABILITY_SNAPSHOT=1
     while True:
         display_menu()
         choice = input("Enter your choice: ")
@@ -150,62 +464,118 @@ def run_menu():
             print("Exiting the program.")
             break
 
-        # Call respective commands
-        elif choice == 1:
-            users = user_service.list_users()
-            for user in users:
-                print(user)
-
-        elif choice == 2:
-            name = input("Enter user name: ")
-            email = input("Enter user email: ")
-            result = user_service.add_user(name, email)
-            print(result)
-
-        elif choice == 3:
-            user_id = input("Enter user ID to delete: ")
-            result = user_service.delete_user(user_id)
-            print(result)
-
-        elif choice == 4:
-            books = book_service.list_books(None)
-            for book in books:
-                print(book)
-
-        elif choice == 5:
-            title = input("Enter book title: ")
-            author = input("Enter book author: ")
-            available = input("Enter available copies (default 1): ")
-            genres = input("Enter genres: ")
-            result = book_service.add_book(title, author, available, genres)
-            print(result)
-
-        elif choice == 6:
-            book_id = input("Enter book ID to delete: ")
-            result = book_service.delete_book(book_id)
-            print(result)
-
-        elif choice == 7:
-            title = input("Enter book title to search: ")
-            author = input("Enter book author to search: ")
-            result = book_service.search_books(title, author)
-            print(result)
-
-        elif choice == 8:
-            user_id = input("Enter user ID: ")
-            book_id = input("Enter book ID: ")
-            result = rental_service.rent_book(user_id, book_id)
-            print(result)
-
-        elif choice == 9:
-            rental_id = input("Enter rental ID to return: ")
-            result = rental_service.return_book(rental_id)
-            print(result)
-
-        elif choice == 10:
-            rentals = rental_service.list_rentals()
-            for rental in rentals:
-                print(rental)
+        with profiling.action(f"menu-{choice}"):
+            # Call respective commands
+            if choice == 1:
+                users = user_service.list_users()
+                for user in users:
+                    print(user)
+
+            elif choice == 2:
+                name = input("Enter user name: ")
+                email = input("Enter user email: ")
+                result = user_service.add_user(name, email)
+                print(result)
+
+            elif choice == 3:
+                user_id = input("Enter user ID to delete: ")
+                result = user_service.delete_user(user_id)
+                print(result)
+
+            elif choice == 4:
+                books = book_service.list_books(None)
+                for book in books:
+                    print(book)
+
+            elif choice == 5:
+                title = input("Enter book title: ")
+                author = input("Enter book author: ")
+                available = input("Enter available copies (default 1): ")
+                genres = input("Enter genres: ")
+                result = book_service.add_book(title, author, available, genres)
+                print(result)
+
+            elif choice == 6:
+                book_id = input("Enter book ID to delete: ")
+                result = book_service.delete_book(book_id)
+                print(result)
+
+            elif choice == 7:
+                title = input("Enter book title to search: ")
+                author = input("Enter book author to search: ")
+                result = book_service.search_books(title, author)
+                print(result)
+
+            elif choice == 8:
+                user_id = input("Enter user ID: ")
+                book_id = input("Enter book ID: ")
+                result = rental_service.rent_book(user_id, book_id)
+                print(result)
+
+            elif choice == 9:
+                rental_id = input("Enter rental ID to return: ")
+                result = rental_service.return_book(rental_id)
+                print(result)
+
+            elif choice == 10:
+                rentals = rental_service.list_rentals()
+                for rental in rentals:
+                    print(rental)
+
+            elif choice == 11:
+                user_id = input("Enter user ID: ")
+                book_id = input("Enter book ID: ")
+                result = reservation_service.reserve_book(user_id, book_id)
+                print(result)
+
+            elif choice == 12:
+                reservation_id = input("Enter reservation ID to cancel: ")
+                result = reservation_service.cancel_reservation(reservation_id)
+                print(result)
+
+            elif choice == 13:
+                book_id = input("Enter book ID: ")
+                reservations = reservation_service.list_reservations(book_id)
+                if isinstance(reservations, str):
+                    print(reservations)
+                else:
+                    for reservation in reservations:
+                        print(reservation)
+
+            elif choice == 14:
+                user_id = input("Enter user ID: ")
+                summary = user_service.account_summary(user_id)
+                for line in format_account_summary(summary):
+                    print(line)
+
+            elif choice == 15:
+                for name, stats in engine_stats().items():
+                    print(f"{name}: {stats['statements']} statements, avg {stats['avg_seconds'] * 1000:.2f} ms, "
+                          f"max {stats['max_seconds'] * 1000:.2f} ms, "
+                          f"compiled cache {stats['cache_hit_ratio']:.0%} hits ({stats['cache_misses']} misses)")
+
+            elif choice == 16:
+                book_id = input("Enter book ID (blank to recommend for a user): ")
+                if book_id:
+                    result = Recommender(branch=branch).for_book(book_id)
+                else:
+                    result = Recommender(branch=branch).for_user(input("Enter user ID: "))
+                if isinstance(result, str):
+                    print(result)
+                else:
+                    for line in result:
+                        print(line)
+
+            elif choice == 17:
+                book_ids = input("Enter book IDs separated by spaces (blank for totals): ").split()
+                if not book_ids:
+                    print(book_service.availability_summary())
+                else:
+                    try:
+                        for line in book_service.check_availability([int(book_id) for book_id in book_ids]):
+                            print(line)
+                    except ValueError:
+                        print("Invalid input. Book IDs must be numbers.")
 
 if __name__ == '__main__':
     # cli()
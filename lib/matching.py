@@ -0,0 +1,306 @@
+"""Typo-tolerant lookup of book titles, authors and user names.
+
+Names are normalized (accents, case and punctuation dropped) and split into
+trigrams the way PostgreSQL's pg_trgm does: each word is padded with two
+spaces in front and one behind, so "Dune" gives "  d", " du", "dun", "une"
+and "ne ". Similarity is the Jaccard index of two trigram sets.
+
+A NameIndex maps every word to the ids whose text contains it. A search
+first finds the indexed spellings of each query word: the word itself,
+words one typo away (looked up through their one-letter-deleted variants,
+so no distance is computed), or for worse typos the few words with the
+most similar trigrams. It counts the ids under those spellings, rarest
+words first and within a fixed budget so "the" and "of" cost nothing, then
+scores the best-counted candidates exactly. A search therefore costs about
+the same for a thousand names or a million.
+"""
+import heapq
+import threading
+import time
+import unicodedata
+from array import array
+from collections import Counter, defaultdict, deque
+
+from sqlalchemy import select
+
+from lib.database import COMMIT_LAG_SECONDS, get_session
+from lib.models import Book, User
+
+MIN_SCORE = 0.3         # Candidates less similar than this aren't suggested
+ACCEPT_SCORE = 0.5      # A fuzzy match is used without asking only above this...
+ACCEPT_MARGIN = 0.15    # ...and this far ahead of the runner-up
+POSTINGS_BUDGET = 20000  # Ids counted per search; words past it are too common to help
+MIN_FUZZY_LENGTH = 3    # Shorter words only match exactly
+VERIFY = 200            # Candidates scored exactly per search
+SPELLINGS = 3           # Similar words tried for a word more than one edit from any indexed word
+LOAD_BATCH_SIZE = 10000
+RECHECK_CHUNK = 500     # Ids per IN (...) list when re-reading rows a late commit held back
+
+
+def normalize(text):
+    """Lowercase ASCII words: 'Chinua Achébé, Jr.' -> 'chinua achebe jr'."""
+    decomposed = unicodedata.normalize("NFKD", text or "")
+    folded = "".join(char for char in decomposed if not unicodedata.combining(char)).lower()
+    return " ".join("".join(char if char.isalnum() else " " for char in folded).split())
+
+
+def trigrams(key):
+    """pg_trgm-style trigrams of a normalized string."""
+    grams = set()
+    for word in key.split():
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+def similarity(grams_a, grams_b):
+    if not grams_a or not grams_b:
+        return 0.0
+    common = len(grams_a & grams_b)
+    return common / (len(grams_a) + len(grams_b) - common)
+
+
+def _deletes(word):
+    """The word with each one of its letters dropped."""
+    return {word[:i] + word[i + 1:] for i in range(len(word))}
+
+
+class NameIndex:
+    """In-memory index from item ids to their text, searchable despite typos."""
+
+    def __init__(self):
+        self._texts = {}                        # id -> (text, normalized key)
+        self._exact = defaultdict(list)         # normalized key -> ids
+        self._postings = defaultdict(lambda: array("l"))    # word -> ids of texts containing it
+        self._variants = defaultdict(list)      # word minus one letter -> words
+        self._word_grams = defaultdict(list)    # trigram -> words containing it
+
+    def __len__(self):
+        return len(self._texts)
+
+    def add(self, item_id, text):
+        self.discard(item_id)
+        key = normalize(text)
+        self._texts[item_id] = (text, key)
+        self._exact[key].append(item_id)
+        for word in set(key.split()):
+            if word not in self._postings and len(word) >= MIN_FUZZY_LENGTH:
+                for variant in _deletes(word):
+                    self._variants[variant].append(word)
+                for gram in trigrams(word):
+                    self._word_grams[gram].append(word)
+            self._postings[word].append(item_id)
+
+    def discard(self, item_id):
+        """Forget an item. Its postings stay behind and are skipped by search()."""
+        entry = self._texts.pop(item_id, None)
+        if entry is not None:
+            ids = self._exact[entry[1]]
+            ids.remove(item_id)
+            if not ids:
+                del self._exact[entry[1]]
+
+    def text(self, item_id):
+        return self._texts[item_id][0]
+
+    def __contains__(self, item_id):
+        return item_id in self._texts
+
+    def _spellings(self, word):
+        """Indexed words within one edit (drop, add, change or swap a letter) of word,
+        or failing that the few most trigram-similar ones."""
+        spellings = {word} if word in self._postings else set()
+        if len(word) < MIN_FUZZY_LENGTH:
+            return spellings
+        for variant in _deletes(word) | {word}:
+            spellings.update(self._variants.get(variant, ()))
+            if variant in self._postings:
+                spellings.add(variant)
+        if not spellings:
+            grams = trigrams(word)
+            shared = Counter()
+            for gram in grams:
+                shared.update(self._word_grams.get(gram, ()))
+            similar = ((count / (len(grams) + len(trigrams(other)) - count), other)
+                       for other, count in shared.items() if count > 1)
+            spellings.update(other for score, other in heapq.nlargest(SPELLINGS, similar) if score >= MIN_SCORE)
+        return spellings
+
+    def search(self, query, limit=5, min_score=MIN_SCORE):
+        """Best matches as (score, id, text), best first; exact matches score 1.0."""
+        key = normalize(query)
+        exact = self._exact.get(key, [])
+        if len(exact) >= limit:
+            return [(1.0, item_id, self._texts[item_id][0]) for item_id in exact[:limit]]
+
+        # Texts sharing the most (possibly misspelled) words, rarest words first
+        words = []
+        for word in set(key.split()):
+            postings = [self._postings[spelling] for spelling in self._spellings(word)]
+            if postings:
+                words.append((sum(map(len, postings)), postings))
+        hits, counted = Counter(), 0
+        for size, postings in sorted(words, key=lambda word: word[0]):
+            if counted + size > POSTINGS_BUDGET:
+                break
+            matched = set()
+            for posting in postings:
+                matched.update(posting)
+            hits.update(matched)
+            counted += size
+
+        grams = trigrams(key)
+        scored = []
+        for item_id, _ in hits.most_common(VERIFY):
+            entry = self._texts.get(item_id)
+            if entry is None:
+                continue  # Discarded
+            score = similarity(grams, trigrams(entry[1]))
+            if score >= min_score:
+                scored.append((score, -item_id, entry[0]))
+        return [(score, -negated, text) for score, negated, text in heapq.nlargest(limit, scored)]
+
+
+def pick(query, candidates):
+    """The candidate to use without asking: an exact match, or a clear best fuzzy match.
+
+    A fuzzy match must also have as many words as the query: "Letters" is a
+    vague search, not a typo for "Harvest Letters".
+    """
+    if not candidates:
+        return None
+    best = candidates[0]
+    if best[0] == 1.0:
+        return best
+    # Same-named rows (two users called 'Jane Doe') are one match, like an exact lookup
+    runner_up = next((candidate[0] for candidate in candidates[1:] if candidate[2] != best[2]), 0.0)
+    if (best[0] >= ACCEPT_SCORE and best[0] - runner_up >= ACCEPT_MARGIN
+            and len(normalize(query).split()) == len(normalize(best[2]).split())):
+        return best
+    return None
+
+
+class Matcher:
+    """Title, author and user-name indexes for one database.
+
+    Built on first use, then topped up with rows added since (by id) before
+    every search, so new books and users are matchable straight away.
+    On PostgreSQL a row can commit after one with a higher id, so each read
+    that skipped ids is read again once COMMIT_LAG_SECONDS have passed.
+    Deletes made by this process drop out through forget_book/forget_user;
+    callers load suggested ids and so skip rows deleted elsewhere.
+    """
+
+    def __init__(self, branch=None):
+        self.branch = branch
+        self.titles = NameIndex()
+        self.authors = NameIndex()
+        self.users = NameIndex()
+        self._last_book_id = 0
+        self._last_user_id = 0
+        self._unsettled = defaultdict(deque)  # Table -> (read at, after id, up to id) with ids missing
+        self._lock = threading.Lock()
+
+    def _add_book(self, book_id, title, author):
+        self.titles.add(book_id, title)
+        self.authors.add(book_id, author)
+
+    def _add_user(self, user_id, name):
+        self.users.add(user_id, name)
+
+    def _load(self, session, columns, index, add, last, lag):
+        """Index rows past id `last`, and rows earlier reads missed; return the new last id."""
+        id_column = columns[0]
+        now = time.monotonic()
+        unsettled = self._unsettled[id_column.table.name]
+        while unsettled and now - unsettled[0][0] >= lag:
+            _, after, upto = unsettled.popleft()
+            # Committed since by transactions that took their ids before the read
+            missing = [item_id for item_id in session.scalars(
+                select(id_column).where(id_column > after, id_column <= upto)
+            ) if item_id not in index]
+            for start in range(0, len(missing), RECHECK_CHUNK):
+                for row in session.execute(select(*columns).where(id_column.in_(missing[start:start + RECHECK_CHUNK]))):
+                    add(*row)
+        newest, count = last, 0
+        for batch in session.execute(
+            select(*columns).where(id_column > last)
+            .order_by(id_column).execution_options(yield_per=LOAD_BATCH_SIZE)
+        ).partitions():
+            for row in batch:
+                add(*row)
+            newest, count = batch[-1][0], count + len(batch)
+        if lag and newest - last > count:
+            unsettled.append((now, last, newest))
+        return newest
+
+    def refresh(self):
+        """Index books and users added since the last refresh."""
+        with self._lock:
+            session = get_session(readonly=True, branch=self.branch)
+            try:
+                lag = 0 if session.get_bind().dialect.name == 'sqlite' else COMMIT_LAG_SECONDS
+                self._last_book_id = self._load(session, (Book.id, Book.title, Book.author), self.titles,
+                                                self._add_book, self._last_book_id, lag)
+                self._last_user_id = self._load(session, (User.id, User.name), self.users,
+                                                self._add_user, self._last_user_id, lag)
+            finally:
+                session.close()
+
+    def books(self, title=None, author=None, limit=5):
+        """Books matching a title and/or author as (score, book_id, title, author); both must match when given."""
+        self.refresh()
+        if title:
+            matches = self.titles.search(title, limit=VERIFY if author else limit)
+            if author:
+                wanted = trigrams(normalize(author))
+                matches = [
+                    ((score + similarity(wanted, trigrams(normalize(self.authors.text(book_id))))) / 2, book_id, text)
+                    for score, book_id, text in matches
+                ]
+                matches = sorted((match for match in matches if match[0] >= MIN_SCORE),
+                                 key=lambda match: (-match[0], match[1]))[:limit]
+        elif author:
+            matches = self.authors.search(author, limit=limit)
+        else:
+            return []
+        return [(score, book_id, self.titles.text(book_id), self.authors.text(book_id)) for score, book_id, _ in matches]
+
+    def user_names(self, name, limit=5):
+        """Users matching a name as (score, user_id, name)."""
+        self.refresh()
+        return self.users.search(name, limit=limit)
+
+    def discard_book(self, book_id):
+        with self._lock:
+            self.titles.discard(book_id)
+            self.authors.discard(book_id)
+
+    def discard_user(self, user_id):
+        with self._lock:
+            self.users.discard(user_id)
+
+
+_matchers = {}
+_matchers_lock = threading.Lock()
+
+
+def matcher(branch=None):
+    """The process-wide Matcher for a database, created on first use."""
+    with _matchers_lock:
+        if branch not in _matchers:
+            _matchers[branch] = Matcher(branch)
+        return _matchers[branch]
+
+
+def forget_book(book_id, branch=None):
+    """Drop a deleted book from the database's Matcher, if one is loaded."""
+    loaded = _matchers.get(branch)
+    if loaded is not None:
+        loaded.discard_book(book_id)
+
+
+def forget_user(user_id):
+    """Drop a deleted user from every loaded Matcher (users exist in every branch)."""
+    for loaded in list(_matchers.values()):
+        loaded.discard_user(user_id)
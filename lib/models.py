@@ -1,9 +1,22 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Table, Float
+from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Table, Float, Index, UniqueConstraint, text
 from sqlalchemy.orm import relationship, declarative_base
 from datetime import datetime, timedelta, timezone
 
 Base = declarative_base()
 
+LOAN_DAYS = 14      # Loan period when no rate plan applies
+DAILY_PENALTY = 50  # KSh per day late when no rate plan applies
+
+
+def late_penalty(due_date, return_date, daily_penalty=DAILY_PENALTY, grace_days=0, cap=None):
+    """Penalty for returning on return_date: full days late beyond the grace period, capped."""
+    # Dates read back from SQLite are naive UTC; compare them as such
+    days_late = (return_date.replace(tzinfo=None) - due_date.replace(tzinfo=None)).days - grace_days
+    if days_late <= 0:
+        return 0.0
+    penalty = float(days_late * daily_penalty)
+    return min(penalty, cap) if cap is not None else penalty
+
 # Association table with a unique 'id' column
 class UserBook(Base):
     __tablename__ = 'user_books'
@@ -16,12 +29,16 @@ class User(Base):
     id = Column(Integer, primary_key=True)
     name = Column(String, nullable=False)
     email = Column(String, unique=True, nullable=False)
+    tier = Column(String, nullable=False, default='standard', server_default='standard')  # Membership tier for pricing
+
+    __table_args__ = {'sqlite_autoincrement': True}  # Never reuse ids: the name indexes and archive rely on them
 
     # Many-to-many relationship through association table
-    books = relationship("Book", secondary="user_books", back_populates="users", cascade="all, delete")
+    books = relationship("Book", secondary="user_books", back_populates="users")
 
-    # Relationship to track rental records
-    rentals = relationship("Rental", back_populates="user", cascade="all, delete")
+    # Relationship to track rental records. UserService.delete_user clears these
+    # in batches, so the ORM never loads them to delete a user
+    rentals = relationship("Rental", back_populates="user", passive_deletes="all")
 
     def __repr__(self):
         return f"<User(name={self.name}, email={self.email})>"
@@ -34,11 +51,13 @@ class Book(Base):
     available = Column(Integer, default=1)
     genres = Column(String, nullable=True)
 
+    __table_args__ = {'sqlite_autoincrement': True}
+
     # Many-to-many relationship through association table
     users = relationship("User", secondary="user_books", back_populates="books")
 
-    # Relationship to track rental records
-    rentals = relationship("Rental", back_populates="book")
+    # Relationship to track rental records (cleared by BookService.delete_book)
+    rentals = relationship("Rental", back_populates="book", passive_deletes="all")
 
     def __repr__(self):
         return f"<Book(title={self.title}, author={self.author})>"
@@ -50,15 +69,188 @@ class Rental(Base):
     book_id = Column(Integer, ForeignKey('books.id'), nullable=False)
     rent_date = Column(DateTime, default=datetime.now(timezone.utc))
     return_date = Column(DateTime, nullable=True)
-    due_date = Column(DateTime, nullable=False, default=lambda: datetime.now(timezone.utc) + timedelta(days=14))
+    due_date = Column(DateTime, nullable=False, default=lambda: datetime.now(timezone.utc) + timedelta(days=LOAN_DAYS))
     penalty = Column(Float, default=0.0)
+    rate_plan_id = Column(Integer, ForeignKey('rate_plans.id'), nullable=True)  # None: LOAN_DAYS / DAILY_PENALTY
 
     user = relationship("User", back_populates="rentals")
     book = relationship("Book", back_populates="rentals")
 
-    def calculate_penalty(self):
-        if self.return_date and self.return_date > self.due_date:
-            days_late = (self.return_date - self.due_date).days
-            self.penalty = days_late * 50  # KSh 50 per day late
+    __table_args__ = (
+        # Partial index over open rentals only, in due order, for the overdue scheduler
+        Index('ix_rentals_open_due', 'due_date', 'id',
+              sqlite_where=text('return_date IS NULL'), postgresql_where=text('return_date IS NULL')),
+        # Serves per-user history pages in rent_date order, and covers the
+        # account summary aggregates so they never touch the table itself
+        Index('ix_rentals_user_history', 'user_id', 'rent_date', 'return_date', 'due_date', 'penalty'),
+        # Ids are never handed out twice, even after the newest rental moves to the
+        # archive, so notices, dedup keys and id watermarks can rely on them
+        {'sqlite_autoincrement': True},
+    )
+
+    def calculate_penalty(self, plan=None):
+        """Set the penalty from the rental's rate plan terms (see lib/pricing.py), or the defaults"""
+        if not self.return_date:
+            self.penalty = 0.0
+        elif plan is None:
+            self.penalty = late_penalty(self.due_date, self.return_date)
         else:
-            self.penalty = 0.0
\ No newline at end of file
+            self.penalty = late_penalty(self.due_date, self.return_date, plan.daily_penalty,
+                                        plan.grace_days, plan.penalty_cap)
+
+class RatePlan(Base):
+    """Loan length and penalty terms for rentals matching a genre and/or membership tier.
+
+    A NULL genre or tier matches any; lib/pricing.py picks the most specific plan.
+    """
+    __tablename__ = 'rate_plans'
+    id = Column(Integer, primary_key=True)
+    name = Column(String, nullable=False, unique=True)
+    genre = Column(String, nullable=True)
+    tier = Column(String, nullable=True)
+    loan_days = Column(Integer, nullable=False, default=LOAN_DAYS)
+    daily_penalty = Column(Float, nullable=False, default=DAILY_PENALTY)
+    penalty_cap = Column(Float, nullable=True)  # None: uncapped
+    grace_days = Column(Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"<RatePlan(name={self.name}, genre={self.genre}, tier={self.tier}, loan_days={self.loan_days})>"
+
+class ArchivedRental(Base):
+    """Returned rental moved out of `rentals` by lib/archive.py; same columns plus archived_at."""
+    __tablename__ = 'rentals_archive'
+    # Ids are kept from `rentals`; no foreign keys so history outlives deleted users and books
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    user_id = Column(Integer, nullable=False)
+    book_id = Column(Integer, nullable=False)
+    rent_date = Column(DateTime, nullable=True)
+    return_date = Column(DateTime, nullable=False)
+    due_date = Column(DateTime, nullable=False)
+    penalty = Column(Float, nullable=True)
+    rate_plan_id = Column(Integer, nullable=True)
+    archived_at = Column(DateTime, nullable=False)
+
+    __table_args__ = (
+        Index('ix_rentals_archive_user_history', 'user_id', 'rent_date', 'return_date', 'due_date', 'penalty'),
+        Index('ix_rentals_archive_returned', 'return_date'),
+    )
+
+    def __repr__(self):
+        return f"<ArchivedRental(user_id={self.user_id}, book_id={self.book_id}, return_date={self.return_date})>"
+
+class BookPair(Base):
+    """Users who rented both books, for book_a <= book_b; book_a == book_b counts a book's renters.
+
+    The sparse co-occurrence matrix behind book_neighbors, kept by lib/recommendations.py.
+    """
+    __tablename__ = 'book_pairs'
+    book_a = Column(Integer, primary_key=True)
+    book_b = Column(Integer, primary_key=True)
+    co_rentals = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (Index('ix_book_pairs_b', 'book_b', 'book_a'),)
+
+    def __repr__(self):
+        return f"<BookPair(book_a={self.book_a}, book_b={self.book_b}, co_rentals={self.co_rentals})>"
+
+class BookNeighbor(Base):
+    """One of a book's top-k most co-rented books, in rank order."""
+    __tablename__ = 'book_neighbors'
+    # No foreign keys, like rentals_archive; lookups join books and skip deleted ones
+    book_id = Column(Integer, primary_key=True)
+    rank = Column(Integer, primary_key=True)
+    neighbor_id = Column(Integer, nullable=False)
+    score = Column(Float, nullable=False)  # Cosine similarity of the two books' renters
+    co_rentals = Column(Integer, nullable=False)
+
+    # Finds the lists a book appears in when its renter count changes
+    __table_args__ = (Index('ix_book_neighbors_neighbor', 'neighbor_id'),)
+
+    def __repr__(self):
+        return f"<BookNeighbor(book_id={self.book_id}, rank={self.rank}, neighbor_id={self.neighbor_id})>"
+
+class Reservation(Base):
+    __tablename__ = 'reservations'
+    id = Column(Integer, primary_key=True)  # Increasing id doubles as the FIFO position
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    book_id = Column(Integer, ForeignKey('books.id'), nullable=False)
+    created_at = Column(DateTime, nullable=False, default=lambda: datetime.now(timezone.utc))
+    # While waiting: when the place in the queue lapses. Once ready: when the held copy is released.
+    expires_at = Column(DateTime, nullable=False)
+    status = Column(String, nullable=False, default='waiting')  # waiting, ready, fulfilled, expired, cancelled
+
+    user = relationship("User")
+    book = relationship("Book")
+
+    __table_args__ = (
+        # Next holder for a book is the first row of (book_id, 'waiting') in id order
+        Index('ix_reservations_queue', 'book_id', 'status', 'id'),
+        Index('ix_reservations_user', 'user_id', 'status'),
+    )
+
+    def __repr__(self):
+        return f"<Reservation(user_id={self.user_id}, book_id={self.book_id}, status={self.status})>"
+
+class RentalNotice(Base):
+    __tablename__ = 'rental_notices'
+    id = Column(Integer, primary_key=True)
+    rental_id = Column(Integer, ForeignKey('rentals.id'), nullable=False)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    kind = Column(String, nullable=False)  # reminder, overdue
+    due_date = Column(DateTime, nullable=False)
+    created_at = Column(DateTime, nullable=False, default=lambda: datetime.now(timezone.utc))
+
+    __table_args__ = (UniqueConstraint('rental_id', 'kind', name='uq_rental_notices_rental_kind'),)
+
+    def __repr__(self):
+        return f"<RentalNotice(rental_id={self.rental_id}, kind={self.kind})>"
+
+class Watermark(Base):
+    """How far a background job has scanned, as a (position, last_id) pair."""
+    __tablename__ = 'watermarks'
+    name = Column(String, primary_key=True)
+    position = Column(DateTime, nullable=True)
+    last_id = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, nullable=True)
+
+    def __repr__(self):
+        return f"<Watermark(name={self.name}, position={self.position}, last_id={self.last_id})>"
+
+class Notification(Base):
+    """Outbox row, written in the same transaction as the change it announces."""
+    __tablename__ = 'notifications'
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    email = Column(String, nullable=False)
+    kind = Column(String, nullable=False)  # reminder, overdue, reservation_ready
+    subject = Column(String, nullable=False)
+    body = Column(String, nullable=False)
+    dedup_key = Column(String, nullable=False, unique=True)
+    status = Column(String, nullable=False, default='pending')  # pending, sent, failed
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(DateTime, nullable=False)
+    created_at = Column(DateTime, nullable=False, default=lambda: datetime.now(timezone.utc))
+    sent_at = Column(DateTime, nullable=True)
+    last_error = Column(String, nullable=True)
+
+    __table_args__ = (Index('ix_notifications_due', 'status', 'next_attempt_at', 'id'),)
+
+    def __repr__(self):
+        return f"<Notification(kind={self.kind}, email={self.email}, status={self.status})>"
+
+class AuditEntry(Base):
+    """One change to a user or book, written in batches by lib/audit.py."""
+    __tablename__ = 'audit_log'
+    id = Column(Integer, primary_key=True)
+    at = Column(DateTime, nullable=False)
+    actor = Column(String, nullable=False)
+    branch = Column(String, nullable=True)  # None for the main database
+    action = Column(String, nullable=False)  # insert, update, delete
+    table_name = Column(String, nullable=False)
+    row_id = Column(Integer, nullable=True)  # None for statements not aimed at one row
+    changes = Column(String, nullable=True)  # JSON
+
+    __table_args__ = (Index('ix_audit_log_row', 'table_name', 'row_id', 'at'), Index('ix_audit_log_at', 'at'))
+
+    def __repr__(self):
+        return f"<AuditEntry(action={self.action}, table_name={self.table_name}, row_id={self.row_id})>"
@@ -0,0 +1,226 @@
+import json
+import random
+import smtplib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from email.message import EmailMessage
+
+from sqlalchemy import bindparam, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+
+from lib.database import get_session
+from lib.models import Notification
+
+SENDER = "library@example.com"
+
+
+def _utcnow():
+    # Naive UTC, comparable with the DateTime values SQLite returns
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def enqueue(session, notices):
+    """Add notification dicts to the outbox inside the caller's transaction.
+
+    Each dict needs user_id, email, kind, subject, body and dedup_key. Rows
+    whose dedup_key is already in the outbox are skipped, so re-running a
+    producer never sends the same notice twice.
+    """
+    if not notices:
+        return
+    now = _utcnow()
+    rows = [dict(notice, status='pending', attempts=0, next_attempt_at=now, created_at=now) for notice in notices]
+    dialect = session.get_bind().dialect.name
+    insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+    session.execute(insert(Notification).on_conflict_do_nothing(index_elements=['dedup_key']), rows)
+
+
+# ---------- transports ----------
+
+class FileTransport:
+    """Appends each message as a JSON line; a stand-in for a mail server when testing."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def send(self, notification):
+        line = json.dumps({"to": notification["email"], "subject": notification["subject"],
+                           "body": notification["body"], "dedup_key": notification["dedup_key"]})
+        with self._lock, open(self.path, "a") as sink:
+            sink.write(line + "\n")
+
+
+class SMTPTransport:
+    """Delivers through an SMTP server, e.g. a local `python -m aiosmtpd -n` debugging server."""
+
+    def __init__(self, host="localhost", port=1025, timeout=10):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+
+    def send(self, notification):
+        message = EmailMessage()
+        message["From"] = SENDER
+        message["To"] = notification["email"]
+        message["Subject"] = notification["subject"]
+        message.set_content(notification["body"])
+        with smtplib.SMTP(self.host, self.port, timeout=self.timeout) as smtp:
+            smtp.send_message(message)
+
+
+def transport_from_url(url):
+    """Build a transport from `file:<path>` or `smtp://host:port`."""
+    if url.startswith("file:"):
+        return FileTransport(url[len("file:"):])
+    if url.startswith("smtp://"):
+        host, _, port = url[len("smtp://"):].partition(":")
+        return SMTPTransport(host or "localhost", int(port or 25))
+    raise ValueError(f"Unknown transport '{url}', expected file:<path> or smtp://host:port.")
+
+
+# ---------- worker ----------
+
+class NotificationWorker:
+    """Drains the outbox in batches with bounded concurrency.
+
+    Claiming a batch pushes its next_attempt_at forward by `lease` seconds,
+    so rows held by a worker that dies become eligible again on their own.
+    Failed sends are retried with exponential backoff until max_attempts.
+    """
+
+    def __init__(self, transport, batch_size=100, concurrency=4, rate=None,
+                 max_attempts=5, backoff=30, lease=300, branch=None):
+        self.transport = transport
+        self.branch = branch
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.rate = rate  # Maximum sends per second, or None for no limit
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.lease = lease
+        self.stats = {"sent": 0, "retried": 0, "failed": 0}
+        self._next_send = time.monotonic()
+        self._pace_lock = threading.Lock()
+
+    def claim(self):
+        """Lease the next batch of due rows and return them as dicts."""
+        session = get_session(branch=self.branch)
+        try:
+            now = _utcnow()
+            query = (
+                select(Notification.id, Notification.email, Notification.subject, Notification.body,
+                       Notification.dedup_key, Notification.attempts)
+                .where(Notification.status == 'pending', Notification.next_attempt_at <= now)
+                .order_by(Notification.next_attempt_at, Notification.id)
+                .limit(self.batch_size)
+                .with_for_update(skip_locked=True)  # Parallel workers claim disjoint batches on PostgreSQL
+            )
+            batch = [row._asdict() for row in session.execute(query)]
+            if batch:
+                # SQLite ignores FOR UPDATE, so two workers can select the same rows. Only
+                # rows still due when this UPDATE runs are leased, and only those are sent
+                leased = set(session.scalars(
+                    update(Notification)
+                    .where(Notification.id.in_([row["id"] for row in batch]),
+                           Notification.status == 'pending', Notification.next_attempt_at <= now)
+                    .values(next_attempt_at=now + timedelta(seconds=self.lease))
+                    .returning(Notification.id)
+                    .execution_options(synchronize_session=False)
+                ))
+                batch = [row for row in batch if row["id"] in leased]
+            session.commit()
+            return batch
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def _pace(self):
+        """Block until the rate limit allows another send."""
+        if not self.rate:
+            return
+        with self._pace_lock:
+            now = time.monotonic()
+            wait = self._next_send - now
+            self._next_send = max(now, self._next_send) + 1 / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+    def _deliver(self, notification):
+        self._pace()
+        try:
+            self.transport.send(notification)
+            return None
+        except Exception as e:
+            return f"{type(e).__name__}: {e}"
+
+    def _record(self, batch, errors):
+        """Write all outcomes of a batch back in one transaction."""
+        now = _utcnow()
+        sent, retry, failed = [], [], []
+        for notification, error in zip(batch, errors):
+            attempts = notification["attempts"] + 1
+            if error is None:
+                sent.append({"n_id": notification["id"], "n_attempts": attempts})
+            elif attempts >= self.max_attempts:
+                failed.append({"n_id": notification["id"], "n_attempts": attempts, "n_error": error})
+            else:
+                delay = self.backoff * 2 ** (attempts - 1) * random.uniform(0.8, 1.2)
+                retry.append({"n_id": notification["id"], "n_attempts": attempts, "n_error": error,
+                              "n_next": now + timedelta(seconds=delay)})
+
+        # Core table statements, so each list runs as a single executemany
+        outbox = Notification.__table__
+        by_id = outbox.c.id == bindparam("n_id")
+        session = get_session(branch=self.branch)
+        try:
+            if sent:
+                session.execute(update(outbox).where(by_id).values(
+                    status='sent', attempts=bindparam("n_attempts"), sent_at=now, last_error=None), sent)
+            if retry:
+                session.execute(update(outbox).where(by_id).values(
+                    attempts=bindparam("n_attempts"), last_error=bindparam("n_error"),
+                    next_attempt_at=bindparam("n_next")), retry)
+            if failed:
+                session.execute(update(outbox).where(by_id).values(
+                    status='failed', attempts=bindparam("n_attempts"), last_error=bindparam("n_error")), failed)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+        self.stats["sent"] += len(sent)
+        self.stats["retried"] += len(retry)
+        self.stats["failed"] += len(failed)
+
+    def drain_once(self, pool):
+        """Claim, send and record one batch; return its size."""
+        batch = self.claim()
+        if batch:
+            errors = list(pool.map(self._deliver, batch))
+            self._record(batch, errors)
+        return len(batch)
+
+    def run(self, interval=5, once=False, echo=print):
+        """Drain the outbox, then poll every `interval` seconds (or stop when empty if once)."""
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            try:
+                while True:
+                    if self.drain_once(pool):
+                        continue
+                    if once:
+                        break
+                    time.sleep(interval)
+            except KeyboardInterrupt:
+                echo("Notification worker stopped.")
+        elapsed = time.monotonic() - started
+        echo(f"Sent {self.stats['sent']}, retrying {self.stats['retried']}, failed {self.stats['failed']} "
+             f"in {elapsed:.1f}s ({self.stats['sent'] / max(elapsed, 1e-9):.0f}/s)")
+        return self.stats
@@ -0,0 +1,277 @@
+"""Rebuild a large table without locking it for the whole copy.
+
+A plain rebuild (create new table, INSERT ... SELECT everything, drop, rename)
+blocks writers for as long as the copy takes. rebuild_table instead:
+
+1. creates the new table and a change log, with triggers on the old table
+   that record the id of every row inserted, updated or deleted;
+2. copies rows in id-range chunks, each in its own short transaction;
+3. replays the change log to catch up with writes made during the copy;
+4. takes the write lock only for the final replay and the table swap.
+
+On PostgreSQL, foreign keys in other tables that reference the rebuilt
+table are dropped and re-added NOT VALID inside the swap, then validated
+after it commits, which doesn't block writers. The referencing tables are
+locked for the swap as well, under a short lock_timeout; when the locks
+aren't granted in time the swap is rolled back and retried. SQLite
+doesn't tie foreign keys to the table object, so references resolve to
+the new table by name.
+
+Use it from an Alembic migration inside an autocommit block:
+
+    with op.get_context().autocommit_block():
+        rebuild_table(op.get_bind(), 'books', [sa.Column(...), ...])
+"""
+import time
+
+import sqlalchemy as sa
+
+SWAP_LOCK_TIMEOUT_MS = 500  # Below PostgreSQL's default 1 s deadlock_timeout
+SWAP_ATTEMPTS = 20
+
+def _log_name(table):
+    return f"_online_log_{table}"
+
+
+def _new_name(table):
+    return f"_online_new_{table}"
+
+
+class _Rebuild:
+    def __init__(self, connection, table, columns, indexes, chunk_size, catchup_threshold, progress, table_kwargs):
+        self.connection = connection
+        self.dialect = connection.dialect.name
+        self.table = table
+        self.new = _new_name(table)
+        self.log = _log_name(table)
+        self.indexes = indexes or []
+        self.chunk_size = chunk_size
+        self.catchup_threshold = catchup_threshold
+        self.progress = progress
+        self.metadata = sa.MetaData()
+        # Foreign keys in `columns` resolve against this metadata, so load the tables they point at
+        referenced = {fk.target_fullname.split(".")[0] for column in columns for fk in column.foreign_keys}
+        if referenced - {table}:
+            self.metadata.reflect(connection, only=sorted(referenced - {table}))
+        self.new_table = sa.Table(self.new, self.metadata, *columns, **(table_kwargs or {}))
+        self.log_table = sa.Table(
+            self.log, self.metadata,
+            sa.Column('seq', sa.Integer, primary_key=True),
+            sa.Column('row_id', sa.Integer, nullable=False),
+        )
+        old_columns = {column['name'] for column in sa.inspect(connection).get_columns(table)}
+        self.copy_columns = ", ".join(c.name for c in self.new_table.columns if c.name in old_columns)
+        self.last_seq = 0
+        self.references = []  # (table, constraint, definition) of foreign keys pointing at the table
+        self.stats = {"copied": 0, "replayed": 0, "swap_seconds": 0.0, "swap_attempts": 0, "total_seconds": 0.0}
+
+    def execute(self, sql, **params):
+        return self.connection.execute(sa.text(sql), params)
+
+    # ---------- capture ----------
+
+    def install_capture(self):
+        self.metadata.create_all(self.connection, tables=[self.new_table, self.log_table])
+        if self.dialect == 'postgresql':
+            self.execute(f"""
+                CREATE FUNCTION {self.log}_fn() RETURNS trigger AS $$
+                BEGIN
+                    IF TG_OP <> 'INSERT' THEN INSERT INTO {self.log} (row_id) VALUES (OLD.id); END IF;
+                    IF TG_OP <> 'DELETE' THEN INSERT INTO {self.log} (row_id) VALUES (NEW.id); END IF;
+                    RETURN NULL;
+                END $$ LANGUAGE plpgsql""")
+            self.execute(f"""
+                CREATE TRIGGER {self.log}_trg AFTER INSERT OR UPDATE OR DELETE ON {self.table}
+                FOR EACH ROW EXECUTE FUNCTION {self.log}_fn()""")
+        else:
+            self.execute(f"""
+                CREATE TRIGGER {self.log}_ins AFTER INSERT ON {self.table}
+                BEGIN INSERT INTO {self.log} (row_id) VALUES (NEW.id); END""")
+            self.execute(f"""
+                CREATE TRIGGER {self.log}_upd AFTER UPDATE ON {self.table}
+                BEGIN
+                    INSERT INTO {self.log} (row_id) VALUES (OLD.id);
+                    INSERT INTO {self.log} (row_id) VALUES (NEW.id);
+                END""")
+            self.execute(f"""
+                CREATE TRIGGER {self.log}_del AFTER DELETE ON {self.table}
+                BEGIN INSERT INTO {self.log} (row_id) VALUES (OLD.id); END""")
+
+    def remove_capture(self):
+        if self.dialect == 'postgresql':
+            self.execute(f"DROP TRIGGER IF EXISTS {self.log}_trg ON {self.table}")
+            self.execute(f"DROP FUNCTION IF EXISTS {self.log}_fn()")
+        else:
+            for suffix in ('ins', 'upd', 'del'):
+                self.execute(f"DROP TRIGGER IF EXISTS {self.log}_{suffix}")
+
+    # ---------- copy and catch-up ----------
+
+    def copy(self):
+        bounds = self.execute(f"SELECT MIN(id), MAX(id), COUNT(*) FROM {self.table}").first()
+        low, high, total = bounds
+        if low is None:
+            return
+        start = low - 1
+        while start < high:
+            end = start + self.chunk_size
+            result = self.execute(
+                f"INSERT INTO {self.new} ({self.copy_columns}) "
+                f"SELECT {self.copy_columns} FROM {self.table} WHERE id > :start AND id <= :end",
+                start=start, end=end,
+            )
+            self.stats["copied"] += max(result.rowcount, 0)
+            start = end
+            self.progress(f"{self.table}: copied {self.stats['copied']}/{total} rows "
+                          f"({min(100, self.stats['copied'] * 100 // max(total, 1))}%)")
+
+    def replay(self, limit=None):
+        """Re-copy rows whose ids were logged since the last replay; return how many log entries were applied."""
+        query = f"SELECT seq, row_id FROM {self.log} WHERE seq > :last ORDER BY seq"
+        if limit:
+            query += f" LIMIT {int(limit)}"
+        entries = self.execute(query, last=self.last_seq).all()
+        if not entries:
+            return 0
+        ids = sorted({row_id for _, row_id in entries})
+        for offset in range(0, len(ids), 500):
+            chunk = ids[offset:offset + 500]
+            params = {f"id{i}": row_id for i, row_id in enumerate(chunk)}
+            placeholders = ", ".join(f":id{i}" for i in range(len(chunk)))
+            self.execute(f"DELETE FROM {self.new} WHERE id IN ({placeholders})", **params)
+            self.execute(
+                f"INSERT INTO {self.new} ({self.copy_columns}) "
+                f"SELECT {self.copy_columns} FROM {self.table} WHERE id IN ({placeholders})",
+                **params,
+            )
+        self.last_seq = entries[-1][0]
+        self.stats["replayed"] += len(ids)
+        return len(entries)
+
+    def catch_up(self):
+        """Replay in batches until the backlog is small enough to finish under the lock."""
+        while True:
+            pending = self.execute(f"SELECT COUNT(*) FROM {self.log} WHERE seq > :last", last=self.last_seq).scalar()
+            if pending <= self.catchup_threshold:
+                return
+            self.progress(f"{self.table}: catching up on {pending} changed rows")
+            self.replay(limit=self.chunk_size)
+
+    # ---------- swap ----------
+
+    def build_indexes(self, temporary):
+        for name, columns, *where in self.indexes:
+            index_name = f"{name}_online" if temporary else name
+            table = self.new if temporary else self.table
+            predicate = f" WHERE {where[0]}" if where else ""
+            self.execute(f"CREATE INDEX {index_name} ON {table} ({', '.join(columns)}){predicate}")
+
+    def _lock(self):
+        """Take the swap's locks: SQLite's write lock, or on PostgreSQL the table and its referencing tables."""
+        if self.dialect != 'postgresql':
+            self.execute("BEGIN IMMEDIATE")
+            return
+        self.execute("BEGIN")
+        # Writers lock books and rentals in either order, so waiting on them could
+        # deadlock; give up well before the deadlock detector picks a victim
+        self.execute(f"SET LOCAL lock_timeout = '{SWAP_LOCK_TIMEOUT_MS}ms'")
+        self.execute(f"LOCK TABLE {self.table} IN EXCLUSIVE MODE")  # Blocks writers, not readers
+        # DROP TABLE refuses while other tables reference it; read under the lock so the set is final
+        self.references = self.execute("""
+            SELECT conrelid::regclass::text, conname, pg_get_constraintdef(oid) FROM pg_constraint
+            WHERE contype = 'f' AND confrelid = CAST(:table AS regclass) AND conrelid <> confrelid
+        """, table=self.table).all()
+        for table in sorted({table for table, _, _ in self.references}):
+            self.execute(f"LOCK TABLE {table} IN ACCESS EXCLUSIVE MODE")
+
+    def swap(self):
+        for attempt in range(1, SWAP_ATTEMPTS + 1):
+            self.stats["swap_attempts"] = attempt
+            last_seq, replayed = self.last_seq, self.stats["replayed"]
+            started = time.perf_counter()
+            try:
+                self._lock()
+                self._swap_locked()
+                self.execute("COMMIT")
+                break
+            except sa.exc.OperationalError as error:
+                self.execute("ROLLBACK")
+                self.last_seq, self.stats["replayed"] = last_seq, replayed  # The replay was rolled back too
+                if getattr(error.orig, "pgcode", None) != '55P03' or attempt == SWAP_ATTEMPTS:
+                    raise
+                self.progress(f"{self.table}: swap lock not granted within {SWAP_LOCK_TIMEOUT_MS} ms, retrying")
+                time.sleep(0.1 * attempt)
+                self.catch_up()
+            except Exception:
+                self.execute("ROLLBACK")
+                raise
+        self.stats["swap_seconds"] = time.perf_counter() - started
+
+    def _swap_locked(self):
+        while self.replay():
+            pass
+        self.remove_capture()
+        if self.dialect == 'postgresql':
+            for table, name, _ in self.references:
+                self.execute(f"ALTER TABLE {table} DROP CONSTRAINT {name}")
+        self.execute(f"DROP TABLE {self.table}")
+        self.execute(f"ALTER TABLE {self.new} RENAME TO {self.table}")
+        if self.dialect == 'postgresql':
+            self.execute(f"ALTER TABLE {self.table} RENAME CONSTRAINT {self.new}_pkey TO {self.table}_pkey")
+            for name, *_ in self.indexes:
+                self.execute(f"ALTER INDEX {name}_online RENAME TO {name}")
+            for table, name, definition in self.references:
+                # NOT VALID skips the scan of the referencing table while the lock is held
+                self.execute(f"ALTER TABLE {table} ADD CONSTRAINT {name} {definition} NOT VALID")
+            self.execute(
+                f"SELECT setval(pg_get_serial_sequence('{self.table}', 'id'), "
+                f"(SELECT COALESCE(MAX(id), 1) FROM {self.table}))"
+            )
+
+    def validate_references(self):
+        """Check existing rows against the re-added foreign keys, without blocking writes."""
+        for table, name, _ in self.references:
+            self.execute(f"ALTER TABLE {table} VALIDATE CONSTRAINT {name}")
+
+    def run(self):
+        started = time.perf_counter()
+        self.install_capture()
+        try:
+            self.copy()
+            self.catch_up()
+            if self.dialect == 'postgresql':
+                # Indexes are renamed in the swap, so they can be built beforehand
+                self.build_indexes(temporary=True)
+            self.swap()
+        except Exception:
+            self.remove_capture()
+            self.execute(f"DROP TABLE IF EXISTS {self.new}")
+            raise
+        finally:
+            self.execute(f"DROP TABLE IF EXISTS {self.log}")
+        if self.dialect == 'postgresql':
+            self.validate_references()
+        else:
+            # SQLite can't rename indexes; build them once the table is in place
+            self.build_indexes(temporary=False)
+        self.stats["total_seconds"] = time.perf_counter() - started
+        self.progress(f"{self.table}: rebuilt {self.stats['copied']} rows, replayed {self.stats['replayed']} changes, "
+                      f"write lock held {self.stats['swap_seconds'] * 1000:.0f} ms")
+        return self.stats
+
+
+def rebuild_table(connection, table, columns, indexes=None, chunk_size=5000, catchup_threshold=1000, progress=print,
+                  table_kwargs=None):
+    """Rebuild `table` with a new column definition while it stays writable.
+
+    `connection` must be in autocommit mode (an Alembic autocommit_block or
+    isolation_level="AUTOCOMMIT"); each chunk commits on its own. `columns`
+    are fresh sa.Column objects for the new table, which must keep an
+    integer `id` primary key; columns present in both tables are copied.
+    `indexes` is a list of (name, [column, ...]) or (name, [column, ...],
+    where) to recreate, the latter as a partial index. `table_kwargs` go to
+    the new sa.Table, e.g. sqlite_autoincrement=True. Returns copy, replay
+    and lock-time statistics.
+    """
+    return _Rebuild(connection, table, columns, indexes, chunk_size, catchup_threshold, progress,
+                    table_kwargs).run()
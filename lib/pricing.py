@@ -0,0 +1,209 @@
+import os
+import threading
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+from sqlalchemy import bindparam, select, update
+
+from lib.database import get_session
+from lib.models import ArchivedRental, Book, DAILY_PENALTY, LOAN_DAYS, RatePlan, Rental, User, late_penalty
+
+
+@dataclass(frozen=True)
+class Plan:
+    """In-memory copy of a RatePlan row; id None is the built-in default."""
+    id: Optional[int]
+    name: str
+    genre: Optional[str]
+    tier: Optional[str]
+    loan_days: int
+    daily_penalty: float
+    penalty_cap: Optional[float]
+    grace_days: int
+
+    def penalty(self, due_date, return_date):
+        return late_penalty(due_date, return_date, self.daily_penalty, self.grace_days, self.penalty_cap)
+
+
+DEFAULT_PLAN = Plan(None, "default", None, None, LOAN_DAYS, DAILY_PENALTY, None, 0)
+
+# Plans changed by another process reach this one's card within this many seconds
+RATE_CARD_TTL_SECONDS = float(os.environ.get("RATE_CARD_TTL_SECONDS", "30"))
+
+
+def genres_of(book_genres):
+    """Normalized genre names from a book's comma-separated `genres` string."""
+    return [genre.strip().lower() for genre in (book_genres or "").split(",") if genre.strip()]
+
+
+class RateCard:
+    """Rate plans compiled into dict lookups, so pricing a rental needs no queries.
+
+    Candidates for a (genre, tier) are found by probing four keys, most specific
+    first: (genre, tier), (genre, any), (any, tier), (any, any).
+    """
+
+    def __init__(self, plans):
+        self.by_id = {plan.id: plan for plan in plans}
+        self._by_key = {}
+        for plan in sorted(plans, key=lambda plan: (plan.loan_days, plan.id)):
+            self._by_key.setdefault((plan.genre, plan.tier), []).append(plan)
+
+    def plan_for(self, genres, tier, loan_days=None):
+        """The most specific plan for any of the book's genres and the user's tier.
+
+        With loan_days, only plans of that length qualify; otherwise the shortest
+        loan of the most specific match is the standard one.
+        """
+        tier = tier.lower() if tier else None
+        for keys in ([(genre, tier) for genre in genres], [(genre, None) for genre in genres], [(None, tier)], [(None, None)]):
+            for key in keys:
+                for plan in self._by_key.get(key, ()):
+                    if loan_days is None or plan.loan_days == loan_days:
+                        return plan
+        if loan_days is None or loan_days == DEFAULT_PLAN.loan_days:
+            return DEFAULT_PLAN
+        return None
+
+    def plan(self, plan_id):
+        """The plan a rental was priced with (the default for None or a deleted plan)."""
+        return self.by_id.get(plan_id, DEFAULT_PLAN)
+
+
+_cards = {}  # Branch -> (card, monotonic time it was compiled)
+_cards_lock = threading.Lock()
+
+
+def _compile(session):
+    plans = [
+        Plan(row.id, row.name, row.genre.lower() if row.genre else None, row.tier.lower() if row.tier else None,
+             row.loan_days, row.daily_penalty, row.penalty_cap, row.grace_days)
+        for row in session.scalars(select(RatePlan))
+    ]
+    return RateCard(plans)
+
+
+def rate_card(branch=None):
+    """The compiled rate card for a database, loaded on first use and again every RATE_CARD_TTL_SECONDS."""
+    entry = _cards.get(branch)
+    if entry is not None and time.monotonic() - entry[1] < RATE_CARD_TTL_SECONDS:
+        return entry[0]
+    # While one thread recompiles an expired card, the others keep pricing with it
+    if not _cards_lock.acquire(blocking=entry is None):
+        return entry[0]
+    try:
+        current = _cards.get(branch)
+        if current is not None and current is not entry:
+            return current[0]
+        session = get_session(branch=branch)
+        try:
+            card = _compile(session)
+        finally:
+            session.close()
+        _cards[branch] = (card, time.monotonic())
+        return card
+    finally:
+        _cards_lock.release()
+
+
+def invalidate(branch=None):
+    """Drop the compiled card after rate plans change; the next rental recompiles it."""
+    with _cards_lock:
+        _cards.pop(branch, None)
+
+
+# ---------- plan management ----------
+
+def add_rate_plan(name, genre=None, tier=None, loan_days=LOAN_DAYS, daily_penalty=DAILY_PENALTY,
+                  penalty_cap=None, grace_days=0, branch=None):
+    session = get_session(branch=branch)
+    try:
+        if loan_days <= 0 or daily_penalty < 0 or grace_days < 0:
+            return "Error: Loan days must be positive; penalty and grace days can't be negative."
+        if session.scalar(select(RatePlan.id).where(RatePlan.name == name)):
+            return f"Error: A rate plan named '{name}' already exists."
+        plan = RatePlan(name=name, genre=genre, tier=tier, loan_days=loan_days, daily_penalty=daily_penalty,
+                        penalty_cap=penalty_cap, grace_days=grace_days)
+        session.add(plan)
+        session.commit()
+        invalidate(branch)
+        return f"Rate plan '{name}' added with ID: {plan.id}"
+    finally:
+        session.close()
+
+
+def list_rate_plans(branch=None):
+    card = rate_card(branch)
+    plans = sorted(card.by_id.values(), key=lambda plan: plan.id)
+    if not plans:
+        return f"No rate plans; every rental uses {LOAN_DAYS} days and KSh {DAILY_PENALTY} per day late."
+    return [
+        f"Plan ID: {plan.id}, Name: {plan.name}, Genre: {plan.genre or 'any'}, Tier: {plan.tier or 'any'}, "
+        f"Loan: {plan.loan_days} days, Penalty: {plan.daily_penalty} KSh/day after {plan.grace_days} grace days, "
+        f"Cap: {plan.penalty_cap if plan.penalty_cap is not None else 'none'}"
+        for plan in plans
+    ]
+
+
+# ---------- bulk repricing ----------
+
+def reprice(branch=None, reassign=False, batch_size=5000, dry_run=False, echo=print):
+    """Recompute penalties of returned rentals, archived ones included, under the current plans.
+
+    Each rental keeps the plan it was rented under, unless reassign is set, in
+    which case the plan is chosen again from the book's genres and the user's
+    current tier (matching the loan length the rental actually had). Only
+    rows whose penalty or plan changes are written, in batches.
+    """
+    card = rate_card(branch)
+    started = time.monotonic()
+    stats = {"scanned": 0, "changed": 0, "delta": 0.0}
+    for model in (Rental, ArchivedRental):
+        table = model.__table__
+        last_id = 0
+        while True:
+            session = get_session(branch=branch)
+            try:
+                rows = session.execute(
+                    select(model.id, model.due_date, model.rent_date, model.return_date, model.penalty,
+                           model.rate_plan_id, Book.genres, User.tier)
+                    .outerjoin(Book, Book.id == model.book_id)
+                    .outerjoin(User, User.id == model.user_id)
+                    .where(model.id > last_id, model.return_date.is_not(None))
+                    .order_by(model.id)
+                    .limit(batch_size)
+                ).all()
+                if not rows:
+                    break
+                changes = []
+                for row in rows:
+                    plan = card.plan(row.rate_plan_id)
+                    if reassign and row.rent_date is not None:
+                        loan_days = (row.due_date.replace(tzinfo=None) - row.rent_date.replace(tzinfo=None)).days
+                        plan = card.plan_for(genres_of(row.genres), row.tier, loan_days) or plan
+                    penalty = plan.penalty(row.due_date, row.return_date)
+                    if penalty != (row.penalty or 0.0) or plan.id != row.rate_plan_id:
+                        changes.append({"r_id": row.id, "r_penalty": penalty, "r_plan": plan.id})
+                        stats["delta"] += penalty - (row.penalty or 0.0)
+                if changes and not dry_run:
+                    session.execute(
+                        update(table).where(table.c.id == bindparam("r_id"))
+                        .values(penalty=bindparam("r_penalty"), rate_plan_id=bindparam("r_plan")),
+                        changes,
+                    )
+                    session.commit()
+                stats["scanned"] += len(rows)
+                stats["changed"] += len(changes)
+                last_id = rows[-1].id
+            except Exception:
+                session.rollback()
+                raise
+            finally:
+                session.close()
+            echo(f"{model.__tablename__}: scanned {stats['scanned']}, changed {stats['changed']}")
+    elapsed = time.monotonic() - started
+    verb = "Would change" if dry_run else "Changed"
+    echo(f"{verb} {stats['changed']} of {stats['scanned']} returned rentals "
+         f"(penalties {stats['delta']:+.1f} KSh) in {elapsed:.1f}s")
+    return stats
@@ -0,0 +1,339 @@
+"""Opt-in profiling for CLI commands and menu actions.
+
+Enabled with `--profile DIR` on the CLI or LIBRARY_PROFILE=DIR for the
+interactive menus. Each action (a command, or one menu choice) is timed by
+phase and profiled, and the results are accumulated per action name in DIR:
+
+    <action>.json       runs, per-phase seconds and top functions, for profile-compare
+    <action>.collapsed  sampled stacks ("frame;frame;frame count"), for flamegraph.pl / speedscope
+    <action>.pstats     cProfile statistics (with LIBRARY_PROFILER=cprofile), for snakeviz / pstats
+
+Stacks are sampled in both modes; with cprofile its overhead shows in them.
+Only the thread running the action is timed and profiled, so queries from
+other threads (the audit flusher, a scheduler, parallel reports) don't
+count against it.
+
+Phases: startup (importing lib to the first action), prompt (waiting on
+input()), engine (opening DBAPI connections), query (statements in the
+database), hydration (the rest of the service call: ORM loading and Python
+logic) and formatting (everything else, mostly printing results).
+"""
+import builtins
+import cProfile
+import functools
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import Pool
+
+import lib
+
+PHASES = ("startup", "prompt", "engine", "query", "hydration", "formatting")
+SAMPLE_INTERVAL = 0.005  # Seconds between stack samples
+TOP_FUNCTIONS = 30       # Functions kept in each .json for comparisons
+
+_profiler = None
+
+
+# ---------- sampling ----------
+
+def _short_path(path):
+    """Project-relative path, or the path below site-packages for libraries."""
+    if path.startswith("<") or path == "~":
+        return path
+    head, marker, tail = path.partition("site-packages" + os.sep)
+    return tail if marker else os.path.relpath(path)
+
+
+def _frame_name(code):
+    return f"{code.co_name} ({_short_path(code.co_filename)}:{code.co_firstlineno})"
+
+
+class _Sampler(threading.Thread):
+    """Samples one thread's Python stack at a fixed interval."""
+
+    def __init__(self, thread_id, interval):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame.f_code))
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self._done.set()
+        self.join()
+        return self.stacks
+
+
+# ---------- phase timing ----------
+
+class _Action:
+    def __init__(self):
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.service_seconds = 0.0
+        self.database_in_services = 0.0  # Part of engine + query spent inside service calls
+
+
+class Profiler:
+    """Collects phase timings and profiles for named actions and saves them to `directory`."""
+
+    def __init__(self, directory, mode="sample"):
+        if mode not in ("sample", "cprofile"):
+            raise ValueError(f"Unknown profiler '{mode}', expected sample or cprofile.")
+        self.directory = directory
+        self.mode = mode
+        self.current = None
+        self._thread = None  # The thread running `current`
+        self._startup = time.perf_counter() - lib.IMPORTED_AT  # Charged to the first action
+        self._local = threading.local()
+        self._cprofiles = {}
+        os.makedirs(directory, exist_ok=True)
+        self._install_hooks()
+
+    def _add(self, phase, seconds):
+        if self.current is not None and threading.get_ident() == self._thread:
+            self.current.phases[phase] += seconds
+            if phase in ("engine", "query") and getattr(self._local, "service_depth", 0):
+                self.current.database_in_services += seconds
+
+    def _install_hooks(self):
+        # Class-level listeners cover engines created later, e.g. branch engines
+        @event.listens_for(Engine, "before_cursor_execute")
+        def _query_started(conn, cursor, statement, parameters, context, executemany):
+            self._local.query_started = time.perf_counter()
+
+        @event.listens_for(Engine, "after_cursor_execute")
+        def _query_finished(conn, cursor, statement, parameters, context, executemany):
+            self._add("query", time.perf_counter() - self._local.query_started)
+
+        @event.listens_for(Engine, "do_connect")
+        def _connecting(dialect, conn_rec, cargs, cparams):
+            self._local.connect_started = time.perf_counter()
+
+        @event.listens_for(Pool, "connect")
+        def _connected(dbapi_connection, connection_record):
+            started = getattr(self._local, "connect_started", None)
+            if started is not None:
+                self._add("engine", time.perf_counter() - started)
+                self._local.connect_started = None
+
+        prompt = builtins.input
+
+        @functools.wraps(prompt)
+        def timed_input(*args):
+            started = time.perf_counter()
+            try:
+                return prompt(*args)
+            finally:
+                self._add("prompt", time.perf_counter() - started)
+
+        builtins.input = timed_input
+
+        from lib.services import book_service, rental_service, reservation_service, user_service
+        for cls in (user_service.UserService, book_service.BookService,
+                    rental_service.RentalService, reservation_service.ReservationService):
+            for name, method in list(vars(cls).items()):
+                if name.startswith("_"):
+                    continue
+                if isinstance(method, staticmethod):
+                    setattr(cls, name, staticmethod(self._timed_service(method.__func__)))
+                elif callable(method):
+                    setattr(cls, name, self._timed_service(method))
+
+    def _timed_service(self, method):
+        @functools.wraps(method)
+        def timed(*args, **kwargs):
+            # Services call each other (return_book -> allocate); only time the outermost call
+            depth = getattr(self._local, "service_depth", 0)
+            self._local.service_depth = depth + 1
+            started = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self._local.service_depth = depth
+                if depth == 0 and self.current is not None and threading.get_ident() == self._thread:
+                    self.current.service_seconds += time.perf_counter() - started
+        return timed
+
+    @contextmanager
+    def action(self, name):
+        """Time and profile the enclosed block as one run of `name`."""
+        started = time.perf_counter()
+        action = self.current = _Action()
+        self._thread = threading.get_ident()
+        action.phases["startup"], self._startup = self._startup, 0.0
+        sampler = _Sampler(self._thread, SAMPLE_INTERVAL)
+        sampler.start()
+        if self.mode == "cprofile":
+            # Profiles only this thread; the sampler runs outside it
+            profile = self._cprofiles.setdefault(name, cProfile.Profile())
+            profile.enable()
+        try:
+            yield action
+        finally:
+            if self.mode == "cprofile":
+                profile.disable()
+            stacks = sampler.stop()
+            elapsed = time.perf_counter() - started
+            self.current = self._thread = None
+            phases = action.phases
+            database_elsewhere = phases["engine"] + phases["query"] - action.database_in_services
+            phases["hydration"] = max(0.0, action.service_seconds - action.database_in_services)
+            phases["formatting"] = max(0.0, elapsed - phases["prompt"] - action.service_seconds - database_elsewhere)
+            collapsed = self._merge_collapsed(name, stacks)
+            if self.mode == "cprofile":
+                self._save(name, phases, self._cprofile_top(name))
+                self._cprofiles[name].dump_stats(self._path(name, "pstats"))
+            else:
+                self._save(name, phases, self._sampled_top(collapsed))
+
+    # ---------- output ----------
+
+    def _path(self, name, extension):
+        return os.path.join(self.directory, f"{name}.{extension}")
+
+    def _merge_collapsed(self, name, stacks):
+        """Add this run's stacks to <name>.collapsed and return the combined counts."""
+        path = self._path(name, "collapsed")
+        combined = Counter()
+        if os.path.exists(path):
+            with open(path) as saved:
+                for line in saved:
+                    stack, _, count = line.rstrip("\n").rpartition(" ")
+                    combined[stack] += int(count)
+        combined.update(stacks)
+        with open(path, "w") as out:
+            for stack, count in combined.most_common():
+                out.write(f"{stack} {count}\n")
+        return combined
+
+    @staticmethod
+    def _sampled_top(collapsed):
+        """Share of samples whose innermost frame is each function."""
+        leaves = Counter()
+        for stack, count in collapsed.items():
+            leaves[stack.rpartition(";")[2]] += count
+        total = sum(leaves.values()) or 1
+        return {frame: count / total for frame, count in leaves.most_common(TOP_FUNCTIONS)}
+
+    def _cprofile_top(self, name):
+        """Share of own (non-child) time spent in each function."""
+        stats = pstats.Stats(self._cprofiles[name]).stats
+        total = sum(entry[2] for entry in stats.values()) or 1
+        ranked = sorted(stats.items(), key=lambda item: item[1][2], reverse=True)[:TOP_FUNCTIONS]
+        return {f"{func} ({_short_path(path)}:{line})": entry[2] / total
+                for (path, line, func), entry in ranked}
+
+    def _save(self, name, phases, top):
+        path = self._path(name, "json")
+        saved = {"name": name, "mode": self.mode, "runs": 0, "phases": dict.fromkeys(PHASES, 0.0)}
+        if os.path.exists(path):
+            with open(path) as existing:
+                saved = json.load(existing)
+        saved["runs"] += 1
+        for phase, seconds in phases.items():
+            saved["phases"][phase] = saved["phases"].get(phase, 0.0) + seconds
+        saved["top"] = top
+        with open(path, "w") as out:
+            json.dump(saved, out, indent=2)
+
+
+def enable(directory, mode="sample"):
+    """Start profiling actions into `directory` (idempotent)."""
+    global _profiler
+    if _profiler is None:
+        _profiler = Profiler(directory, mode)
+    return _profiler
+
+
+def enable_from_env():
+    """Enable profiling if LIBRARY_PROFILE names an output directory."""
+    directory = os.environ.get("LIBRARY_PROFILE")
+    if directory:
+        enable(directory, os.environ.get("LIBRARY_PROFILER", "sample"))
+
+
+@contextmanager
+def action(name):
+    """Profile the enclosed block as one run of `name`; a no-op unless profiling is enabled."""
+    if _profiler is None:
+        yield None
+    else:
+        with _profiler.action(name) as current:
+            yield current
+
+
+def profiled(func):
+    """Decorator form of action(), named after the function."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with action(func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+# ---------- comparison ----------
+
+def _load(path):
+    if os.path.isdir(path):
+        profiles = {}
+        for filename in sorted(os.listdir(path)):
+            if filename.endswith(".json"):
+                with open(os.path.join(path, filename)) as saved:
+                    profile = json.load(saved)
+                profiles[profile["name"]] = profile
+        return profiles
+    with open(path) as saved:
+        profile = json.load(saved)
+    return {profile["name"]: profile}
+
+
+def _change(before, after):
+    if before == 0:
+        return "new" if after else ""
+    return f"{(after - before) / before * 100:+.0f}%"
+
+
+def compare(baseline, current, top=10):
+    """Lines comparing per-run phase times and hot functions of two profile files or directories."""
+    before, after = _load(baseline), _load(current)
+    lines = []
+    for name in sorted(set(before) & set(after)):
+        old, new = before[name], after[name]
+        lines.append(f"== {name} ({old['runs']} baseline runs, {new['runs']} current runs)")
+        lines.append(f"{'phase':<12}{'baseline ms':>14}{'current ms':>14}{'change':>10}")
+        for phase in PHASES:
+            old_ms = old["phases"].get(phase, 0.0) / old["runs"] * 1000
+            new_ms = new["phases"].get(phase, 0.0) / new["runs"] * 1000
+            lines.append(f"{phase:<12}{old_ms:>14.2f}{new_ms:>14.2f}{_change(old_ms, new_ms):>10}")
+        shifts = sorted(
+            set(old["top"]) | set(new["top"]),
+            key=lambda frame: abs(new["top"].get(frame, 0.0) - old["top"].get(frame, 0.0)),
+            reverse=True,
+        )[:top]
+        if shifts:
+            lines.append("largest shifts in self time share:")
+            for frame in shifts:
+                lines.append(f"  {old['top'].get(frame, 0.0) * 100:5.1f}% -> {new['top'].get(frame, 0.0) * 100:5.1f}%  {frame}")
+    missing = sorted(set(before) ^ set(after))
+    if missing:
+        lines.append(f"Only in one of the two: {', '.join(missing)}")
+    return lines
@@ -0,0 +1,356 @@
+"""'Users who rented this also rented' suggestions from co-rental counts.
+
+Two tables hold the precomputed state:
+
+    book_pairs       sparse, symmetric co-occurrence matrix (upper triangle):
+                     how many users rented both books; the diagonal counts
+                     each book's renters
+    book_neighbors   the top TOP_K books per book by cosine similarity,
+                     co_rentals / sqrt(renters(a) * renters(b))
+
+`rebuild()` computes the matrix from the whole rental history, with a SciPy
+sparse product when NumPy and SciPy are installed and plain Python
+otherwise. `update()` folds in rentals past a watermark: each new
+(user, book) only adds the pairs it forms with that user's earlier books,
+and only the neighbor lists those counts can change are recomputed.
+
+Rental ids are never reused (AUTOINCREMENT on SQLite, a sequence on
+PostgreSQL), but on PostgreSQL a rental can commit after one with a higher
+id. The watermark therefore only moves up to the newest id seen at least
+COMMIT_LAG_SECONDS ago, by when any lower id has committed or been
+abandoned; new rentals reach the lists that much later. SQLite commits one
+writer at a time, in id order, and folds rentals in right away.
+Lookups read book_neighbors by primary key, so they take milliseconds
+however long the history is.
+"""
+import heapq
+import math
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import bindparam, delete, desc, func, insert, or_, select
+from sqlalchemy.dialects import postgresql, sqlite
+
+from lib.archive import rental_history
+from lib.database import COMMIT_LAG_SECONDS, get_session
+from lib.models import Book, BookNeighbor, BookPair, Watermark
+
+try:
+    import numpy
+    from scipy import sparse
+except ImportError:  # Optional; rebuild() falls back to counting in Python
+    numpy = sparse = None
+
+TOP_K = 20          # Neighbors kept per book
+RECOMMEND_LIMIT = 10
+WATERMARK = "recommendations:rentals"
+HORIZON = "recommendations:horizon"
+_CHUNK = 500        # Ids per IN (...) list
+
+_history = rental_history()
+_user_books = select(rental_history(user_id=bindparam("user_id")).c.book_id)
+
+_BOOK_NEIGHBORS = (
+    select(BookNeighbor.neighbor_id, Book.title, Book.author, Book.available,
+           BookNeighbor.score, BookNeighbor.co_rentals)
+    .join(Book, Book.id == BookNeighbor.neighbor_id)
+    .where(BookNeighbor.book_id == bindparam("book_id"))
+    .order_by(BookNeighbor.rank)
+    .limit(bindparam("limit"))
+)
+
+# Neighbors of everything the user has rented, weighted by similarity, minus what they've read
+_USER_RECOMMENDATIONS = (
+    select(BookNeighbor.neighbor_id, Book.title, Book.author, Book.available,
+           func.sum(BookNeighbor.score).label("score"), func.count().label("because"))
+    .join(Book, Book.id == BookNeighbor.neighbor_id)
+    .where(BookNeighbor.book_id.in_(_user_books), BookNeighbor.neighbor_id.not_in(_user_books))
+    .group_by(BookNeighbor.neighbor_id, Book.title, Book.author, Book.available)
+    .order_by(desc("score"), BookNeighbor.neighbor_id)
+    .limit(bindparam("limit"))
+)
+
+
+def _utcnow():
+    # Naive UTC, comparable with the DateTime values SQLite returns
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def _score(co_rentals, renters_a, renters_b):
+    return co_rentals / math.sqrt(renters_a * renters_b)
+
+
+def _chunks(ids, size=_CHUNK):
+    ids = sorted(ids)
+    for start in range(0, len(ids), size):
+        yield ids[start:start + size]
+
+
+def count_pairs(user_ids, book_ids):
+    """Co-rental counts as (book_a, book_b, users) with book_a <= book_b, from distinct (user, book) pairs."""
+    if sparse is not None:
+        books, columns = numpy.unique(numpy.asarray(book_ids), return_inverse=True)
+        users, rows = numpy.unique(numpy.asarray(user_ids), return_inverse=True)
+        renters = sparse.csr_matrix((numpy.ones(len(rows), dtype=numpy.int64), (rows, columns)),
+                                    shape=(len(users), len(books)))
+        matrix = sparse.triu(renters.T @ renters).tocoo()
+        return zip(books[matrix.row].tolist(), books[matrix.col].tolist(), matrix.data.tolist())
+    by_user = defaultdict(list)
+    for user_id, book_id in zip(user_ids, book_ids):
+        by_user[user_id].append(book_id)
+    counts = Counter()
+    for books in by_user.values():
+        books.sort()
+        for i, book_a in enumerate(books):
+            for book_b in books[i:]:
+                counts[book_a, book_b] += 1
+    return ((book_a, book_b, users) for (book_a, book_b), users in counts.items())
+
+
+class Recommender:
+    """Keeps book_pairs and book_neighbors current and serves recommendations from them."""
+
+    def __init__(self, top_k=TOP_K, batch_size=2000, branch=None):
+        self.top_k = top_k
+        self.batch_size = batch_size
+        self.branch = branch
+
+    # ---------- lookups ----------
+
+    def for_book(self, book_id, limit=RECOMMEND_LIMIT):
+        """Books most often rented by the renters of book_id"""
+        session = get_session(readonly=True, branch=self.branch)
+        try:
+            rows = session.execute(_BOOK_NEIGHBORS, {"book_id": book_id, "limit": limit}).all()
+            if not rows and session.get(Book, book_id) is None:
+                return f"Error: Book with ID {book_id} does not exist."
+        finally:
+            session.close()
+        if not rows:
+            return f"No recommendations for book ID {book_id} yet."
+        return [
+            f"Book ID: {row.neighbor_id}, Title: {row.title}, Author: {row.author}, Available: {row.available}, "
+            f"Score: {row.score:.3f} ({row.co_rentals} shared renters)"
+            for row in rows
+        ]
+
+    def for_user(self, user_id, limit=RECOMMEND_LIMIT):
+        """Books similar to a user's rental history that they haven't rented"""
+        session = get_session(readonly=True, branch=self.branch)
+        try:
+            rows = session.execute(_USER_RECOMMENDATIONS, {"user_id": user_id, "limit": limit}).all()
+        finally:
+            session.close()
+        if not rows:
+            return f"No recommendations for user ID {user_id} yet."
+        return [
+            f"Book ID: {row.neighbor_id}, Title: {row.title}, Author: {row.author}, Available: {row.available}, "
+            f"Score: {row.score:.3f} (similar to {row.because} of their books)"
+            for row in rows
+        ]
+
+    # ---------- maintenance ----------
+
+    def _watermark(self, session):
+        watermark = session.get(Watermark, WATERMARK, with_for_update=True)
+        if watermark is None:
+            watermark = Watermark(name=WATERMARK, position=None, last_id=0)
+            session.add(watermark)
+        return watermark
+
+    @staticmethod
+    def _horizon(session):
+        """The lag (seconds) before an id is settled, and the row timing it; no lag on SQLite."""
+        if session.get_bind().dialect.name == 'sqlite':
+            return 0, None
+        horizon = session.get(Watermark, HORIZON, with_for_update=True)
+        if horizon is None:
+            horizon = Watermark(name=HORIZON, position=_utcnow(), last_id=0)
+            session.add(horizon)
+        return COMMIT_LAG_SECONDS, horizon
+
+    def _settled(self, session, folded):
+        """The highest rental id below which every rental has committed or been abandoned."""
+        newest = session.scalar(select(func.max(_history.c.id))) or 0
+        lag, horizon = self._horizon(session)
+        if horizon is None:
+            return newest
+        now = _utcnow()
+        if horizon.position > now - timedelta(seconds=lag):
+            return folded
+        if horizon.last_id > folded:
+            return horizon.last_id
+        # Caught up with the last settled id: time the newest one
+        horizon.position, horizon.last_id = now, newest
+        return folded
+
+    @staticmethod
+    def _add_pairs(session, counts):
+        rows = [{"book_a": a, "book_b": b, "co_rentals": users} for (a, b), users in counts.items()]
+        if not rows:
+            return
+        dialect = session.get_bind().dialect.name
+        upsert = (postgresql.insert if dialect == 'postgresql' else sqlite.insert)(BookPair)
+        session.execute(upsert.on_conflict_do_update(
+            index_elements=['book_a', 'book_b'],
+            set_={"co_rentals": BookPair.co_rentals + upsert.excluded.co_rentals},
+        ), rows)
+
+    @staticmethod
+    def _renters(session, book_ids):
+        """Renter counts (the matrix diagonal) of book_ids."""
+        renters = {}
+        for chunk in _chunks(book_ids):
+            renters.update(session.execute(
+                select(BookPair.book_a, BookPair.co_rentals)
+                .where(BookPair.book_a.in_(chunk), BookPair.book_b == BookPair.book_a)
+            ).tuples().all())
+        return renters
+
+    def _refresh(self, session, book_ids):
+        """Recompute the neighbor lists of book_ids from book_pairs."""
+        for chunk in _chunks(book_ids):
+            wanted = set(chunk)
+            candidates = defaultdict(list)
+            for book_a, book_b, users in session.execute(
+                select(BookPair.book_a, BookPair.book_b, BookPair.co_rentals)
+                .where(or_(BookPair.book_a.in_(chunk), BookPair.book_b.in_(chunk)), BookPair.book_a != BookPair.book_b)
+            ):
+                if book_a in wanted:
+                    candidates[book_a].append((book_b, users))
+                if book_b in wanted:
+                    candidates[book_b].append((book_a, users))
+
+            renters = self._renters(session, wanted.union(*([book for book, _ in pairs] for pairs in candidates.values())))
+            rows = []
+            for book_id, pairs in candidates.items():
+                scored = (
+                    (_score(users, renters[book_id], renters[neighbor]), users, -neighbor)
+                    for neighbor, users in pairs
+                )
+                for rank, (score, users, neighbor) in enumerate(heapq.nlargest(self.top_k, scored), start=1):
+                    rows.append({"book_id": book_id, "rank": rank, "neighbor_id": -neighbor,
+                                 "score": score, "co_rentals": users})
+            session.execute(delete(BookNeighbor).where(BookNeighbor.book_id.in_(chunk)))
+            if rows:
+                session.execute(insert(BookNeighbor.__table__), rows)
+
+    @staticmethod
+    def _listing(session, book_ids):
+        """Books whose neighbor lists include any of book_ids."""
+        books = set()
+        for chunk in _chunks(book_ids):
+            books.update(session.scalars(select(BookNeighbor.book_id).where(BookNeighbor.neighbor_id.in_(chunk))))
+        return books
+
+    def update_batch(self):
+        """Fold the next batch of rentals past the watermark into the matrix; return how many were read."""
+        session = get_session(branch=self.branch)
+        try:
+            watermark = self._watermark(session)
+            after = watermark.last_id
+            settled = self._settled(session, after)
+            rentals = session.execute(
+                select(_history.c.id, _history.c.user_id, _history.c.book_id)
+                .where(_history.c.id > after, _history.c.id <= settled)
+                .order_by(_history.c.id)
+                .limit(self.batch_size)
+            ).all()
+            if not rentals:
+                session.commit()  # Keeps a newly timed horizon
+                return 0
+
+            seen = defaultdict(set)
+            for users in _chunks({rental.user_id for rental in rentals}):
+                for user_id, book_id in session.execute(
+                    select(_history.c.user_id, _history.c.book_id).distinct()
+                    .where(_history.c.user_id.in_(users), _history.c.id <= after)
+                ):
+                    seen[user_id].add(book_id)
+
+            counts = Counter()
+            for rental in rentals:
+                books = seen[rental.user_id]
+                if rental.book_id in books:
+                    continue  # A re-rental adds no new pairs
+                for other in books:
+                    counts[min(rental.book_id, other), max(rental.book_id, other)] += 1
+                counts[rental.book_id, rental.book_id] += 1
+                books.add(rental.book_id)
+
+            self._add_pairs(session, counts)
+            # A changed pair can reorder anything in its two books' lists; a book with
+            # more renters only scores lower elsewhere, which matters to lists it is in
+            changed = {book for pair in counts for book in pair}
+            new_renters = {book_a for book_a, book_b in counts if book_a == book_b}
+            self._refresh(session, changed | self._listing(session, new_renters))
+            watermark.last_id = rentals[-1].id
+            watermark.updated_at = _utcnow()
+            session.commit()
+            return len(rentals)
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def update(self, max_batches=None, deadline=None):
+        """Catch up with new rentals, stopping at a time.monotonic() deadline if given; return how many were read."""
+        total, batches = 0, 0
+        while (max_batches is None or batches < max_batches) and (deadline is None or time.monotonic() < deadline):
+            count = self.update_batch()
+            total += count
+            batches += 1
+            if count < self.batch_size:
+                break
+        return total
+
+    def rebuild(self, echo=print):
+        """Recompute the whole matrix and every neighbor list from the rental history."""
+        started = time.monotonic()
+        session = get_session(branch=self.branch)
+        try:
+            watermark = self._watermark(session)
+            last_id = session.scalar(select(func.max(_history.c.id))) or 0
+            lag, horizon = self._horizon(session)
+            if horizon is not None:
+                if horizon.last_id < last_id or horizon.position > _utcnow() - timedelta(seconds=lag):
+                    # Rentals below last_id may still be committing
+                    echo(f"Waiting {lag}s for rentals still being committed")
+                    time.sleep(lag)
+                horizon.position, horizon.last_id = _utcnow(), session.scalar(select(func.max(_history.c.id))) or 0
+            user_ids, book_ids = [], []
+            for user_id, book_id in session.execute(
+                select(_history.c.user_id, _history.c.book_id).distinct().where(_history.c.id <= last_id)
+            ):
+                user_ids.append(user_id)
+                book_ids.append(book_id)
+            counted = time.monotonic()
+
+            session.execute(delete(BookNeighbor))
+            session.execute(delete(BookPair))
+            pairs, batch = 0, []
+            for book_a, book_b, users in count_pairs(user_ids, book_ids):
+                batch.append({"book_a": book_a, "book_b": book_b, "co_rentals": users})
+                if len(batch) >= 10000:
+                    session.execute(insert(BookPair.__table__), batch)
+                    pairs, batch = pairs + len(batch), []
+            if batch:
+                session.execute(insert(BookPair.__table__), batch)
+                pairs += len(batch)
+            books = set(book_ids)
+            self._refresh(session, books)
+            watermark.last_id = last_id
+            watermark.updated_at = _utcnow()
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+        elapsed = time.monotonic() - started
+        method = "scipy" if sparse is not None else "python"
+        echo(f"Counted {pairs} book pairs from {len(user_ids)} user-book pairs ({method}, "
+             f"{counted - started:.1f}s to read) and ranked neighbors of {len(books)} books in {elapsed:.1f}s")
+        return pairs
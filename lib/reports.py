@@ -0,0 +1,195 @@
+"""Reports over the whole rental history, computed in parallel.
+
+A database runs each query on one core, so a report that scans millions
+of rentals through one connection leaves the rest of the machine idle.
+Here live and archived rentals are split into contiguous ranges of a key
+column, each range is aggregated by a worker process over its own
+read-only connection, and the parent merges the partial results. With
+workers=1 the same ranges are scanned in-process.
+
+Reports split on rental id by default (live and archived rentals share one
+id sequence). Per-user reports split on user id instead, so every user's
+totals come from a single range and partial results never overlap.
+"""
+import csv
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from sqlalchemy import case, create_engine, event, func, select
+
+from lib.database import Session, engine_options, get_session
+from lib.models import ArchivedRental, Rental, User
+
+RANGES_PER_WORKER = 4   # More ranges than workers, so a dense range doesn't hold up the rest
+
+_worker_engine = None
+
+
+def _read_only_engine(url):
+    engine = create_engine(url, **engine_options(url))
+    if engine.dialect.name == "sqlite":
+        @event.listens_for(engine, "connect")
+        def _query_only(dbapi_connection, connection_record):
+            dbapi_connection.execute("PRAGMA query_only = ON")
+        return engine
+    return engine.execution_options(postgresql_readonly=True)
+
+
+def _start_worker(url):
+    global _worker_engine
+    _worker_engine = _read_only_engine(url)
+
+
+def _scan(report, first, last):
+    """Worker side: one range's partial result."""
+    session = Session(bind=_worker_engine)
+    try:
+        return report.scan(session, first, last)
+    finally:
+        session.close()
+
+
+def id_ranges(session, count, column="id"):
+    """Split the values of `column` in live and archived rentals into at most `count` contiguous (first, last) ranges."""
+    bounds = [session.execute(select(func.min(getattr(model, column)), func.max(getattr(model, column)))).one()
+              for model in (Rental, ArchivedRental)]
+    lows = [low for low, _ in bounds if low is not None]
+    if not lows:
+        return []
+    low, high = min(lows), max(high for _, high in bounds if high is not None)
+    width = max(1, -(-(high - low + 1) // count))  # Ceiling division
+    return [(first, min(first + width - 1, high)) for first in range(low, high + 1, width)]
+
+
+def run(report, workers=None, ranges=None, branch=None):
+    """Scan the rental history with `report` across worker processes; return the merged result."""
+    workers = workers or os.cpu_count() or 1
+    session = get_session(readonly=True, branch=branch)
+    try:
+        shards = id_ranges(session, ranges or workers * RANGES_PER_WORKER, report.split_by)
+        if workers == 1 or len(shards) <= 1:
+            partials = [report.scan(session, first, last) for first, last in shards]
+        else:
+            url = session.get_bind().url.render_as_string(hide_password=False)
+            with ProcessPoolExecutor(max_workers=workers, initializer=_start_worker, initargs=(url,)) as pool:
+                partials = list(pool.map(_scan, [report] * len(shards), *zip(*shards)))
+    finally:
+        session.close()
+
+    total = report.empty()
+    for partial in partials:
+        report.merge(total, partial)
+    return total
+
+
+def _penalized(model):
+    return func.count(case((model.penalty > 0, 1)))
+
+
+class PenaltyRevenue:
+    """Returned rentals, how many were penalized, and penalties charged, per year of return (per month within `year`)."""
+
+    split_by = "id"
+
+    def __init__(self, year=None):
+        self.year = year
+
+    def empty(self):
+        return {}
+
+    def scan(self, session, first_id, last_id):
+        partial = {}
+        for model in (Rental, ArchivedRental):
+            period = func.extract("month" if self.year else "year", model.return_date)
+            query = (
+                select(period, func.count(), _penalized(model), func.coalesce(func.sum(model.penalty), 0.0))
+                .where(model.id.between(first_id, last_id), model.return_date.is_not(None))
+                .group_by(period)
+            )
+            if self.year:
+                query = query.where(model.return_date >= datetime(self.year, 1, 1),
+                                    model.return_date < datetime(self.year + 1, 1, 1))
+            for key, returned, penalized, penalties in session.execute(query):
+                self.merge(partial, {int(key): [returned, penalized, penalties]})
+        return partial
+
+    def merge(self, total, partial):
+        for key, (returned, penalized, penalties) in partial.items():
+            counts = total.setdefault(key, [0, 0, 0.0])
+            counts[0] += returned
+            counts[1] += penalized
+            counts[2] += penalties
+
+    def lines(self, total):
+        if not total:
+            return [f"No returned rentals{f' in {self.year}' if self.year else ''}."]
+        label = f"{self.year}-" if self.year else ""
+        lines = [
+            f"{label}{key:02d}: {returned} returned, {penalized} penalized, KSh {penalties:,.2f} in penalties"
+            for key, (returned, penalized, penalties) in sorted(total.items())
+        ]
+        returned, penalized, penalties = (sum(counts[i] for counts in total.values()) for i in range(3))
+        lines.append(f"Total: {returned} returned, {penalized} penalized, KSh {penalties:,.2f} in penalties")
+        return lines
+
+
+class UserSummary:
+    """Per-user rental history totals, written to a CSV file.
+
+    Each range writes its users' rows to a part file next to the output and
+    the parent only concatenates the parts, so no per-user data crosses
+    between processes.
+    """
+
+    split_by = "user_id"  # Ranges scan the covering (user_id, rent_date, ...) history indexes
+    FIELDS = ("user_id", "name", "rentals", "returned", "penalized", "penalties", "first_rented", "last_rented")
+
+    def __init__(self, path):
+        self.path = path
+
+    def empty(self):
+        return []
+
+    def scan(self, session, first_id, last_id):
+        totals = {}
+        for model in (Rental, ArchivedRental):  # A user's archived and live rentals still need merging
+            for user_id, rentals, returned, penalized, penalties, first, last in session.execute(
+                select(model.user_id, func.count(), func.count(model.return_date), _penalized(model),
+                       func.coalesce(func.sum(model.penalty), 0.0), func.min(model.rent_date), func.max(model.rent_date))
+                .where(model.user_id.between(first_id, last_id))
+                .group_by(model.user_id)
+            ):
+                current = totals.get(user_id)
+                if current is None:
+                    totals[user_id] = [rentals, returned, penalized, penalties, first, last]
+                    continue
+                current[0] += rentals
+                current[1] += returned
+                current[2] += penalized
+                current[3] += penalties
+                current[4] = min(filter(None, (current[4], first)), default=None)
+                current[5] = max(filter(None, (current[5], last)), default=None)
+        names = dict(session.execute(select(User.id, User.name).where(User.id.between(first_id, last_id))).tuples().all())
+
+        part = f"{self.path}.{first_id}.part"
+        with open(part, "w", newline="") as output:
+            writer = csv.writer(output)
+            for user_id, (rentals, returned, penalized, penalties, first, last) in sorted(totals.items()):
+                # Users deleted since keep their history, without a name
+                writer.writerow((user_id, names.get(user_id, ""), rentals, returned, penalized,
+                                 f"{penalties:.2f}", first, last))
+        return [(first_id, part, len(totals))]
+
+    def merge(self, total, partial):
+        total.extend(partial)
+
+    def lines(self, total):
+        with open(self.path, "w", newline="") as output:
+            csv.writer(output).writerow(self.FIELDS)
+            for _, part, _ in sorted(total):
+                with open(part, newline="") as rows:
+                    shutil.copyfileobj(rows, output)
+                os.remove(part)
+        return [f"Wrote rental totals of {sum(users for _, _, users in total)} users to {self.path}"]
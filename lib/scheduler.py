@@ -0,0 +1,226 @@
+import time
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import and_, exists, or_, select
+from sqlalchemy.dialects import postgresql, sqlite
+
+from lib.database import get_session
+from lib.models import Rental, RentalNotice, Watermark, User, Book
+from lib import notifications
+from lib.services.reservation_service import ReservationService
+from lib.recommendations import Recommender
+
+REMINDER_DAYS = 2  # Remind users this many days before a rental is due
+RECOMMEND_SECONDS = 10  # Time each tick may spend folding rentals into recommendations
+
+
+def _utcnow():
+    # Naive UTC, comparable with the DateTime values SQLite returns
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class OverdueScheduler:
+    """Finds open rentals crossing a due-date horizon and records notices for them.
+
+    Overdue notices keep a (due_date, rental_id) watermark in the
+    `watermarks` table: a tick only walks `ix_rentals_open_due` from the
+    watermark up to now, so rows handled by earlier ticks are never read
+    again no matter how many rentals are open. That works because a rental
+    is due after it is made (only seed data backdates open rentals). A
+    reminder horizon runs REMINDER_DAYS ahead, so a short loan can fall due
+    behind a watermark. Reminders therefore scan the whole window from now
+    to the horizon each tick and skip rentals that already have a reminder.
+    The window holds only the rentals due in the next few days.
+    """
+
+    KINDS = ('reminder', 'overdue')
+
+    def __init__(self, batch_size=1000, max_batches=100, reminder_days=REMINDER_DAYS,
+                 recommend_seconds=RECOMMEND_SECONDS, branch=None):
+        self.batch_size = batch_size
+        self.max_batches = max_batches
+        self.reminder_days = reminder_days
+        self.recommend_seconds = recommend_seconds
+        self.branch = branch
+        self.reservations = ReservationService(branch)
+        self.recommender = Recommender(batch_size=batch_size, branch=branch)
+        self.metrics = {
+            "ticks": 0,
+            "notices_total": 0,
+            "last_tick_at": None,
+            "last_tick_seconds": 0.0,
+            "last_tick_notices": {kind: 0 for kind in self.KINDS},
+            "lag_seconds": {kind: 0.0 for kind in self.KINDS},
+            "last_tick_recommended": 0,
+            "last_tick_recommend_seconds": 0.0,
+            "last_tick_recommend_error": None,
+        }
+
+    def _horizon(self, kind, now):
+        if kind == 'reminder':
+            return now + timedelta(days=self.reminder_days)
+        return now
+
+    def _watermark(self, session, kind):
+        # Locked so two scheduler processes never scan the same range (PostgreSQL)
+        watermark = session.get(Watermark, f"scheduler:{kind}", with_for_update=True)
+        if watermark is None:
+            watermark = Watermark(name=f"scheduler:{kind}", position=None, last_id=0)
+            session.add(watermark)
+        return watermark
+
+    @staticmethod
+    def _after(position, last_id):
+        """Rows strictly past (position, last_id) in (due_date, id) order."""
+        if position is None:
+            return True
+        return or_(
+            Rental.due_date > position,
+            and_(Rental.due_date == position, Rental.id > last_id),
+        )
+
+    def _open_rentals(self, kind, cursor, now, limit):
+        query = (
+            select(Rental.id, Rental.user_id, Rental.due_date, User.name, User.email, Book.title)
+            .join(User, User.id == Rental.user_id)
+            .join(Book, Book.id == Rental.book_id)
+            .where(Rental.return_date.is_(None), Rental.due_date <= self._horizon(kind, now), self._after(*cursor))
+        )
+        if kind == 'reminder':
+            # Rentals already past due get an overdue notice, not a reminder
+            query = query.where(Rental.due_date > now, ~exists().where(
+                RentalNotice.rental_id == Rental.id, RentalNotice.kind == kind))
+        return query.order_by(Rental.due_date, Rental.id).limit(limit)
+
+    @staticmethod
+    def _message(kind, row):
+        if kind == 'reminder':
+            subject = f"'{row.title}' is due on {row.due_date:%Y-%m-%d}"
+            body = f"Hello {row.name}, please return '{row.title}' by {row.due_date:%Y-%m-%d} to avoid a penalty."
+        else:
+            subject = f"'{row.title}' is overdue"
+            body = (f"Hello {row.name}, '{row.title}' was due on {row.due_date:%Y-%m-%d}. "
+                    f"A penalty accrues for every day it is late.")
+        # Rental ids are never reused; the due date in the key guards against it anyway,
+        # since a clashing key would silently drop this notice
+        return {"user_id": row.user_id, "email": row.email, "kind": kind, "subject": subject,
+                "body": body, "dedup_key": f"{kind}:{row.id}:{row.due_date:%Y%m%d%H%M%S}"}
+
+    def scan(self, kind, now):
+        """Record notices for one kind in batches; return how many were written."""
+        written, cursor = 0, (None, 0)
+        for _ in range(self.max_batches):
+            session = get_session(branch=self.branch)
+            try:
+                # Locked even for reminders, so two scheduler processes never notice the same rows (PostgreSQL)
+                watermark = self._watermark(session, kind)
+                if kind != 'reminder':
+                    cursor = (watermark.position, watermark.last_id)
+                rows = session.execute(self._open_rentals(kind, cursor, now, self.batch_size)).all()
+                if rows:
+                    # A notice another process already recorded is kept, not an error
+                    dialect = session.get_bind().dialect.name
+                    insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+                    notices = insert(RentalNotice).on_conflict_do_nothing(index_elements=['rental_id', 'kind'])
+                    session.execute(notices, [
+                        {"rental_id": row.id, "user_id": row.user_id, "kind": kind,
+                         "due_date": row.due_date, "created_at": now}
+                        for row in rows
+                    ])
+                    # Queue the emails in the same transaction as the notices
+                    notifications.enqueue(session, [self._message(kind, row) for row in rows])
+                    cursor = (rows[-1].due_date, rows[-1].id)
+                    if kind != 'reminder':
+                        watermark.position, watermark.last_id = cursor
+                watermark.updated_at = now
+                session.commit()
+            except Exception:
+                session.rollback()
+                raise
+            finally:
+                session.close()
+
+            written += len(rows)
+            if len(rows) < self.batch_size:
+                break
+        return written
+
+    def lag(self, kind, now):
+        """Seconds since the oldest row past the horizon that is still unprocessed."""
+        session = get_session(branch=self.branch)
+        try:
+            watermark = self._watermark(session, kind)
+            cursor = (None, 0) if kind == 'reminder' else (watermark.position, watermark.last_id)
+            oldest = session.execute(self._open_rentals(kind, cursor, now, 1)).first()
+            session.rollback()
+            if oldest is None:
+                return 0.0
+            return max(0.0, (self._horizon(kind, now) - oldest.due_date).total_seconds())
+        finally:
+            session.close()
+
+    def tick(self, now=None):
+        """Run one scheduling pass and return the updated metrics."""
+        now = now or _utcnow()
+        started = time.perf_counter()
+
+        for kind in self.KINDS:
+            written = self.scan(kind, now)
+            self.metrics["last_tick_notices"][kind] = written
+            self.metrics["notices_total"] += written
+            self.metrics["lag_seconds"][kind] = self.lag(kind, now)
+
+        self.reservations.expire_reservations()
+
+        self.metrics["ticks"] += 1
+        self.metrics["last_tick_at"] = now
+        self.metrics["last_tick_seconds"] = time.perf_counter() - started
+        self.fold_recommendations()
+        return self.metrics
+
+    def fold_recommendations(self):
+        """Fold new rentals into recommendations for up to `recommend_seconds`.
+
+        Runs after the notices are recorded; a failure only shows in the
+        metrics, since recommendations can lag a tick and notices should not.
+        """
+        started = time.perf_counter()
+        self.metrics["last_tick_recommended"] = 0
+        self.metrics["last_tick_recommend_error"] = None
+        try:
+            self.metrics["last_tick_recommended"] = self.recommender.update(
+                self.max_batches, deadline=time.monotonic() + self.recommend_seconds)
+        except Exception as exc:
+            self.metrics["last_tick_recommend_error"] = f"{type(exc).__name__}: {exc}"
+        self.metrics["last_tick_recommend_seconds"] = time.perf_counter() - started
+
+    def run(self, interval=60, ticks=None, echo=print):
+        """Tick every `interval` seconds until interrupted (or `ticks` passes have run).
+
+        A failed tick is reported and the next one runs on schedule.
+        """
+        done = 0
+        try:
+            while ticks is None or done < ticks:
+                started = time.monotonic()
+                try:
+                    echo(self.format_metrics(self.tick()))
+                except Exception as exc:
+                    echo(f"[{_utcnow():%Y-%m-%d %H:%M:%S}] tick failed: {type(exc).__name__}: {exc}")
+                done += 1
+                if ticks is not None and done >= ticks:
+                    break
+                time.sleep(max(0.0, interval - (time.monotonic() - started)))
+        except KeyboardInterrupt:
+            echo("Scheduler stopped.")
+
+    def format_metrics(self, metrics):
+        notices = ", ".join(f"{kind}={count}" for kind, count in metrics["last_tick_notices"].items())
+        lag = ", ".join(f"{kind}={seconds:.0f}s" for kind, seconds in metrics["lag_seconds"].items())
+        if metrics["last_tick_recommend_error"]:
+            recommended = f"recommendations failed: {metrics['last_tick_recommend_error']}"
+        else:
+            recommended = (f"rentals folded into recommendations: {metrics['last_tick_recommended']} "
+                           f"in {metrics['last_tick_recommend_seconds'] * 1000:.1f} ms")
+        return (f"[{metrics['last_tick_at']:%Y-%m-%d %H:%M:%S}] tick {metrics['ticks']} "
+                f"in {metrics['last_tick_seconds'] * 1000:.1f} ms, notices: {notices}, lag: {lag}, {recommended}")
@@ -0,0 +1 @@
+from lib import audit  # noqa: F401  Registers the session listeners that feed the audit log
@@ -1,10 +1,38 @@
-from lib.models import Book
-from lib.database import get_session
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import bindparam, delete, func, or_, select
+from sqlalchemy.exc import IntegrityError
+from lib.models import Book, BookNeighbor, BookPair, Rental, Reservation, UserBook
+from lib import availability, database, matching
+from lib.cleanup import CLEANUP_BATCH_SIZE, archive_returned, delete_batches, open_rentals, referencing_rentals
+from lib.database import get_session, STREAM_BATCH_SIZE
+
+
+def _search_statement(by_title, by_author):
+    """Available books, filtered by case-insensitive substrings of title and/or author."""
+    # lower() LIKE lower() on every backend; patterns are escaped with '/' by _escape_like
+    query = select(Book).where(Book.available > 0)
+    if by_title:
+        query = query.where(Book.title.icontains(bindparam("title"), escape="/"))
+    if by_author:
+        query = query.where(Book.author.icontains(bindparam("author"), escape="/"))
+    return query
+
+# One prebuilt statement per filter combination, so searches reuse the compiled cache
+_SEARCHES = {(t, a): _search_statement(t, a) for t in (False, True) for a in (False, True)}
+
+
+def _escape_like(value):
+    """Keep '%', '_' and '/' literal in a LIKE pattern (what autoescape=True does)."""
+    return value.replace("/", "//").replace("%", "/%").replace("_", "/_")
 
 class BookService:
+    def __init__(self, branch=None):
+        # Branch database to work in; None means the main database
+        self.branch = branch
+
     def add_book(self, title, author, available, genres=None):
         """Add a new book to the system"""
-        session = get_session()
+        session = get_session(branch=self.branch)
         try:
             if not title or not author:
                 raise ValueError("Title and author are required.")
@@ -13,55 +41,121 @@ class BookService:
             
             book = Book(title=title, author=author, available=available, genres=genres)
             session.add(book)
+            session.flush()
+            read_at = availability.stamp()
             session.commit()
+            availability.note(book.id, available, self.branch, read_at)
             return f"Book '{title}' by '{author}' added successfully with ID: {book.id}"
         except ValueError as e:
             return str(e)
         finally:
             session.close()
 
-    def delete_book(self, book_id):
-        """Delete a book by its ID"""
-        session = get_session()
+    def delete_book(self, book_id, batch_size=CLEANUP_BATCH_SIZE):
+        """Delete a book with no copies out, with everything that refers to it.
+
+        Returned rentals move to the archive, and reservations, user_books rows
+        and co-rental statistics are deleted, all in batches. The book row goes last.
+        """
+        session = get_session(branch=self.branch)
         try:
-            book = session.get(Book, book_id)
-            if not book:
+            if session.get(Book, book_id) is None:
                 return f"Error: Book with ID {book_id} does not exist."
-            session.delete(book)
+            out = open_rentals(session, Rental.book_id == book_id)
+            if out:
+                return f"Error: Book ID {book_id} still has {out} open rental(s); they must be returned first."
+        finally:
+            session.close()
+
+        for model, condition in (
+            (Reservation, Reservation.book_id == book_id),
+            (UserBook, UserBook.book_id == book_id),
+            (BookNeighbor, or_(BookNeighbor.book_id == book_id, BookNeighbor.neighbor_id == book_id)),
+            (BookPair, or_(BookPair.book_a == book_id, BookPair.book_b == book_id)),
+        ):
+            delete_batches(model, condition, self.branch, batch_size)
+        archived = archive_returned(Rental.book_id == book_id, self.branch, batch_size)
+
+        session = get_session(branch=self.branch)
+        try:
+            # Every rental of it is archived by now, unless one was made meanwhile
+            if referencing_rentals(session, Rental.book_id == book_id):
+                return f"Error: Book ID {book_id} was rented while being deleted; try again once it is returned."
+            session.execute(delete(Book.__table__).where(Book.id == book_id))
+            read_at = availability.stamp()
             session.commit()
-            return f"Book ID {book_id} successfully deleted."
+        except IntegrityError:
+            session.rollback()
+            return f"Error: Book ID {book_id} was changed while being deleted; try again."
         finally:
             session.close()
+        matching.forget_book(book_id, self.branch)
+        availability.note(book_id, None, self.branch, read_at)
+        moved = f" {archived} returned rental(s) moved to the archive." if archived else ""
+        return f"Book ID {book_id} successfully deleted.{moved}"
 
     def list_books(self, sort_by=None):
         """List all books and allow sorting by genre or author"""
-        session = get_session()
-        query = session.query(Book).filter(Book.available > 0)
+        session = get_session(readonly=True, branch=self.branch)
+        query = select(Book.id, Book.title, Book.author, Book.genres).where(Book.available > 0)
         
         if sort_by == "genre":
             query = query.order_by(Book.genres)
         elif sort_by == "author":
             query = query.order_by(Book.author)
 
-        books = query.all()
-        session.close()
-        return [f"Book ID: {book.id}, Title: {book.title}, Author: {book.author}, Genre: {book.genres}" for book in books]
+        try:
+            books = session.execute(query.execution_options(yield_per=STREAM_BATCH_SIZE))
+            return [f"Book ID: {book.id}, Title: {book.title}, Author: {book.author}, Genre: {book.genres}" for book in books]
+        finally:
+            session.close()
     
+    def check_availability(self, book_ids):
+        """Copies on the shelf per book, from the availability snapshot when enabled"""
+        snapshot = availability.snapshot(self.branch)
+        if snapshot is not None:
+            counts = {book_id: snapshot.available(book_id) for book_id in book_ids}
+        else:
+            session = get_session(readonly=True, branch=self.branch)
+            try:
+                counts = dict(session.execute(
+                    select(Book.id, Book.available).where(Book.id.in_(book_ids))
+                ).tuples().all())
+            finally:
+                session.close()
+        return [
+            f"Error: Book with ID {book_id} does not exist." if counts.get(book_id) is None
+            else f"Book ID {book_id}: {counts[book_id]} copies available" if counts[book_id] > 0
+            else f"Book ID {book_id}: no copies available"
+            for book_id in book_ids
+        ]
+
+    def availability_summary(self):
+        """How many titles have a copy on the shelf, and how many copies that is"""
+        snapshot = availability.snapshot(self.branch)
+        if snapshot is not None:
+            titles, copies = snapshot.totals()
+        else:
+            session = get_session(readonly=True, branch=self.branch)
+            try:
+                titles, copies = session.execute(
+                    select(func.count(), func.coalesce(func.sum(Book.available), 0)).where(Book.available > 0)
+                ).one()
+            finally:
+                session.close()
+        return f"{titles} titles available, {copies} copies on the shelf."
+
     def search_books(self, title=None, author=None):
         """Search for books by title and/or author."""
-        session = get_session()
+        session = get_session(readonly=True, branch=self.branch)
         try:
-            query = session.query(Book).filter(Book.available > 0)  # Only search available books
-
-            # Filter by title if provided
+            # Only available books, filtered by title and/or author if provided
+            params = {}
             if title:
-                query = query.filter(Book.title.ilike(f'%{title}%'))
-            
-            # Filter by author if provided
+                params["title"] = _escape_like(title)
             if author:
-                query = query.filter(Book.author.ilike(f'%{author}%'))
-            
-            books = query.all()
+                params["author"] = _escape_like(author)
+            books = session.scalars(_SEARCHES[bool(title), bool(author)], params).all()
             session.close()
 
             return books  # Return the list of books
@@ -70,4 +164,31 @@ class BookService:
             session.rollback()  # Rollback in case of an error
             return str(e)
         finally:
-            session.close()
\ No newline at end of file
+            session.close()
+
+    def suggest_books(self, title=None, author=None, limit=5):
+        """Closest titles/authors for a search with no results, as (score, book_id, title, author)."""
+        return matching.matcher(self.branch).books(title, author, limit)
+
+    def search_all_branches(self, title=None, author=None, max_workers=8):
+        """Search every branch in parallel.
+
+        Returns (branch, book) pairs sorted by title, and (branch, error)
+        pairs for branches that failed; the others' results are kept.
+        """
+        branches = database.branch_names() or [None]
+
+        def search(branch):
+            try:
+                return branch, BookService(branch).search_books(title, author)
+            except Exception as e:  # Unreachable branch database
+                return branch, str(e)
+
+        matches, errors = [], []
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(branches))) as pool:
+            for branch, books in pool.map(search, branches):
+                if isinstance(books, str):  # Error message from that branch
+                    errors.append((branch, books))
+                else:
+                    matches.extend((branch, book) for book in books)
+        return sorted(matches, key=lambda pair: (pair[1].title.lower(), pair[0] or "")), errors
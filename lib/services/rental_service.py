@@ -1,91 +1,281 @@
-from sqlalchemy.orm import joinedload
-from lib.models import Rental, Book, User
+from collections import Counter
+from sqlalchemy import bindparam, select, update
+from lib.models import ArchivedRental, Rental, Book, User, UserBook, Reservation
 from datetime import datetime, timedelta, timezone
-from lib.database import get_session
+from lib.database import get_session, STREAM_BATCH_SIZE
+from lib.pricing import genres_of, rate_card
+from lib import availability, matching
+from lib.services.reservation_service import ReservationService
+
+BARCODE_PREFIX = "R"  # Rental slips carry barcodes like R00001234 (rental ID, zero-padded to 8 digits)
+
+# Hot-path statements, built once. Executing the same statement object reuses its
+# cache key and the engine's compiled SQL; only the bound values change per call.
+_READY_HOLD = (
+    select(Reservation)
+    .where(Reservation.user_id == bindparam("user_id"), Reservation.book_id == bindparam("book_id"),
+           Reservation.status == 'ready', Reservation.expires_at > bindparam("now"))
+    .limit(1)
+)
+_ACTIVE_RENTAL = (
+    select(Rental.id)
+    .where(Rental.user_id == bindparam("user_id"), Rental.book_id == bindparam("book_id"),
+           Rental.return_date.is_(None))
+    .limit(1)
+)
+_USER_BY_NAME = select(User).where(User.name == bindparam("name")).limit(1)
+_BOOK_BY_TITLE = select(Book).where(Book.title == bindparam("title")).limit(1).with_for_update()
+
+
+def _did_you_mean(names):
+    names = list(dict.fromkeys(names))
+    return f" Did you mean: {', '.join(repr(name) for name in names)}?" if names else ""
+
+
+def parse_rental_code(code):
+    """Rental ID from a plain ID or a scanned barcode, or None if it is neither."""
+    code = code.strip().upper()
+    if code.startswith(BARCODE_PREFIX):
+        code = code[len(BARCODE_PREFIX):]
+    return int(code) if code.isdigit() else None
 
 class RentalService:
-    def rent_book(self, user_id, book_id):
-        """Rent a book"""
-        session = get_session()
+    def __init__(self, branch=None):
+        # Branch database to work in; None means the main database
+        self.branch = branch
+
+    def rent_book(self, user_id, book_id, loan_days=None):
+        """Rent a book under the rate plan for its genre and the user's tier"""
+        session = get_session(branch=self.branch)
         try:
             user = session.get(User, user_id)
-            book = session.get(Book, book_id)
+            # Lock the book row (PostgreSQL) so concurrent rentals can't both take the last copy
+            book = session.get(Book, book_id, with_for_update=True)
 
             if not user:
                 return "Error: User not found."
             if not book:
                 return "Error: Book not found."
-            if book.available <= 0:
+
+            # A copy held for this user off the waitlist is already off the shelf
+            now = datetime.now(timezone.utc)
+            keys = {"user_id": user_id, "book_id": book_id}
+            hold = session.scalars(_READY_HOLD, {**keys, "now": now.replace(tzinfo=None)}).first()
+            if not hold and book.available <= 0:
                 return "Error: Book is unavailable."
             
             # Check if the user already has an active rental for this book
-            active_rental = session.query(Rental).filter_by(user_id=user_id, book_id=book_id, return_date=None).first()
+            active_rental = session.scalar(_ACTIVE_RENTAL, keys)
             if active_rental:
                 return f"Error: User '{user.name}' has already rented '{book.title}' and hasn't returned it yet."
 
+            # Priced from the in-memory rate card: no extra queries
+            plan = rate_card(self.branch).plan_for(genres_of(book.genres), user.tier, loan_days)
+            if plan is None:
+                return f"Error: No rate plan offers a {loan_days}-day loan of '{book.title}'."
+
             rental = Rental(
                 user_id=user_id,
                 book_id=book_id,
-                rent_date=datetime.now(timezone.utc),
-                due_date=datetime.now(timezone.utc) + timedelta(days=14)
+                rent_date=now,
+                due_date=now + timedelta(days=plan.loan_days),
+                rate_plan_id=plan.id
             )
-            # Update the user_books association table
-            user.books.append(book)
-            book.available -= 1
+            # Update the user_books association table without loading the user's whole collection
+            session.add(UserBook(user_id=user_id, book_id=book_id))
+            if hold:
+                hold.status = 'fulfilled'
+            else:
+                book.available -= 1
             
             session.add(rental)
+            copies, read_at = book.available, availability.stamp()
             session.commit()
+            availability.note(book_id, copies, self.branch, read_at)
             return f"User '{user.name}' rented book '{book.title}'"
         except Exception as e:
-            self.session.rollback()
+            session.rollback()
             raise e
         finally:
             session.close()
 
     def return_book(self, rental_id):
         """Return a book and calculate any penalties"""
-        session = get_session()
+        session = get_session(branch=self.branch)
         try:
-            rental = session.get(Rental, rental_id)
+            # Locked so two terminals can't return the same rental
+            rental = session.get(Rental, rental_id, with_for_update=True)
             if not rental or rental.return_date:
                 return "Error: Rental either doesn't exist or the book has already been returned."
             
             rental.return_date = datetime.now(timezone.utc)
-            rental.calculate_penalty()
+            rental.calculate_penalty(rate_card(self.branch).plan(rental.rate_plan_id))
 
-            book = session.get(Book, rental.book_id)
-            book.available += 1
+            # The copy goes to the next user on the waitlist, or back on the shelf
+            ready = ReservationService.allocate(session, rental.book_id)
+            book_id, copies = rental.book_id, session.get(Book, rental.book_id).available  # Loaded by allocate
+            read_at = availability.stamp()
             session.commit()
-            return f"Rental ID {rental_id} returned with a penalty of {rental.penalty} KSh."
+            availability.note(book_id, copies, self.branch, read_at)
+            result = f"Rental ID {rental_id} returned with a penalty of {rental.penalty} KSh."
+            if ready:
+                result += f" Copy held for user ID {ready[0].user_id} (reservation ID {ready[0].id})."
+            return result
+        except Exception:
+            session.rollback()
+            raise
         finally:
             session.close()
 
-    def list_rentals(self):
-        """List all rentals, sorting returned ones"""
-        session = get_session()
+    def return_batch(self, codes, chunk_size=500):
+        """Return many rentals from scanned codes; one outcome line per input code.
+
+        Each chunk is resolved with one query, stamped with one UPDATE,
+        priced from the rate card with one executemany UPDATE, and shelved
+        with one grouped increment per title; titles with a waitlist go
+        through ReservationService.allocate instead. Chunks commit
+        independently, so a failure only loses its own chunk.
+        """
+        outcomes = [None] * len(codes)
+        pending = []  # (line index, rental id)
+        seen = set()
+        for index, code in enumerate(codes):
+            rental_id = parse_rental_code(code)
+            if rental_id is None:
+                outcomes[index] = f"{code.strip()}: Error: not a rental ID or barcode."
+            elif rental_id in seen:
+                outcomes[index] = f"{code.strip()}: Error: duplicate of an earlier line."
+            else:
+                seen.add(rental_id)
+                pending.append((index, rental_id))
+
+        for start in range(0, len(pending), chunk_size):
+            chunk = pending[start:start + chunk_size]
+            try:
+                results = self._return_chunk([rental_id for _, rental_id in chunk])
+            except Exception as e:
+                results = {rental_id: f"Error: chunk rolled back ({type(e).__name__}: {e})" for _, rental_id in chunk}
+            for index, rental_id in chunk:
+                outcomes[index] = f"{codes[index].strip()}: {results[rental_id]}"
+        return outcomes
+
+    def _return_chunk(self, rental_ids):
+        session = get_session(branch=self.branch)
         try:
-            # Use joinedload to eagerly load the 'book' relationship
-            rentals = session.query(Rental).options(joinedload(Rental.book)).all()
+            now = datetime.now(timezone.utc).replace(tzinfo=None)
+            rows = session.execute(
+                select(Rental.id, Rental.book_id, Rental.return_date, Rental.due_date, Rental.rate_plan_id)
+                .where(Rental.id.in_(rental_ids))
+                .with_for_update()
+            ).all()
+            results = {rental_id: "Error: Rental doesn't exist." for rental_id in rental_ids}
+            open_rentals = {}
+            penalties = {}
+            card = rate_card(self.branch)
+            for row in rows:
+                if row.return_date:
+                    results[row.id] = "Error: Book has already been returned."
+                else:
+                    open_rentals[row.id] = row.book_id
+                    penalties[row.id] = card.plan(row.rate_plan_id).penalty(row.due_date, now)
+            if not open_rentals:
+                return results
 
-            # Separate returned and active rentals
-            returned_rentals = [rental for rental in rentals if rental.return_date is not None]
-            active_rentals = [rental for rental in rentals if rental.return_date is None]
+            stamped = session.execute(
+                update(Rental)
+                .where(Rental.id.in_(list(open_rentals)), Rental.return_date.is_(None))
+                .values(return_date=now)
+                .execution_options(synchronize_session=False)
+            )
+            if stamped.rowcount != len(open_rentals):
+                # Another terminal returned one of these since we read them; redo the chunk one by one
+                session.rollback()
+                return {**results, **{rental_id: self.return_book(rental_id) for rental_id in open_rentals}}
+            rentals = Rental.__table__
+            session.execute(
+                update(rentals).where(rentals.c.id == bindparam("r_id")).values(penalty=bindparam("r_penalty")),
+                [{"r_id": rental_id, "r_penalty": penalty} for rental_id, penalty in penalties.items()],
+            )
 
-            # Sort returned rentals by return_date (oldest to newest)
-            returned_rentals_sorted = sorted(returned_rentals, key=lambda r: r.return_date)
+            # Copies per title; titles with a waitlist hand them to the queue first
+            copies = Counter(open_rentals.values())
+            queued = set(session.scalars(
+                select(Reservation.book_id).distinct()
+                .where(Reservation.book_id.in_(list(copies)), Reservation.status == 'waiting')
+            ))
+            held = {}
+            for book_id in sorted(queued):
+                ready = ReservationService.allocate(session, book_id, copies=copies[book_id], now=now)
+                held[book_id] = [(reservation.user_id, reservation.id) for reservation in ready]
+            shelved = [{"b_id": book_id, "b_copies": count} for book_id, count in copies.items() if book_id not in queued]
+            if shelved:
+                books = Book.__table__
+                session.execute(
+                    update(books).where(books.c.id == bindparam("b_id"))
+                    .values(available=books.c.available + bindparam("b_copies")),
+                    shelved,
+                )
+            shelves = []
+            if availability.snapshot_loaded(self.branch):
+                shelves = session.execute(select(Book.id, Book.available).where(Book.id.in_(list(copies)))).all()
+            read_at = availability.stamp()
 
-            # Prepare the result for display
-            result = []
+            session.commit()
+            for book_id, available in shelves:
+                availability.note(book_id, available, self.branch, read_at)
+
+            for rental_id, book_id in open_rentals.items():
+                result = f"Rental ID {rental_id} returned with a penalty of {float(penalties[rental_id])} KSh."
+                if held.get(book_id):
+                    user_id, reservation_id = held[book_id].pop(0)
+                    result += f" Copy held for user ID {user_id} (reservation ID {reservation_id})."
+                results[rental_id] = result
+            return results
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def list_rentals(self, archived=0):
+        """List open and returned rentals, plus the latest `archived` ones from the archive"""
+        session = get_session(readonly=True, branch=self.branch)
+        try:
+            columns = (Rental.id, Rental.user_id, Book.title, Rental.return_date)
+            streamed = {"yield_per": STREAM_BATCH_SIZE}
 
             # First, display active rentals
-            result.append("Active Rentals:")
-            for rental in active_rentals:
-                result.append(f"Rental ID: {rental.id}, User ID: {rental.user_id}, Book: {rental.book.title}")
+            result = ["Active Rentals:"]
+            active = (
+                select(*columns).join(Book, Book.id == Rental.book_id)
+                .where(Rental.return_date.is_(None)).order_by(Rental.id)
+            )
+            for rental in session.execute(active.execution_options(**streamed)):
+                result.append(f"Rental ID: {rental.id}, User ID: {rental.user_id}, Book: {rental.title}")
+
+            # Then the latest archived returns: a short walk back along ix_rentals_archive_returned,
+            # however long the archive has grown. Outer join: their book may have been deleted since
+            if archived:
+                result.append(f"\nArchived Rentals (latest {archived}, sorted by return date):")
+                latest = (
+                    select(ArchivedRental.id, ArchivedRental.user_id, ArchivedRental.book_id, Book.title,
+                           ArchivedRental.return_date)
+                    .outerjoin(Book, Book.id == ArchivedRental.book_id)
+                    .order_by(ArchivedRental.return_date.desc(), ArchivedRental.id.desc())
+                    .limit(archived)
+                )
+                for rental in reversed(session.execute(latest).all()):
+                    title = rental.title if rental.title is not None else f"(deleted book ID {rental.book_id})"
+                    result.append(f"Rental ID: {rental.id}, User ID: {rental.user_id}, Book: {title}, Returned on: {rental.return_date}")
 
-            # Then, display returned rentals (sorted)
+            # Then returned rentals not yet archived, sorted by return_date (oldest to newest)
             result.append("\nReturned Rentals (sorted by return date):")
-            for rental in returned_rentals_sorted:
-                result.append(f"Rental ID: {rental.id}, User ID: {rental.user_id}, Book: {rental.book.title}, Returned on: {rental.return_date}")
+            returned = (
+                select(*columns).join(Book, Book.id == Rental.book_id)
+                .where(Rental.return_date.is_not(None)).order_by(Rental.return_date)
+            )
+            for rental in session.execute(returned.execution_options(**streamed)):
+                result.append(f"Rental ID: {rental.id}, User ID: {rental.user_id}, Book: {rental.title}, Returned on: {rental.return_date}")
 
             return result
         finally:
@@ -93,32 +283,44 @@ class RentalService:
     
     def rent_book_by_name(self, user_name, book_title, days_rented_ago=0, due_days_ago=0):
         """Rent a book by user name and book title (for seed data purposes)"""
-        session = get_session()
+        session = get_session(branch=self.branch)
         try:
-            user = session.query(User).filter_by(name=user_name).first()
-            book = session.query(Book).filter_by(title=book_title).first()
+            user = session.scalars(_USER_BY_NAME, {"name": user_name}).first()
+            book = session.scalars(_BOOK_BY_TITLE, {"title": book_title}).first()
 
+            # No exact match: take a clear best fuzzy match, or suggest the closest ones
             if not user:
-                return f"Error: User '{user_name}' not found."
+                candidates = matching.matcher(self.branch).user_names(user_name)
+                best = matching.pick(user_name, candidates)
+                user = session.get(User, best[1]) if best else None
+                if not user:
+                    return f"Error: User '{user_name}' not found.{_did_you_mean(name for _, _, name in candidates)}"
             if not book:
-                return f"Error: Book '{book_title}' not found."
+                candidates = matching.matcher(self.branch).books(title=book_title)
+                best = matching.pick(book_title, candidates)
+                book = session.get(Book, best[1], with_for_update=True) if best else None
+                if not book:
+                    return f"Error: Book '{book_title}' not found.{_did_you_mean(title for _, _, title, _ in candidates)}"
             if book.available <= 0:
-                return f"Error: Book '{book_title}' is unavailable."
+                return f"Error: Book '{book.title}' is unavailable."
 
             # Create the rental
+            plan = rate_card(self.branch).plan_for(genres_of(book.genres), user.tier)
             rent_date = datetime.now(timezone.utc) - timedelta(days=days_rented_ago)
-            due_date = datetime.now(timezone.utc) - timedelta(days=due_days_ago) if due_days_ago > 0 else rent_date + timedelta(days=14)
+            due_date = datetime.now(timezone.utc) - timedelta(days=due_days_ago) if due_days_ago > 0 else rent_date + timedelta(days=plan.loan_days)
 
-            rental = Rental(user_id=user.id, book_id=book.id, rent_date=rent_date, due_date=due_date)
+            rental = Rental(user_id=user.id, book_id=book.id, rent_date=rent_date, due_date=due_date, rate_plan_id=plan.id)
             session.add(rental)
             book.available -= 1
 
             # If the book is overdue, simulate the return and calculate penalty
             if due_days_ago > 0:
                 rental.return_date = datetime.now(timezone.utc)  # Simulate return
-                rental.calculate_penalty()
+                rental.calculate_penalty(plan)
 
+            book_id, copies, read_at = book.id, book.available, availability.stamp()
             session.commit()
+            availability.note(book_id, copies, self.branch, read_at)
 
             if due_days_ago > 0:
                 return f"Book '{book.title}' rented by {user.name} with a penalty for late return."
@@ -0,0 +1,188 @@
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import bindparam, select
+from lib.models import Reservation, Rental, Book, User
+from lib.database import get_session
+from lib import notifications
+
+WAITLIST_DAYS = 30  # How long a place in the queue is kept
+HOLD_DAYS = 3       # How long a returned copy is held for the next user
+
+# Built once so each call reuses the cached compiled statement (see rental_service)
+_ACTIVE_RENTAL = (
+    select(Rental.id)
+    .where(Rental.user_id == bindparam("user_id"), Rental.book_id == bindparam("book_id"),
+           Rental.return_date.is_(None))
+    .limit(1)
+)
+_OPEN_RESERVATION = (
+    select(Reservation)
+    .where(Reservation.user_id == bindparam("user_id"), Reservation.book_id == bindparam("book_id"),
+           Reservation.status.in_(('waiting', 'ready')))
+    .limit(1)
+)
+
+
+def _utcnow():
+    # Naive UTC, comparable with the DateTime values SQLite returns
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class ReservationService:
+    def __init__(self, branch=None):
+        # Branch database to work in; None means the main database
+        self.branch = branch
+
+    def reserve_book(self, user_id, book_id):
+        """Join the waitlist for a book that has no copies on the shelf"""
+        session = get_session(branch=self.branch)
+        try:
+            user = session.get(User, user_id)
+            book = session.get(Book, book_id)
+
+            if not user:
+                return "Error: User not found."
+            if not book:
+                return "Error: Book not found."
+            if book.available > 0:
+                return f"Error: '{book.title}' is available, rent it directly."
+
+            keys = {"user_id": user_id, "book_id": book_id}
+            active_rental = session.scalar(_ACTIVE_RENTAL, keys)
+            if active_rental:
+                return f"Error: User '{user.name}' already has '{book.title}'."
+
+            existing = session.scalars(_OPEN_RESERVATION, keys).first()
+            if existing:
+                return f"Error: User '{user.name}' already has reservation ID {existing.id} for '{book.title}'."
+
+            now = _utcnow()
+            reservation = Reservation(user_id=user_id, book_id=book_id, created_at=now,
+                                      expires_at=now + timedelta(days=WAITLIST_DAYS), status='waiting')
+            session.add(reservation)
+            session.commit()
+            return f"User '{user.name}' joined the waitlist for '{book.title}' with reservation ID: {reservation.id}"
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def cancel_reservation(self, reservation_id):
+        """Cancel a waiting or ready reservation, passing a held copy on"""
+        session = get_session(branch=self.branch)
+        try:
+            reservation = session.get(Reservation, reservation_id)
+            if not reservation or reservation.status not in ('waiting', 'ready'):
+                return "Error: Reservation either doesn't exist or is no longer open."
+
+            held = reservation.status == 'ready'
+            reservation.status = 'cancelled'
+            if held:
+                self.allocate(session, reservation.book_id)
+            session.commit()
+            return f"Reservation ID {reservation_id} cancelled."
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def list_reservations(self, book_id):
+        """List the open reservations for a book in queue order"""
+        session = get_session(readonly=True, branch=self.branch)
+        try:
+            reservations = (
+                session.query(Reservation)
+                .filter(Reservation.book_id == book_id, Reservation.status.in_(('waiting', 'ready')))
+                .order_by(Reservation.id)
+                .all()
+            )
+            if not reservations:
+                return "No open reservations for this book."
+            return [
+                f"Reservation ID: {r.id}, User ID: {r.user_id}, Status: {r.status}, Expires: {r.expires_at}"
+                for r in reservations
+            ]
+        finally:
+            session.close()
+
+    def expire_reservations(self):
+        """Expire lapsed waitlist places and release uncollected holds"""
+        session = get_session(branch=self.branch)
+        try:
+            now = _utcnow()
+            lapsed = (
+                session.query(Reservation)
+                .filter(Reservation.status.in_(('waiting', 'ready')), Reservation.expires_at <= now)
+                .all()
+            )
+            released = 0
+            for reservation in lapsed:
+                if reservation.status == 'ready':
+                    released += 1
+                    reservation.status = 'expired'
+                    self.allocate(session, reservation.book_id, now=now)
+                else:
+                    reservation.status = 'expired'
+            session.commit()
+            return f"Expired {len(lapsed)} reservations, released {released} held copies."
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    @staticmethod
+    def next_waiting(session, book_id, now=None):
+        """Return the first live 'waiting' reservation for a book, expiring stale ones on the way"""
+        now = now or _utcnow()
+        while True:
+            # SKIP LOCKED (PostgreSQL) lets concurrent returns of the same title
+            # each take a different waiter instead of queueing behind each other
+            reservation = (
+                session.query(Reservation)
+                .filter(Reservation.book_id == book_id, Reservation.status == 'waiting')
+                .order_by(Reservation.id)
+                .with_for_update(skip_locked=True)
+                .first()
+            )
+            if reservation is None or reservation.expires_at > now:
+                return reservation
+            reservation.status = 'expired'
+
+    @staticmethod
+    def allocate(session, book_id, copies=1, now=None):
+        """Hand returned copies of a book to the waitlist, shelving whatever is left.
+
+        Runs inside the caller's session so the return and the allocation
+        commit together. Returns the reservations that became ready.
+        """
+        now = now or _utcnow()
+        book = session.get(Book, book_id, with_for_update=True)
+        ready = []
+        while len(ready) < copies:
+            reservation = ReservationService.next_waiting(session, book_id, now)
+            if reservation is None:
+                break
+            reservation.status = 'ready'
+            reservation.expires_at = now + timedelta(days=HOLD_DAYS)
+            ready.append(reservation)
+
+        leftover = copies - len(ready)
+        if leftover:
+            book.available += leftover
+        session.flush()
+
+        # Tell each new holder through the outbox, committed with the allocation
+        notices = []
+        for reservation in ready:
+            user = session.get(User, reservation.user_id)
+            notices.append({
+                "user_id": user.id, "email": user.email, "kind": "reservation_ready",
+                "subject": f"'{book.title}' is ready for collection",
+                "body": f"Hello {user.name}, a copy of '{book.title}' is being held for you "
+                        f"until {reservation.expires_at:%Y-%m-%d}.",
+                "dedup_key": f"reservation_ready:{reservation.id}:{reservation.expires_at:%Y%m%d%H%M%S}",  # One per hold
+            })
+        notifications.enqueue(session, notices)
+        return ready
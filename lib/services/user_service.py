@@ -1,10 +1,74 @@
-from lib.models import User
+from datetime import datetime, timezone
+from lib.models import Book, Notification, Rental, RentalNotice, Reservation, User, UserBook
+from sqlalchemy import and_, case, delete, func, select
 from sqlalchemy.exc import IntegrityError
-from lib.database import get_session
+from lib import database, matching
+from lib.database import get_session, STREAM_BATCH_SIZE
+from lib.archive import rental_history
+from lib.pricing import rate_card
+from lib.cleanup import CLEANUP_BATCH_SIZE, archive_returned, delete_batches, open_rentals, referencing_rentals
+from lib.services.reservation_service import ReservationService
 
 class UserService:
+    def __init__(self, branch=None):
+        # Branch database for rental data; users themselves are always global
+        self.branch = branch
+
+    @staticmethod
+    def _databases():
+        """Branch ids of every database holding user copies and rentals; None is the main one, first"""
+        return [None] + [
+            branch for branch in database.branch_names() if database.branch_engine(branch) is not database.engine
+        ]
+
+    def _replicate(self, write):
+        """Apply write(session) to every branch database that isn't the main one.
+
+        A branch that fails doesn't stop the others; returns {branch: error} for those that did.
+        """
+        failed = {}
+        for branch in self._databases()[1:]:
+            session = get_session(branch=branch)
+            try:
+                write(session)
+                session.commit()
+            except Exception as error:
+                session.rollback()
+                failed[branch] = error
+            finally:
+                session.close()
+        return failed
+
+    @staticmethod
+    def _failures(failed):
+        return ", ".join(f"branch '{branch}' ({getattr(error, 'orig', error)})" for branch, error in failed.items())
+
+    def sync_users(self, branch, batch_size=STREAM_BATCH_SIZE):
+        """Copy every global user into a branch database, e.g. after adding the branch"""
+        source = get_session()
+        target = get_session(branch=branch)
+        try:
+            copied = 0
+            query = select(User.id, User.name, User.email, User.tier).order_by(User.id)
+            for batch in source.execute(query.execution_options(yield_per=batch_size)).partitions():
+                for row in batch:
+                    target.merge(User(id=row.id, name=row.name, email=row.email, tier=row.tier))
+                target.commit()
+                copied += len(batch)
+            return f"Synced {copied} users into branch '{branch}'."
+        except Exception:
+            target.rollback()
+            raise
+        finally:
+            source.close()
+            target.close()
+
     def add_user(self, name, email):
-        """Add a new user to the system"""
+        """Add a new user to the system, and a copy to every branch.
+
+        If a branch can't take its copy the user is removed again everywhere,
+        rather than left unable to rent there.
+        """
         session = get_session()
         try:
             if not name or not email:
@@ -12,49 +76,188 @@ class UserService:
             user = User(name=name, email=email)
             session.add(user)
             session.commit()
-            return f"User '{name}' added successfully with ID: {user.id}"
+            user_id = user.id
         except IntegrityError:
             session.rollback()
             return "Error: Email already exists."
         finally:
             session.close()
 
-    def delete_user(self, user_id):
-        """Delete a user by their ID"""
+        # Same id in every branch so branch rentals can reference the user
+        failed = self._replicate(lambda branch_session: branch_session.merge(User(id=user_id, name=name, email=email)))
+        if not failed:
+            return f"User '{name}' added successfully with ID: {user_id}"
+        # Ids are never reused, so a copy a failing branch still holds can't be mistaken for a later user
+        self._replicate(lambda branch_session: branch_session.execute(delete(User).where(User.id == user_id)))
+        session = get_session()
+        try:
+            session.execute(delete(User).where(User.id == user_id))
+            session.commit()
+        finally:
+            session.close()
+        return f"Error: User '{name}' was not added: copying them to {self._failures(failed)} failed."
+
+    def delete_user(self, user_id, batch_size=CLEANUP_BATCH_SIZE):
+        """Delete a user who has no books out, with everything that refers to them.
+
+        In every database, open reservations are cancelled (passing held copies
+        on), returned rentals move to the archive, and reservations, notices,
+        notifications and user_books rows are deleted, all in batches. The user
+        rows go last.
+        """
+        session = get_session()
+        try:
+            if session.get(User, user_id) is None:
+                return f"Error: User with ID {user_id} does not exist."
+        finally:
+            session.close()
+
+        databases = self._databases()
+        for branch in databases:
+            session = get_session(branch=branch)
+            try:
+                out = open_rentals(session, Rental.user_id == user_id)
+            finally:
+                session.close()
+            if out:
+                return f"Error: User ID {user_id} still has {out} open rental(s); they must be returned first."
+
+        archived = 0
+        for branch in databases:
+            session = get_session(branch=branch)
+            try:
+                holds = session.scalars(select(Reservation.id).where(
+                    Reservation.user_id == user_id, Reservation.status.in_(('waiting', 'ready')))).all()
+            finally:
+                session.close()
+            for reservation_id in holds:
+                ReservationService(branch).cancel_reservation(reservation_id)
+            for model in (Reservation, RentalNotice, Notification, UserBook):
+                delete_batches(model, model.user_id == user_id, branch, batch_size)
+            archived += archive_returned(Rental.user_id == user_id, branch, batch_size)
+
+        for branch in reversed(databases):  # The main database last
+            session = get_session(branch=branch)
+            try:
+                # Every rental of theirs is archived by now, unless one was made meanwhile
+                if referencing_rentals(session, Rental.user_id == user_id):
+                    return f"Error: User ID {user_id} rented a book while being deleted; try again once it is returned."
+                session.execute(delete(User.__table__).where(User.id == user_id))
+                session.commit()
+            except IntegrityError:
+                session.rollback()
+                return f"Error: User ID {user_id} was changed while being deleted; try again."
+            finally:
+                session.close()
+        matching.forget_user(user_id)
+        moved = f" {archived} returned rental(s) moved to the archive." if archived else ""
+        return f"User ID {user_id} successfully deleted.{moved}"
+
+    def set_tier(self, user_id, tier):
+        """Change a user's membership tier, which picks their rate plans"""
         session = get_session()
         try:
             user = session.get(User, user_id)
             if not user:
                 return f"Error: User with ID {user_id} does not exist."
-            session.delete(user)
+            if not tier:
+                return "Error: Tier is required."
+            user.tier = tier
             session.commit()
-            return f"User ID {user_id} successfully deleted."
+
+            def set_copy(branch_session):
+                copy = branch_session.get(User, user_id)
+                if copy:
+                    copy.tier = tier
+            failed = self._replicate(set_copy)
+            if failed:
+                return (f"User ID {user_id} is now on the '{tier}' tier, but not yet in {self._failures(failed)}; "
+                        f"run sync-users for it.")
+            return f"User ID {user_id} is now on the '{tier}' tier."
         finally:
             session.close()
 
     def list_users(self):
         """List all users"""
-        session = get_session()
-        users = session.query(User).all()
-        session.close()
+        session = get_session(readonly=True)
+        try:
+            query = select(User.id, User.name, User.email).order_by(User.id)
+            users = [
+                f"User ID: {user.id}, Name: {user.name}, Email: {user.email}"
+                for user in session.execute(query.execution_options(yield_per=STREAM_BATCH_SIZE))
+            ]
+        finally:
+            session.close()
         if users:
-            return [f"User ID: {user.id}, Name: {user.name}, Email: {user.email}" for user in users]
+            return users
         return "No users found."
     
     def find_by_name(self, name):
         """Find users by name"""
-        session = get_session()
+        session = get_session(readonly=True)
         try:
-            users = session.query(User).filter(User.name.ilike(f"%{name}%")).all()
+            users = session.query(User).filter(User.name.icontains(name, autoescape=True)).all()
             return users
         finally:
             session.close()
 
     def find_by_email(self, email):
         """Find users by email"""
-        session = get_session()
+        session = get_session(readonly=True)
         try:
-            users = session.query(User).filter(User.email.ilike(f"%{email}%")).all()
+            users = session.query(User).filter(User.email.icontains(email, autoescape=True)).all()
             return users
         finally:
             session.close()
+
+    def account_summary(self, user_id, limit=10, offset=0):
+        """Summarize a user's rentals, archived ones included: one aggregate query plus one page of recent rentals"""
+        session = get_session(readonly=True, branch=self.branch)
+        try:
+            now = datetime.now(timezone.utc).replace(tzinfo=None)
+            history = rental_history(user_id=user_id)
+            is_active = history.c.return_date.is_(None)
+            totals = session.execute(
+                select(
+                    User.id, User.name, User.email,
+                    func.count(history.c.id).label("total_rentals"),
+                    func.coalesce(func.sum(case((is_active, 1), else_=0)), 0).label("active_rentals"),
+                    func.coalesce(func.sum(case((and_(is_active, history.c.due_date < now), 1), else_=0)), 0).label("overdue_rentals"),
+                    func.coalesce(func.sum(history.c.penalty), 0.0).label("penalties"),
+                )
+                .outerjoin(history, history.c.user_id == User.id)
+                .where(User.id == user_id)
+                .group_by(User.id, User.name, User.email)
+            ).first()
+            if totals is None:
+                return f"Error: User with ID {user_id} does not exist."
+
+            # "penalties" is what returns have been charged, ever. Overdue rentals still out
+            # add to it daily; price them as if returned now (they are never archived)
+            accruing = 0.0
+            if totals.overdue_rentals:
+                card = rate_card(self.branch)
+                for due_date, plan_id in session.execute(
+                    select(Rental.due_date, Rental.rate_plan_id)
+                    .where(Rental.user_id == user_id, Rental.return_date.is_(None), Rental.due_date < now)
+                ):
+                    accruing += card.plan(plan_id).penalty(due_date, now)
+
+            recent = session.execute(
+                select(history.c.id, history.c.book_id, Book.title, history.c.rent_date, history.c.due_date,
+                       history.c.return_date, history.c.penalty)
+                .outerjoin(Book, Book.id == history.c.book_id)  # Archived rentals can outlive their book
+                .order_by(history.c.rent_date.desc(), history.c.id.desc())
+                .limit(limit)
+                .offset(offset)
+            ).all()
+
+            summary = totals._asdict()
+            summary["accruing_penalties"] = accruing
+            summary["recent_rentals"] = [
+                {**row._asdict(), "title": row.title if row.title is not None else f"(deleted book ID {row.book_id})"}
+                for row in recent
+            ]
+            return summary
+        finally:
+            session.close()
@@ -0,0 +1,351 @@
+"""Load test: counter terminals running a mix of service calls at once.
+
+Each terminal is a thread (or, with --processes, a process with its own
+engine) that loops over rent_book, return_book, search_books and
+check_availability picked by weight from --mix, as fast as it can or with
+--think-ms between calls. Books are picked with Zipf weights (low ids
+hottest), so hot titles see the row contention a real counter would.
+
+Every call is timed end to end. A call that fails because the database
+is busy (SQLite "database is locked", PostgreSQL deadlocks, serialization
+failures and lock timeouts) is retried with backoff up to --retries
+times. Those retries are counted, and the time spent in the failed attempts
+and the backoff is reported as lock wait. Waits that end within SQLite's
+busy timeout (--busy-timeout) show up only as latency.
+Calls that return an "Error: ..." message (book unavailable, already
+returned) are counted as rejected, not as errors.
+
+By default the run goes against a fresh synthetic database in a temporary
+directory; --database-url points it at an existing one, which it writes to.
+"""
+import json
+import multiprocessing
+import os
+import queue
+import random
+import tempfile
+import threading
+import time
+from bisect import bisect
+from itertools import accumulate
+
+import click
+from sqlalchemy import func, select
+from sqlalchemy.exc import DBAPIError
+
+from generate_data import DataGenerator
+from lib import database
+from lib.models import Book, Rental, User
+from lib.services.book_service import BookService
+from lib.services.rental_service import RentalService
+
+OPERATIONS = ("rent", "return", "search", "availability")
+SEND_SECONDS = 0.5   # How often terminals hand their samples to the collector
+
+# PostgreSQL: serialization_failure, deadlock_detected, lock_not_available
+_PG_BUSY_CODES = {"40001", "40P01", "55P03"}
+
+
+def _is_busy(error):
+    """Whether a failed call could succeed on retry once the competing transaction is done."""
+    if isinstance(error, DBAPIError):
+        if getattr(error.orig, "pgcode", None) in _PG_BUSY_CODES:
+            return True
+        error = error.orig
+    return "database is locked" in str(error) or "database table is locked" in str(error)
+
+
+def _engine_options(url, busy_timeout):
+    return {"connect_args": {"timeout": busy_timeout}} if url.startswith("sqlite") else {}
+
+
+def parse_mix(text):
+    """'rent=4,return=4,search=2' -> [('rent', 4.0), ('return', 4.0), ('search', 2.0)]."""
+    mix = []
+    for entry in text.split(","):
+        name, _, weight = entry.partition("=")
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise click.BadParameter(f"Unknown operation '{name}', expected one of {', '.join(OPERATIONS)}.")
+        mix.append((name, float(weight or 1)))
+    return mix
+
+
+def _percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))] if ordered else 0.0
+
+
+# ---------- terminals ----------
+
+class Terminal:
+    """One counter terminal: picks operations and targets, times the service calls."""
+
+    def __init__(self, number, settings):
+        self.settings = settings
+        self.rng = random.Random(settings["seed"] * 1000 + number)
+        self.rentals = RentalService()
+        self.books = BookService()
+        self.mine = []  # (user_id, book_id) of rentals this terminal made and hasn't returned
+        self._operations = [name for name, _ in settings["mix"]]
+        self._operation_weights = list(accumulate(weight for _, weight in settings["mix"]))
+        self._book_weights = list(accumulate(1 / rank ** settings["zipf_s"]
+                                             for rank in range(1, settings["books"] + 1)))
+
+    def _book(self):
+        point = self.rng.random() * self._book_weights[-1]
+        return min(bisect(self._book_weights, point), len(self._book_weights) - 1) + 1
+
+    def _open_rental(self):
+        """A rental to return: one of ours, else any open one. Looked up outside the timed call."""
+        session = database.get_session()
+        try:
+            if self.mine:
+                user_id, book_id = self.mine.pop(self.rng.randrange(len(self.mine)))
+                rental_id = session.scalar(select(Rental.id).where(
+                    Rental.user_id == user_id, Rental.book_id == book_id, Rental.return_date.is_(None)))
+                if rental_id is not None:
+                    return rental_id
+            start = self.rng.randint(1, self.settings["max_rental_id"])
+            return session.scalar(select(Rental.id).where(Rental.id >= start, Rental.return_date.is_(None))
+                                  .order_by(Rental.id).limit(1))
+        finally:
+            session.close()
+
+    def prepare(self, operation):
+        """Arguments for one call, chosen before the clock starts."""
+        if operation == "rent":
+            return self.rng.randint(1, self.settings["users"]), self._book()
+        if operation == "return":
+            return (self._open_rental(),)
+        if operation == "search":
+            return (self.rng.choice(self.settings["words"]),)
+        return ([self._book() for _ in range(self.rng.randint(1, 5))],)
+
+    def call(self, operation, arguments):
+        if operation == "rent":
+            result = self.rentals.rent_book(*arguments)
+            if not result.startswith("Error"):
+                self.mine.append(arguments)
+            return result
+        if operation == "return":
+            if arguments[0] is None:
+                return "Error: No open rentals."
+            return self.rentals.return_book(*arguments)
+        if operation == "search":
+            result = self.books.search_books(title=arguments[0])
+            if isinstance(result, str):  # search_books hands back the exception text
+                raise RuntimeError(result)
+            return result
+        return self.books.check_availability(*arguments)
+
+    def run_one(self):
+        """Do one operation; return a sample (finished_at, operation, seconds, outcome, retries, lock_wait)."""
+        rng, settings = self.rng, self.settings
+        operation = self._operations[bisect(self._operation_weights, rng.random() * self._operation_weights[-1])]
+        arguments = self.prepare(operation)
+        retries, lock_wait = 0, 0.0
+        started = time.perf_counter()
+        while True:
+            attempt = time.perf_counter()
+            try:
+                result = self.call(operation, arguments)
+                outcome = "rejected" if isinstance(result, str) and result.startswith("Error") else "ok"
+                break
+            except Exception as error:
+                if not _is_busy(error):
+                    outcome = f"error: {type(error).__name__}"
+                    break
+                if retries >= settings["retries"]:
+                    outcome = "error: busy"
+                    break
+                retries += 1
+                pause = settings["backoff"] * 2 ** (retries - 1) * (0.5 + rng.random())
+                time.sleep(pause)
+                lock_wait += time.perf_counter() - attempt
+        return time.time(), operation, time.perf_counter() - started, outcome, retries, lock_wait
+
+
+def _terminal(number, settings, stop_at, samples, url=None):
+    """Run one terminal until stop_at (wall clock), handing samples over in batches; None when done."""
+    if url is not None:  # A process of its own: open its own engine
+        database.configure(url, **_engine_options(url, settings["busy_timeout"]))
+    terminal = Terminal(number, settings)
+    pending, sent = [], time.monotonic()
+    try:
+        while time.time() < stop_at:
+            pending.append(terminal.run_one())
+            if settings["think"]:
+                time.sleep(terminal.rng.expovariate(1 / settings["think"]))
+            if time.monotonic() - sent >= SEND_SECONDS:
+                samples.put(pending)
+                pending, sent = [], time.monotonic()
+    finally:
+        samples.put(pending)
+        samples.put(None)
+
+
+# ---------- reporting ----------
+
+def summarize(samples, seconds):
+    """Per-operation and overall totals over samples."""
+    groups = {operation: [] for operation in OPERATIONS}
+    for sample in samples:
+        groups[sample[1]].append(sample)
+    groups = {operation: group for operation, group in groups.items() if group}
+    groups["all"] = samples
+    summary = {}
+    for operation, group in groups.items():
+        latencies = [sample[2] for sample in group]
+        errors = [sample[3] for sample in group if sample[3].startswith("error")]
+        summary[operation] = {
+            "count": len(group),
+            "per_second": len(group) / seconds if seconds else 0.0,
+            "p50_ms": _percentile(latencies, 50) * 1000,
+            "p95_ms": _percentile(latencies, 95) * 1000,
+            "p99_ms": _percentile(latencies, 99) * 1000,
+            "max_ms": max(latencies, default=0.0) * 1000,
+            "rejected": sum(1 for sample in group if sample[3] == "rejected"),
+            "errors": len(errors),
+            "error_kinds": {kind: errors.count(kind) for kind in set(errors)},
+            "busy_retries": sum(sample[4] for sample in group),
+            "lock_wait_seconds": sum(sample[5] for sample in group),
+        }
+    return summary
+
+
+def _interval_line(index, interval, samples):
+    latencies = [sample[2] for sample in samples]
+    return {
+        "second": (index + 1) * interval,
+        "per_second": len(samples) / interval,
+        "p50_ms": _percentile(latencies, 50) * 1000,
+        "p99_ms": _percentile(latencies, 99) * 1000,
+        "rejected": sum(1 for sample in samples if sample[3] == "rejected"),
+        "errors": sum(1 for sample in samples if sample[3].startswith("error")),
+        "busy_retries": sum(sample[4] for sample in samples),
+    }
+
+
+def _echo_interval(line):
+    click.echo(f"{line['second']:6.0f}s {line['per_second']:8.1f} ops/s  p50 {line['p50_ms']:7.2f} ms  "
+               f"p99 {line['p99_ms']:8.2f} ms  rejected {line['rejected']:4d}  errors {line['errors']:3d}  "
+               f"busy retries {line['busy_retries']:4d}")
+
+
+def _echo_summary(summary):
+    click.echo(f"\n{'operation':<13}{'count':>8}{'ops/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}"
+               f"{'rejected':>10}{'errors':>8}{'retries':>9}{'lock wait s':>13}")
+    for operation, stats in summary.items():
+        click.echo(f"{operation:<13}{stats['count']:>8}{stats['per_second']:>9.1f}{stats['p50_ms']:>9.2f}"
+                   f"{stats['p95_ms']:>9.2f}{stats['p99_ms']:>9.2f}{stats['max_ms']:>9.1f}"
+                   f"{stats['rejected'] / max(stats['count'], 1):>10.1%}{stats['errors'] / max(stats['count'], 1):>8.1%}"
+                   f"{stats['busy_retries']:>9}{stats['lock_wait_seconds']:>13.2f}")
+    for kind, count in sorted(summary["all"]["error_kinds"].items()):
+        click.echo(f"  {kind}: {count}")
+
+
+# ---------- setup ----------
+
+def _dataset(engine, sample_titles=500):
+    """Id ranges and search words of the target database."""
+    with engine.connect() as connection:
+        users = connection.scalar(select(func.max(User.id))) or 0
+        books = connection.scalar(select(func.max(Book.id))) or 0
+        max_rental_id = connection.scalar(select(func.max(Rental.id))) or 1
+        titles = connection.scalars(select(Book.title).order_by(func.random()).limit(sample_titles)).all()
+    words = sorted({word for title in titles for word in title.split() if len(word) > 2 and not word.isdigit()})
+    if not users or not books:
+        raise click.ClickException("The database has no users or books; drop --database-url to generate some.")
+    return {"users": users, "books": books, "max_rental_id": max_rental_id, "words": words or ["a"]}
+
+
+@click.command()
+@click.option('--terminals', default=20, show_default=True, help="Concurrent counter terminals.")
+@click.option('--processes', is_flag=True, help="Run each terminal in its own process instead of a thread.")
+@click.option('--duration', default=30.0, show_default=True, help="Seconds to measure, after the warm-up.")
+@click.option('--warmup', default=3.0, show_default=True, help="Seconds run before measuring (caches, connections).")
+@click.option('--mix', default='rent=4,return=4,search=2', show_default=True,
+              help=f"Weighted operations, from: {', '.join(OPERATIONS)}.")
+@click.option('--think-ms', default=0.0, show_default=True, help="Mean pause between a terminal's calls.")
+@click.option('--interval', default=5.0, show_default=True, help="Seconds per line of the timeline.")
+@click.option('--retries', default=5, show_default=True, help="Retries of a call that found the database busy.")
+@click.option('--backoff-ms', default=10.0, show_default=True, help="First retry delay, doubled per retry.")
+@click.option('--busy-timeout', default=1.0, show_default=True,
+              help="Seconds SQLite waits for a lock before reporting the database busy.")
+@click.option('--zipf-s', default=1.1, show_default=True, help="Skew of the books picked; 0 for uniform.")
+@click.option('--users', default=5000, show_default=True, help="Synthetic users.")
+@click.option('--books', default=20000, show_default=True, help="Synthetic titles.")
+@click.option('--rentals', default=100000, show_default=True, help="Synthetic rental history.")
+@click.option('--seed', default=42, show_default=True, help="Random seed for the data and the terminals.")
+@click.option('--database-url', default=None, help="Run against this database instead of a synthetic one.")
+@click.option('--output', default=None, type=click.Path(dir_okay=False),
+              help="Write the summary and timeline as JSON, to compare runs.")
+def loadtest(terminals, processes, duration, warmup, mix, think_ms, interval, retries, backoff_ms, busy_timeout,
+             zipf_s, users, books, rentals, seed, database_url, output):
+    """Replay a mix of service calls from many terminals at once and report throughput and contention."""
+    mix = parse_mix(mix)
+    with tempfile.TemporaryDirectory() as directory:
+        url = database_url or f"sqlite:///{os.path.join(directory, 'loadtest.db')}"
+        engine = database.configure(url, **_engine_options(url, busy_timeout))
+        if database_url is None:
+            click.echo(f"Generating {users} users, {books} books and {rentals} rentals")
+            DataGenerator(users=users, books=books, rentals=rentals, seed=seed).load(engine)
+        settings = dict(_dataset(engine), mix=mix, zipf_s=zipf_s, think=think_ms / 1000, retries=retries,
+                        backoff=backoff_ms / 1000, busy_timeout=busy_timeout, seed=seed)
+
+        started = time.time()
+        measure_from = started + warmup
+        stop_at = measure_from + duration
+        mode = "processes" if processes else "threads"
+        click.echo(f"\n{terminals} terminals ({mode}), mix {', '.join(f'{n}={w:g}' for n, w in mix)}, "
+                   f"{duration:g}s after {warmup:g}s warm-up, against {engine.url.render_as_string()}")
+        if processes:
+            engine.dispose()  # Terminals open their own connections
+            context = multiprocessing.get_context("spawn")
+            samples = context.Queue()
+            workers = [context.Process(target=_terminal, args=(number, settings, stop_at, samples, url))
+                       for number in range(terminals)]
+        else:
+            samples = queue.Queue()
+            workers = [threading.Thread(target=_terminal, args=(number, settings, stop_at, samples), daemon=True)
+                       for number in range(terminals)]
+        for worker in workers:
+            worker.start()
+
+        measured, timeline, running = [], [], terminals
+        buckets = {}
+        while running:
+            try:
+                batch = samples.get(timeout=0.25)
+            except queue.Empty:
+                batch = []
+            if batch is None:
+                running -= 1
+                batch = []
+            for sample in batch:
+                if sample[0] >= measure_from:
+                    measured.append(sample)
+                    buckets.setdefault(int((sample[0] - measure_from) // interval), []).append(sample)
+            # An interval is complete once every terminal has sent what it did during it
+            while running and time.time() > measure_from + (len(timeline) + 1) * interval + 2 * SEND_SECONDS:
+                timeline.append(_interval_line(len(timeline), interval, buckets.pop(len(timeline), [])))
+                _echo_interval(timeline[-1])
+        for worker in workers:
+            worker.join()
+        while len(timeline) * interval < duration - 1e-9:
+            timeline.append(_interval_line(len(timeline), interval, buckets.pop(len(timeline), [])))
+            _echo_interval(timeline[-1])
+
+        summary = summarize(measured, duration)
+        _echo_summary(summary)
+        if output:
+            with open(output, "w") as report:
+                json.dump({"terminals": terminals, "mode": mode, "mix": dict(mix), "duration": duration,
+                           "summary": summary, "timeline": timeline}, report, indent=2)
+            click.echo(f"\nWrote {output}")
+        database.engine.dispose()
+
+
+if __name__ == "__main__":
+    loadtest()
@@ -5,12 +5,17 @@ from sqlalchemy import pool
 
 from alembic import context
 
+from lib.database import DATABASE_URL
 from lib.models import Base
 
 # this is the Alembic Config object, which provides
 # access to the values within the .ini file in use.
 config = context.config
 
+# DATABASE_URL (environment variable, default sqlite:///book_rental.db) wins
+# over alembic.ini so migrations always target the database the app uses
+config.set_main_option("sqlalchemy.url", DATABASE_URL.replace("%", "%%"))
+
 # Interpret the config file for Python logging.
 # This line sets up loggers basically.
 if config.config_file_name is not None:
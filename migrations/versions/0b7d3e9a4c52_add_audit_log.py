@@ -0,0 +1,40 @@
+"""Add the audit log
+
+Revision ID: 0b7d3e9a4c52
+Revises: e81b5d3f7a26
+Create Date: 2026-10-19 23:41:08.512377
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0b7d3e9a4c52'
+down_revision: Union[str, None] = 'e81b5d3f7a26'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'audit_log',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('at', sa.DateTime, nullable=False),
+        sa.Column('actor', sa.String, nullable=False),
+        sa.Column('branch', sa.String, nullable=True),
+        sa.Column('action', sa.String, nullable=False),
+        sa.Column('table_name', sa.String, nullable=False),
+        sa.Column('row_id', sa.Integer, nullable=True),
+        sa.Column('changes', sa.String, nullable=True),
+    )
+    op.create_index('ix_audit_log_row', 'audit_log', ['table_name', 'row_id', 'at'])
+    op.create_index('ix_audit_log_at', 'audit_log', ['at'])
+
+
+def downgrade() -> None:
+    op.drop_index('ix_audit_log_at', table_name='audit_log')
+    op.drop_index('ix_audit_log_row', table_name='audit_log')
+    op.drop_table('audit_log')
@@ -0,0 +1,38 @@
+"""Add reservations
+
+Revision ID: 3c1d8a7e5f20
+Revises: b92f45f82e82
+Create Date: 2026-10-19 09:12:41.308215
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3c1d8a7e5f20'
+down_revision: Union[str, None] = 'b92f45f82e82'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'reservations',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('user_id', sa.Integer, sa.ForeignKey('users.id'), nullable=False),
+        sa.Column('book_id', sa.Integer, sa.ForeignKey('books.id'), nullable=False),
+        sa.Column('created_at', sa.DateTime, nullable=False),
+        sa.Column('expires_at', sa.DateTime, nullable=False),
+        sa.Column('status', sa.String, nullable=False),
+    )
+    op.create_index('ix_reservations_queue', 'reservations', ['book_id', 'status', 'id'])
+    op.create_index('ix_reservations_user', 'reservations', ['user_id', 'status'])
+
+
+def downgrade() -> None:
+    op.drop_index('ix_reservations_user', table_name='reservations')
+    op.drop_index('ix_reservations_queue', table_name='reservations')
+    op.drop_table('reservations')
@@ -0,0 +1,63 @@
+"""Never reuse rental ids on SQLite
+
+Revision ID: 5d8e1f0a6b39
+Revises: 0b7d3e9a4c52
+Create Date: 2026-10-20 10:12:44.309183
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+from lib.online_migration import rebuild_table
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5d8e1f0a6b39'
+down_revision: Union[str, None] = '0b7d3e9a4c52'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+INDEXES = [
+    ('ix_rentals_open_due', ['due_date', 'id'], 'return_date IS NULL'),
+    ('ix_rentals_user_history', ['user_id', 'rent_date', 'return_date', 'due_date', 'penalty']),
+]
+
+
+def _columns():
+    return [
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('user_id', sa.Integer, sa.ForeignKey('users.id'), nullable=False),
+        sa.Column('book_id', sa.Integer, sa.ForeignKey('books.id'), nullable=False),
+        sa.Column('rent_date', sa.DateTime),
+        sa.Column('return_date', sa.DateTime, nullable=True),
+        sa.Column('due_date', sa.DateTime, nullable=False),
+        sa.Column('penalty', sa.Float),
+        sa.Column('rate_plan_id', sa.Integer, sa.ForeignKey('rate_plans.id', name='fk_rentals_rate_plan_id'),
+                  nullable=True),
+    ]
+
+
+def upgrade() -> None:
+    # PostgreSQL's serial sequences never hand out an id twice already. SQLite
+    # gives a new row max(id) + 1 unless the table is AUTOINCREMENT, so an
+    # archived or deleted newest rental would have its id reused.
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    with op.get_context().autocommit_block():
+        rebuild_table(op.get_bind(), 'rentals', _columns(), INDEXES, table_kwargs={'sqlite_autoincrement': True})
+        # Start past every id already used, archived rentals included
+        op.execute("DELETE FROM sqlite_sequence WHERE name = 'rentals'")
+        op.execute("""
+            INSERT INTO sqlite_sequence (name, seq) SELECT 'rentals', MAX(
+                (SELECT COALESCE(MAX(id), 0) FROM rentals),
+                (SELECT COALESCE(MAX(id), 0) FROM rentals_archive))
+        """)
+
+
+def downgrade() -> None:
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    with op.get_context().autocommit_block():
+        rebuild_table(op.get_bind(), 'rentals', _columns(), INDEXES)
@@ -7,7 +7,7 @@ Create Date: 2024-09-18 09:20:37.704954
 """
 from typing import Sequence, Union
 
-from alembic import op
+from alembic import context, op
 import sqlalchemy as sa
 
 
@@ -19,9 +19,45 @@ depends_on: Union[str, Sequence[str], None] = None
 
 
 def upgrade() -> None:
-    # ### commands auto generated by Alembic - please adjust! ###
-    pass
-    # ### end Alembic commands ###
+    # The original autogenerate left this empty because the tables had been
+    # created with create_all(). Create them here when they are missing so a
+    # fresh database (SQLite or PostgreSQL) can be built from migrations alone.
+    # Offline (--sql) runs have no database to inspect and emit everything
+    existing = set() if context.is_offline_mode() else set(sa.inspect(op.get_bind()).get_table_names())
+    if 'users' not in existing:
+        op.create_table(
+            'users',
+            sa.Column('id', sa.Integer, primary_key=True),
+            sa.Column('name', sa.String, nullable=False),
+            sa.Column('email', sa.String, nullable=False, unique=True),
+        )
+    if 'books' not in existing:
+        op.create_table(
+            'books',
+            sa.Column('id', sa.Integer, primary_key=True),
+            sa.Column('title', sa.String, nullable=False),
+            sa.Column('author', sa.String, nullable=False),
+            sa.Column('available', sa.Integer, nullable=False),
+            sa.Column('genres', sa.String, nullable=True),
+        )
+    if 'user_books' not in existing:
+        op.create_table(
+            'user_books',
+            sa.Column('id', sa.Integer, primary_key=True),
+            sa.Column('user_id', sa.Integer, sa.ForeignKey('users.id')),
+            sa.Column('book_id', sa.Integer, sa.ForeignKey('books.id')),
+        )
+    if 'rentals' not in existing:
+        op.create_table(
+            'rentals',
+            sa.Column('id', sa.Integer, primary_key=True),
+            sa.Column('user_id', sa.Integer, sa.ForeignKey('users.id'), nullable=False),
+            sa.Column('book_id', sa.Integer, sa.ForeignKey('books.id'), nullable=False),
+            sa.Column('rent_date', sa.DateTime),
+            sa.Column('return_date', sa.DateTime, nullable=True),
+            sa.Column('due_date', sa.DateTime, nullable=False),
+            sa.Column('penalty', sa.Float),
+        )
 
 
 def downgrade() -> None:
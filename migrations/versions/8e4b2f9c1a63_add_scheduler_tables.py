@@ -0,0 +1,47 @@
+"""Add scheduler tables and open rental index
+
+Revision ID: 8e4b2f9c1a63
+Revises: 3c1d8a7e5f20
+Create Date: 2026-10-19 11:03:17.552904
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8e4b2f9c1a63'
+down_revision: Union[str, None] = '3c1d8a7e5f20'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'rental_notices',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('rental_id', sa.Integer, sa.ForeignKey('rentals.id'), nullable=False),
+        sa.Column('user_id', sa.Integer, sa.ForeignKey('users.id'), nullable=False),
+        sa.Column('kind', sa.String, nullable=False),
+        sa.Column('due_date', sa.DateTime, nullable=False),
+        sa.Column('created_at', sa.DateTime, nullable=False),
+        sa.UniqueConstraint('rental_id', 'kind', name='uq_rental_notices_rental_kind'),
+    )
+    op.create_table(
+        'watermarks',
+        sa.Column('name', sa.String, primary_key=True),
+        sa.Column('position', sa.DateTime, nullable=True),
+        sa.Column('last_id', sa.Integer, nullable=False),
+        sa.Column('updated_at', sa.DateTime, nullable=True),
+    )
+    op.create_index('ix_rentals_open_due', 'rentals', ['due_date', 'id'],
+                    sqlite_where=sa.text('return_date IS NULL'),
+                    postgresql_where=sa.text('return_date IS NULL'))
+
+
+def downgrade() -> None:
+    op.drop_index('ix_rentals_open_due', table_name='rentals')
+    op.drop_table('watermarks')
+    op.drop_table('rental_notices')
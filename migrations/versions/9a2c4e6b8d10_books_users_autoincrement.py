@@ -0,0 +1,64 @@
+"""Never reuse book or user ids on SQLite
+
+Revision ID: 9a2c4e6b8d10
+Revises: 5d8e1f0a6b39
+Create Date: 2026-10-20 15:41:07.518264
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+from lib.online_migration import rebuild_table
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9a2c4e6b8d10'
+down_revision: Union[str, None] = '5d8e1f0a6b39'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def _users():
+    return [
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('name', sa.String, nullable=False),
+        sa.Column('email', sa.String, unique=True, nullable=False),
+        sa.Column('tier', sa.String, nullable=False, server_default='standard'),
+    ]
+
+
+def _books():
+    return [
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('title', sa.String, nullable=False),
+        sa.Column('author', sa.String, nullable=False),
+        sa.Column('available', sa.Integer),
+        sa.Column('genres', sa.String, nullable=True),
+    ]
+
+
+def upgrade() -> None:
+    # Like rentals: without AUTOINCREMENT a new row takes max(id) + 1, so a
+    # deleted newest book or user would lend its id, and its archived
+    # rentals, to the next one.
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    with op.get_context().autocommit_block():
+        for table, columns, column in (('users', _users(), 'user_id'), ('books', _books(), 'book_id')):
+            rebuild_table(op.get_bind(), table, columns, table_kwargs={'sqlite_autoincrement': True})
+            op.execute(f"DELETE FROM sqlite_sequence WHERE name = '{table}'")
+            op.execute(f"""
+                INSERT INTO sqlite_sequence (name, seq) SELECT '{table}', MAX(
+                    (SELECT COALESCE(MAX(id), 0) FROM {table}),
+                    (SELECT COALESCE(MAX({column}), 0) FROM rentals_archive))
+            """)
+
+
+def downgrade() -> None:
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    with op.get_context().autocommit_block():
+        rebuild_table(op.get_bind(), 'users', _users())
+        rebuild_table(op.get_bind(), 'books', _books())
@@ -0,0 +1,46 @@
+"""Add rentals archive
+
+Revision ID: a4c81e6d2f93
+Revises: f27c6d0e9b18
+Create Date: 2026-10-19 16:02:37.514209
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a4c81e6d2f93'
+down_revision: Union[str, None] = 'f27c6d0e9b18'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'rentals_archive',
+        sa.Column('id', sa.Integer, primary_key=True, autoincrement=False),
+        sa.Column('user_id', sa.Integer, nullable=False),
+        sa.Column('book_id', sa.Integer, nullable=False),
+        sa.Column('rent_date', sa.DateTime, nullable=True),
+        sa.Column('return_date', sa.DateTime, nullable=False),
+        sa.Column('due_date', sa.DateTime, nullable=False),
+        sa.Column('penalty', sa.Float, nullable=True),
+        sa.Column('archived_at', sa.DateTime, nullable=False),
+    )
+    op.create_index('ix_rentals_archive_user_history', 'rentals_archive',
+                    ['user_id', 'rent_date', 'return_date', 'due_date', 'penalty'])
+    op.create_index('ix_rentals_archive_returned', 'rentals_archive', ['return_date'])
+
+
+def downgrade() -> None:
+    # Put archived rentals back before dropping the archive
+    op.execute(
+        "INSERT INTO rentals (id, user_id, book_id, rent_date, due_date, return_date, penalty) "
+        "SELECT id, user_id, book_id, rent_date, due_date, return_date, penalty FROM rentals_archive"
+    )
+    op.drop_index('ix_rentals_archive_returned', table_name='rentals_archive')
+    op.drop_index('ix_rentals_archive_user_history', table_name='rentals_archive')
+    op.drop_table('rentals_archive')
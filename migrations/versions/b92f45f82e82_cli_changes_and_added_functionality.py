@@ -7,9 +7,11 @@ Create Date: 2024-09-18 16:54:49.029399
 """
 from typing import Sequence, Union
 
-from alembic import op
+from alembic import context, op
 import sqlalchemy as sa
 
+from lib.online_migration import rebuild_table
+
 
 # revision identifiers, used by Alembic.
 revision: str = 'b92f45f82e82'
@@ -19,16 +21,27 @@ depends_on: Union[str, Sequence[str], None] = None
 
 
 def upgrade():
-    # ### commands auto generated by Alembic - please adjust! ###
-     # Create a new table with the modified column (no NOT NULL constraint on 'available')
-    op.create_table(
-        'new_books',
+    # SQLite cannot drop a NOT NULL constraint in place, hence the rebuild below
+    if op.get_bind().dialect.name != 'sqlite':
+        op.alter_column('books', 'available', existing_type=sa.Integer, nullable=True)
+        return
+
+    columns = [
         sa.Column('id', sa.Integer, primary_key=True),
         sa.Column('title', sa.String, nullable=False),
         sa.Column('author', sa.String, nullable=False),
         sa.Column('available', sa.Integer, nullable=True),  # 'available' can now be NULL
         sa.Column('genres', sa.String, nullable=True)
-    )
+    ]
+    if not context.is_offline_mode():
+        # Copy in chunks while rentals keep writing; the write lock is only held for the swap
+        with op.get_context().autocommit_block():
+            rebuild_table(op.get_bind(), 'books', columns)
+        return
+
+    # ### commands auto generated by Alembic - please adjust! ###
+     # Create a new table with the modified column (no NOT NULL constraint on 'available')
+    op.create_table('new_books', *columns)
     
     # Copy data from the old 'books' table to the new one
     op.execute('''
@@ -45,6 +58,10 @@ def upgrade():
 
 
 def downgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        op.alter_column('books', 'available', existing_type=sa.Integer, nullable=False)
+        return
+
     # ### commands auto generated by Alembic - please adjust! ###
     # Recreate the original table (with NOT NULL constraint on 'available')
     op.create_table(
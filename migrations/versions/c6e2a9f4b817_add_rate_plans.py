@@ -0,0 +1,47 @@
+"""Add rate plans and membership tiers
+
+Revision ID: c6e2a9f4b817
+Revises: a4c81e6d2f93
+Create Date: 2026-10-19 18:21:09.603512
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c6e2a9f4b817'
+down_revision: Union[str, None] = 'a4c81e6d2f93'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'rate_plans',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('name', sa.String, nullable=False, unique=True),
+        sa.Column('genre', sa.String, nullable=True),
+        sa.Column('tier', sa.String, nullable=True),
+        sa.Column('loan_days', sa.Integer, nullable=False),
+        sa.Column('daily_penalty', sa.Float, nullable=False),
+        sa.Column('penalty_cap', sa.Float, nullable=True),
+        sa.Column('grace_days', sa.Integer, nullable=False),
+    )
+    op.add_column('users', sa.Column('tier', sa.String, nullable=False, server_default='standard'))
+    op.add_column('rentals', sa.Column('rate_plan_id', sa.Integer, nullable=True))
+    op.add_column('rentals_archive', sa.Column('rate_plan_id', sa.Integer, nullable=True))
+    # SQLite can't add a constraint to an existing table: batch mode copies it into a new one
+    with op.batch_alter_table('rentals') as batch:
+        batch.create_foreign_key('fk_rentals_rate_plan_id', 'rate_plans', ['rate_plan_id'], ['id'])
+
+
+def downgrade() -> None:
+    with op.batch_alter_table('rentals') as batch:
+        batch.drop_constraint('fk_rentals_rate_plan_id', type_='foreignkey')
+    op.drop_column('rentals_archive', 'rate_plan_id')
+    op.drop_column('rentals', 'rate_plan_id')
+    op.drop_column('users', 'tier')
+    op.drop_table('rate_plans')
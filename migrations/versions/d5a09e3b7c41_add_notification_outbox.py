@@ -0,0 +1,43 @@
+"""Add notification outbox
+
+Revision ID: d5a09e3b7c41
+Revises: 8e4b2f9c1a63
+Create Date: 2026-10-19 13:26:02.914377
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd5a09e3b7c41'
+down_revision: Union[str, None] = '8e4b2f9c1a63'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'notifications',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('user_id', sa.Integer, sa.ForeignKey('users.id'), nullable=False),
+        sa.Column('email', sa.String, nullable=False),
+        sa.Column('kind', sa.String, nullable=False),
+        sa.Column('subject', sa.String, nullable=False),
+        sa.Column('body', sa.String, nullable=False),
+        sa.Column('dedup_key', sa.String, nullable=False, unique=True),
+        sa.Column('status', sa.String, nullable=False),
+        sa.Column('attempts', sa.Integer, nullable=False),
+        sa.Column('next_attempt_at', sa.DateTime, nullable=False),
+        sa.Column('created_at', sa.DateTime, nullable=False),
+        sa.Column('sent_at', sa.DateTime, nullable=True),
+        sa.Column('last_error', sa.String, nullable=True),
+    )
+    op.create_index('ix_notifications_due', 'notifications', ['status', 'next_attempt_at', 'id'])
+
+
+def downgrade() -> None:
+    op.drop_index('ix_notifications_due', table_name='notifications')
+    op.drop_table('notifications')
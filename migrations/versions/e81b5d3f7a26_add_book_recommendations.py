@@ -0,0 +1,44 @@
+"""Add book co-rental pairs and top-k neighbors
+
+Revision ID: e81b5d3f7a26
+Revises: c6e2a9f4b817
+Create Date: 2026-10-19 20:04:37.218940
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e81b5d3f7a26'
+down_revision: Union[str, None] = 'c6e2a9f4b817'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'book_pairs',
+        sa.Column('book_a', sa.Integer, primary_key=True),
+        sa.Column('book_b', sa.Integer, primary_key=True),
+        sa.Column('co_rentals', sa.Integer, nullable=False),
+    )
+    op.create_index('ix_book_pairs_b', 'book_pairs', ['book_b', 'book_a'])
+    op.create_table(
+        'book_neighbors',
+        sa.Column('book_id', sa.Integer, primary_key=True),
+        sa.Column('rank', sa.Integer, primary_key=True),
+        sa.Column('neighbor_id', sa.Integer, nullable=False),
+        sa.Column('score', sa.Float, nullable=False),
+        sa.Column('co_rentals', sa.Integer, nullable=False),
+    )
+    op.create_index('ix_book_neighbors_neighbor', 'book_neighbors', ['neighbor_id'])
+
+
+def downgrade() -> None:
+    op.drop_index('ix_book_neighbors_neighbor', table_name='book_neighbors')
+    op.drop_table('book_neighbors')
+    op.drop_index('ix_book_pairs_b', table_name='book_pairs')
+    op.drop_table('book_pairs')
@@ -0,0 +1,26 @@
+"""Add rentals user index
+
+Revision ID: f27c6d0e9b18
+Revises: d5a09e3b7c41
+Create Date: 2026-10-19 14:48:55.120663
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f27c6d0e9b18'
+down_revision: Union[str, None] = 'd5a09e3b7c41'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index('ix_rentals_user_history', 'rentals',
+                    ['user_id', 'rent_date', 'return_date', 'due_date', 'penalty'])
+
+
+def downgrade() -> None:
+    op.drop_index('ix_rentals_user_history', table_name='rentals')
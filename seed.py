@@ -4,6 +4,7 @@ from lib.services.book_service import BookService
 from lib.services.rental_service import RentalService
 from lib.models import User, Book, Rental, UserBook
 from lib.database import get_session
+from lib import matching
 from datetime import datetime, timezone, timedelta
 
 # Initialize services
@@ -95,6 +96,14 @@ def rent_book_for_seed(user_name, book_title, days_rented_ago=0, due_days_ago=0)
         user = session.query(User).filter_by(name=user_name).first()
         book = session.query(Book).filter_by(title=book_title).first()
 
+        # Tolerate typos in the seed data when the best fuzzy match is clear
+        if not user:
+            best = matching.pick(user_name, matching.matcher().user_names(user_name))
+            user = session.get(User, best[1]) if best else None
+        if not book:
+            best = matching.pick(book_title, matching.matcher().books(title=book_title))
+            book = session.get(Book, best[1]) if best else None
+
         if not user:
             print(f"Error: User '{user_name}' not found.")
             return
@@ -0,0 +1,64 @@
+"""Fixtures pointing lib.database at a scratch database for each test.
+
+Every backend test runs against a temporary SQLite file and, when one is
+reachable, the PostgreSQL database in TEST_POSTGRES_URL (or DATABASE_URL
+if that names PostgreSQL). Its tables are dropped and recreated per test.
+"""
+import os
+import sys
+
+import pytest
+from sqlalchemy import create_engine, text
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib import availability, database, matching, pricing  # noqa: E402
+from lib.models import Base  # noqa: E402
+
+POSTGRES_URL = os.environ.get("TEST_POSTGRES_URL") or (
+    database.DATABASE_URL if database.DATABASE_URL.startswith("postgresql")
+    else "postgresql+psycopg2://postgres@localhost/book_rental_test"
+)
+
+
+def _reachable(url):
+    try:
+        engine = create_engine(url, connect_args={"connect_timeout": 2})
+        with engine.connect() as connection:
+            connection.execute(text("SELECT 1"))
+        engine.dispose()
+        return True
+    except Exception:  # No driver, no server, no database
+        return False
+
+
+_postgres = None
+
+
+def postgres_url():
+    global _postgres
+    if _postgres is None:
+        _postgres = _reachable(POSTGRES_URL)
+    if not _postgres:
+        pytest.skip(f"No PostgreSQL server at {POSTGRES_URL} (set TEST_POSTGRES_URL)")
+    return POSTGRES_URL
+
+
+@pytest.fixture(params=["sqlite", "postgresql"])
+def database_url(request, tmp_path):
+    if request.param == "sqlite":
+        return f"sqlite:///{tmp_path / 'book_rental.db'}"
+    return postgres_url()
+
+
+@pytest.fixture
+def db(database_url):
+    """A freshly created schema that every service uses; yields the engine."""
+    engine = database.configure(database_url)
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    pricing.invalidate()
+    matching._matchers.clear()
+    availability._snapshots.clear()
+    yield engine
+    engine.dispose()
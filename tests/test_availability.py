@@ -0,0 +1,72 @@
+"""The in-process availability snapshot: reloads, notes from write paths and stale notes."""
+import time
+
+from sqlalchemy import insert, update
+
+from lib import availability
+from lib.models import Book, User
+from lib.services.rental_service import RentalService
+
+
+def _book(db, available):
+    with db.begin() as connection:
+        return connection.execute(
+            insert(Book).values(title="Kindred", author="Octavia Butler", available=available).returning(Book.id)
+        ).scalar()
+
+
+def _set(db, book_id, available):
+    """Change a book behind the snapshot's back, like another process would."""
+    with db.begin() as connection:
+        connection.execute(update(Book).where(Book.id == book_id).values(available=available))
+
+
+def test_reloads_when_another_writer_commits(db):
+    book_id = _book(db, 3)
+    snapshot = availability.AvailabilitySnapshot(poll_seconds=0)
+    assert snapshot.available(book_id) == 3
+    assert snapshot.available(book_id + 1) is None
+
+    _set(db, book_id, 1)
+    # PostgreSQL publishes its table counters a moment after the commit
+    deadline = time.monotonic() + 5
+    while snapshot.available(book_id) != 1 and time.monotonic() < deadline:
+        time.sleep(0.1)
+    assert snapshot.available(book_id) == 1
+    assert snapshot.reloads > 1
+    assert snapshot.totals() == (1, 1)
+    assert snapshot.verify() == []
+    snapshot.close()
+
+
+def test_own_writes_show_up_without_a_reload(db):
+    with db.begin() as connection:
+        user_id = connection.execute(
+            insert(User).values(name="Ada", email="ada@example.com").returning(User.id)).scalar()
+    book_id = _book(db, 2)
+    snapshot = availability._snapshots[None] = availability.AvailabilitySnapshot(poll_seconds=3600)
+
+    assert RentalService().rent_book(user_id, book_id).startswith("User")
+    assert snapshot.available(book_id) == 1
+    assert snapshot.reloads == 1
+    snapshot.close()
+
+
+def test_stale_notes_are_dropped(db):
+    book_id = _book(db, 3)
+    snapshot = availability.AvailabilitySnapshot(poll_seconds=3600)
+
+    # A writer read 2 copies, then a reload saw a later commit before the note came in
+    read_at = availability.stamp()
+    _set(db, book_id, 5)
+    snapshot.reload()
+    assert not snapshot.note(book_id, 2, read_at)
+    assert snapshot.available(book_id) == 5
+
+    # Two notes for one book arriving out of order: the later read wins
+    first, second = availability.stamp(), availability.stamp()
+    assert snapshot.note(book_id, 4, second)
+    assert not snapshot.note(book_id, 6, first)
+    assert snapshot.available(book_id) == 4
+    assert snapshot.totals() == (1, 4)
+    snapshot.close()
@@ -0,0 +1,248 @@
+"""Rentals, the waitlist, the outbox and watermarks on SQLite and PostgreSQL.
+
+The concurrent cases are what the row locks (FOR UPDATE, SKIP LOCKED) and
+conflict-ignoring inserts exist for; they run wherever the backend can
+take concurrent writers.
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from sqlalchemy import func, select
+
+from lib import matching, notifications, recommendations
+from lib.database import get_session
+from lib.models import Book, Notification, Rental, Reservation, User
+from lib.services.rental_service import RentalService
+from lib.services.reservation_service import ReservationService
+from lib.services.user_service import UserService
+
+
+def _add(*rows):
+    session = get_session()
+    try:
+        session.add_all(rows)
+        session.commit()
+        return [row.id for row in rows]
+    finally:
+        session.close()
+
+
+def _users(count):
+    return _add(*(User(name=f"User {n}", email=f"user{n}@example.com") for n in range(count)))
+
+
+def _book(available=1, title="Things Fall Apart"):
+    return _add(Book(title=title, author="Chinua Achebe", available=available))[0]
+
+
+def _available(book_id):
+    session = get_session()
+    try:
+        return session.get(Book, book_id).available
+    finally:
+        session.close()
+
+
+def _open_rental(user_id, book_id):
+    session = get_session()
+    try:
+        return session.scalar(select(Rental.id).where(Rental.user_id == user_id, Rental.book_id == book_id,
+                                                      Rental.return_date.is_(None)))
+    finally:
+        session.close()
+
+
+def _concurrent(calls):
+    """Run the calls at once, released together, and return their results in order."""
+    start = threading.Barrier(len(calls))
+
+    def run(call):
+        start.wait()
+        return call()
+
+    with ThreadPoolExecutor(len(calls)) as pool:
+        return list(pool.map(run, calls))
+
+
+def test_rent_and_return(db):
+    alice, bob = _users(2)
+    book_id = _book(available=1)
+    rentals = RentalService()
+
+    assert rentals.rent_book(alice, book_id) == "User 'User 0' rented book 'Things Fall Apart'"
+    assert rentals.rent_book(bob, book_id) == "Error: Book is unavailable."
+    assert _available(book_id) == 0
+
+    rental_id = _open_rental(alice, book_id)
+    assert rentals.return_book(rental_id) == f"Rental ID {rental_id} returned with a penalty of 0.0 KSh."
+    assert rentals.return_book(rental_id).startswith("Error:")
+    assert _available(book_id) == 1
+
+
+def test_last_copy_goes_to_one_renter(db):
+    if db.dialect.name == "sqlite":
+        pytest.skip("SQLite runs one writer at a time; the race needs row locks")
+    users = _users(8)
+    book_id = _book(available=1)
+    rentals = RentalService()
+
+    results = _concurrent([lambda user_id=user_id: rentals.rent_book(user_id, book_id) for user_id in users])
+
+    assert sum(not result.startswith("Error") for result in results) == 1
+    assert results.count("Error: Book is unavailable.") == 7
+    assert _available(book_id) == 0
+
+
+def test_return_hands_the_copy_to_the_waitlist(db):
+    alice, bob, carol = _users(3)
+    book_id = _book(available=1)
+    rentals, reservations = RentalService(), ReservationService()
+
+    rentals.rent_book(alice, book_id)
+    assert "joined the waitlist" in reservations.reserve_book(bob, book_id)
+    assert "joined the waitlist" in reservations.reserve_book(carol, book_id)
+
+    result = rentals.return_book(_open_rental(alice, book_id))
+    assert f"Copy held for user ID {bob}" in result
+    assert _available(book_id) == 0  # Held, not shelved
+    assert rentals.rent_book(carol, book_id) == "Error: Book is unavailable."
+    assert rentals.rent_book(bob, book_id) == "User 'User 1' rented book 'Things Fall Apart'"
+
+
+def test_concurrent_returns_serve_distinct_waiters(db):
+    if db.dialect.name == "sqlite":
+        pytest.skip("SQLite runs one writer at a time; the race needs SKIP LOCKED")
+    first, second, third, fourth = _users(4)
+    book_id = _book(available=2)
+    rentals, reservations = RentalService(), ReservationService()
+    rentals.rent_book(first, book_id)
+    rentals.rent_book(second, book_id)
+    reservations.reserve_book(third, book_id)
+    reservations.reserve_book(fourth, book_id)
+
+    _concurrent([lambda rental_id=_open_rental(user_id, book_id): rentals.return_book(rental_id)
+                 for user_id in (first, second)])
+
+    session = get_session()
+    try:
+        ready = session.scalars(select(Reservation.user_id).where(Reservation.status == 'ready')).all()
+    finally:
+        session.close()
+    assert sorted(ready) == [third, fourth]
+    assert _available(book_id) == 0
+
+
+def _notices(user_id, count, prefix="notice"):
+    return [{"user_id": user_id, "email": "user0@example.com", "kind": "reminder", "subject": "Due soon",
+             "body": "Please return it.", "dedup_key": f"{prefix}:{n}"} for n in range(count)]
+
+
+def _enqueue(notices):
+    session = get_session()
+    try:
+        notifications.enqueue(session, notices)
+        session.commit()
+    finally:
+        session.close()
+
+
+def test_enqueue_skips_known_dedup_keys(db):
+    (user_id,) = _users(1)
+    notices = _notices(user_id, 3)
+    _enqueue(notices)
+    _enqueue(notices + _notices(user_id, 1, prefix="other"))
+
+    session = get_session()
+    try:
+        assert session.scalar(select(func.count()).select_from(Notification)) == 4
+    finally:
+        session.close()
+
+
+def test_workers_claim_each_notification_once(db):
+    (user_id,) = _users(1)
+    _enqueue(_notices(user_id, 200))
+    workers = [notifications.NotificationWorker(transport=None, batch_size=30) for _ in range(4)]
+
+    claimed = []
+    while True:
+        batches = _concurrent([worker.claim for worker in workers])
+        if not any(batches):
+            break
+        claimed.extend(row["id"] for batch in batches for row in batch)
+
+    assert len(claimed) == len(set(claimed)) == 200
+
+
+def test_listings_stream_past_one_batch(db):
+    _users(2500)  # More than STREAM_BATCH_SIZE: a server-side cursor on PostgreSQL
+    assert len(UserService().list_users()) == 2500
+
+
+def _rent(session, user_id, book_id):
+    rental = Rental(user_id=user_id, book_id=book_id, due_date=recommendations._utcnow())
+    session.add(rental)
+    session.flush()
+    return rental
+
+
+def test_recommendations_wait_for_lower_ids_to_commit(db, monkeypatch):
+    monkeypatch.setattr(recommendations, "COMMIT_LAG_SECONDS", 0.5)
+    first, second = _users(2)
+    books = [_book(title=f"Book {n}") for n in range(3)]
+    session = get_session()
+    _rent(session, first, books[0])
+    _rent(session, first, books[1])
+    session.commit()
+    recommender = recommendations.Recommender()
+    recommender.rebuild(echo=lambda line: None)
+
+    # A rental takes the lower id but commits after a higher one
+    slow, fast = get_session(), get_session()
+    postgres = db.dialect.name == "postgresql"
+    _rent(slow, second, books[0])
+    if not postgres:
+        slow.commit()  # SQLite: the second writer would wait for the first anyway
+    _rent(fast, second, books[1])
+    fast.commit()
+
+    if postgres:
+        assert recommender.update() == 0  # Not settled yet
+        slow.commit()
+        deadline = time.monotonic() + 5
+        folded = 0
+        while folded < 2 and time.monotonic() < deadline:
+            time.sleep(0.2)
+            folded += recommender.update()
+        assert folded == 2
+    else:
+        assert recommender.update() == 2
+    slow.close()
+    fast.close()
+    session.close()
+
+    assert "(2 shared renters)" in recommender.for_book(books[0])[0]
+
+
+def test_name_index_picks_up_late_commits(db, monkeypatch):
+    monkeypatch.setattr(matching, "COMMIT_LAG_SECONDS", 0.5)
+    _book(title="Dune")
+    index = matching.Matcher()
+    assert index.books(title="Dune")[0][2] == "Dune"
+
+    slow, fast = get_session(), get_session()
+    slow.add(Book(title="Hyperion", author="Dan Simmons", available=1))
+    slow.flush()
+    if db.dialect.name == "sqlite":
+        slow.commit()
+    fast.add(Book(title="Foundation", author="Isaac Asimov", available=1))
+    fast.commit()
+    assert index.books(title="Foundation")[0][2] == "Foundation"
+    slow.commit()
+    slow.close()
+    fast.close()
+
+    time.sleep(0.6)
+    assert index.books(title="Hyperion")[0][2] == "Hyperion"
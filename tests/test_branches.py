@@ -0,0 +1,18 @@
+"""Searching every branch database when one of them can't be reached."""
+from lib import database
+from lib.services.book_service import BookService
+
+
+def test_search_keeps_the_branches_that_answered(db, monkeypatch, tmp_path):
+    monkeypatch.setattr(database, "BRANCH_URLS", {
+        "east": db.url.render_as_string(hide_password=False),
+        "west": f"sqlite:///{tmp_path / 'missing' / 'west.db'}",
+    })
+    monkeypatch.setattr(database, "_branch_engines", {})
+    BookService("east").add_book("The Hobbit", "J. R. R. Tolkien", 2)
+
+    matches, errors = BookService().search_all_branches(title="hobbit")
+
+    assert [(branch, book.title) for branch, book in matches] == [("east", "The Hobbit")]
+    assert [branch for branch, _ in errors] == ["west"]
+    assert "unable to open database file" in errors[0][1]